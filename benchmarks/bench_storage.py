@@ -0,0 +1,166 @@
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import database as db  # noqa: E402
+from gen_dataset import BASE_USER_ID, generate  # noqa: E402
+
+# database.py funksiyalari uchun mikrobenchmark: har bir hajmdagi sintetik baza (gen_dataset.py)
+# nusxasida har bir funksiya bir necha marta chaqiriladi va median/p95 vaqt yoziladi.
+# Natija jadval ko'rinishida chiqadi va --json bilan vaqt o'tishi bilan solishtirish uchun saqlanadi.
+#
+#   python benchmarks/bench_storage.py --sizes 10000,100000,1000000 --json results.json
+
+
+def _timings(values):
+    values = sorted(values)
+    return {
+        "runs": len(values),
+        "median_ms": round(statistics.median(values) * 1000, 3),
+        "p95_ms": round(values[min(len(values) - 1, int(0.95 * len(values)))] * 1000, 3),
+        "mean_ms": round(statistics.fmean(values) * 1000, 3),
+    }
+
+
+def _cases(size: int, rng: random.Random, state: dict):
+    # (nom, chaqiruv, takrorlar soni ko'paytuvchisi). Og'ir so'rovlar kamroq takrorlanadi.
+    def uid():
+        return BASE_USER_ID + rng.randrange(size)
+
+    async def register_with_referral():
+        state["next"] += 1
+        user_id = state["next"]
+        await db.load_user(user_id, None)
+        await db.set_pending_ref(user_id, uid())
+        start = time.perf_counter()
+        await db.register_user(user_id, f"+1{user_id}")
+        return time.perf_counter() - start
+
+    def consume(stream):
+        return sum(1 for _ in stream)
+
+    return [
+        ("load_user", lambda: db.load_user(uid(), "bench"), 1),
+        ("get_user_refs", lambda: db.get_user_refs(uid()), 1),
+        ("get_user_rank", lambda: db.get_user_rank(rng.randrange(5)), 1),
+        ("get_top_refs", lambda: db.get_top_refs(10), 1),
+        ("get_memberships", lambda: db.get_memberships(uid(), state["channels"]), 1),
+        ("register_user+referral", register_with_referral, 1),
+        ("get_stats", db.get_stats, 1),
+        ("get_counter_totals", lambda: db.get_counter_totals([3600, 86400, 7 * 86400]), 1),
+        ("get_counter_series", lambda: db.get_counter_series("users", 86400, 30), 1),
+        ("draw_winners", lambda: db.draw_winners(10, rng.randrange(1 << 30)), 0.1),
+        ("draw_winners weighted", lambda: db.draw_winners(10, rng.randrange(1 << 30), True), 0.1),
+        ("get_all_users", db.get_all_users, 0.05),
+        ("stream_users", lambda: asyncio.to_thread(consume, db.stream_users()), 0.05),
+    ]
+
+
+async def bench_size(path: str, size: int, repeat: int, only=None):
+    results = []
+    await db.init_db(path)
+    try:
+        rng = random.Random(size)
+        state = {"next": BASE_USER_ID + size + 1, "channels": await db.get_channels()}
+        for name, call, factor in _cases(size, rng, state):
+            if only and not any(o in name for o in only):
+                continue
+            runs = max(3, int(repeat * factor))
+            await call()  # isitish
+            values = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                measured = await call()
+                elapsed = time.perf_counter() - start
+                values.append(measured if isinstance(measured, float) else elapsed)
+            row = {"size": size, "case": name, **_timings(values)}
+            results.append(row)
+            print(f"  {name:<26}{row['median_ms']:>10.3f} ms{row['p95_ms']:>10.3f} ms  ({runs})")
+    finally:
+        await db.close_db()
+    return results
+
+
+def _table(results, sizes):
+    cases = list(dict.fromkeys(r["case"] for r in results))
+    by_key = {(r["case"], r["size"]): r for r in results}
+    header = f"{'median ms (p95)':<26}" + "".join(f"{size:>22,}" for size in sizes)
+    lines = [header, "-" * len(header)]
+    for case in cases:
+        cells = []
+        for size in sizes:
+            r = by_key.get((case, size))
+            cells.append(f"{r['median_ms']:>12.3f} ({r['p95_ms']:.2f})".rjust(22) if r else " " * 22)
+        lines.append(f"{case:<26}" + "".join(cells))
+    return "\n".join(lines)
+
+
+def _meta():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "sqlite": sqlite3.sqlite_version,
+    }
+
+
+async def run(args):
+    sizes = [int(s) for s in args.sizes.split(",")]
+    os.makedirs(args.data_dir, exist_ok=True)
+    results = []
+    for size in sizes:
+        source = os.path.join(args.data_dir, f"bench_{size}_s{args.seed}.sqlite3")
+        if not os.path.exists(source) or args.regenerate:
+            generate(source, size, seed=args.seed)
+        # Yozuvchi benchmarklar asl bazani o'zgartirmasligi uchun nusxada ishlanadi
+        workdir = tempfile.mkdtemp(prefix="bot-bench-")
+        path = os.path.join(workdir, "bench.sqlite3")
+        shutil.copy(source, path)
+        print(f"\n📦 {size:,} foydalanuvchi")
+        try:
+            results += await bench_size(path, size, args.repeat, args.only)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print("\n" + _table(results, sizes))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"meta": _meta(), "results": results}, f, indent=2, ensure_ascii=False)
+        print(f"\n💾 {args.json}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="database.py funksiyalari uchun mikrobenchmark")
+    parser.add_argument("--sizes", default="10000,100000", help="vergul bilan: foydalanuvchilar soni")
+    parser.add_argument("--repeat", type=int, default=200, help="yengil so'rovlar uchun takrorlar")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "bot-bench-data"))
+    parser.add_argument("--regenerate", action="store_true", help="keshlangan bazalarni qayta yaratish")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--only", action="append", help="faqat nomida shu qism bor holatlar")
+    parser.add_argument("--json", help="natijalarni JSON faylga yozish")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run(parse_args()))
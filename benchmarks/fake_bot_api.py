@@ -0,0 +1,122 @@
+import asyncio
+import itertools
+import random
+import time
+from collections import Counter, defaultdict, deque
+
+from aiohttp import web
+
+# Bot API o'rnini bosuvchi lokal server: har bir metod chaqiruvini sanaydi,
+# sun'iy kechikish qo'shadi va kerak bo'lsa 429 (Too Many Requests) qaytaradi.
+# Bot unga TELEGRAM_API_URL orqali ulanadi. Polling rejimi uchun getUpdates ham bor:
+# push_update() bilan qo'shilgan update'lar offset tasdiqlanguncha saqlanadi.
+
+
+class FakeBotApi:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, rate_429: float = 0.0, retry_after: int = 1):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.injected_429 = 0
+        self.notifications = 0
+        self.webhook_set = asyncio.Event()
+        self.polling = asyncio.Event()
+        self.updates = deque()
+        self._update_arrived = asyncio.Event()
+        # (user_id, callbackmi) -> [(yuborilgan vaqt, turi), ...]: birinchi javob kelganda kechikish hisoblanadi.
+        # Callback'ga javob answerCallbackQuery, xabarga - sendMessage/sendDocument.
+        self.pending = defaultdict(deque)
+        self.latencies = defaultdict(list)
+        self._message_id = 0
+
+    def expect_reply(self, user_id: int, kind: str, callback: bool = False):
+        self.pending[(user_id, callback)].append((time.perf_counter(), kind))
+
+    def push_update(self, update: dict):
+        self.updates.append(update)
+        self._update_arrived.set()
+
+    async def _get_updates(self, params: dict):
+        self.polling.set()
+        offset = int(params.get("offset") or 0)
+        while self.updates and self.updates[0]["update_id"] < offset:
+            self.updates.popleft()
+        if not self.updates:
+            self._update_arrived.clear()
+            try:
+                await asyncio.wait_for(self._update_arrived.wait(), float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(self.updates, int(params.get("limit") or 100)))
+
+    def outstanding(self) -> int:
+        return sum(len(q) for q in self.pending.values())
+
+    def _replied(self, user_id: int, callback: bool = False):
+        queue = self.pending.get((user_id, callback))
+        if queue:
+            sent_at, kind = queue.popleft()
+            self.latencies[kind].append(time.perf_counter() - sent_at)
+
+    def _message(self, chat_id, text=None):
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "text": text or "",
+        }
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.random() * self.jitter)
+        if self.rate_429 and method.startswith(("send", "edit")) and random.random() < self.rate_429:
+            self.injected_429 += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            })
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self._get_updates(params)})
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+    def _result(self, method: str, params: dict):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "benchbot"}
+        if method == "setWebhook":
+            self.webhook_set.set()
+            return True
+        if method == "getChatMember":
+            user = {"id": int(params["user_id"]), "is_bot": False, "first_name": "u"}
+            return {"status": "member", "user": user}
+        if method == "answerCallbackQuery":
+            # Harness callback id'ni "user_id:n" ko'rinishida yuboradi
+            self._replied(int(params["callback_query_id"].split(":")[0]), callback=True)
+            return True
+        if method in ("sendMessage", "editMessageText", "sendDocument"):
+            text = params.get("text", "")
+            if "yangi referral" in text:
+                # Outbox'dan kelgan bildirishnoma - foydalanuvchi so'roviga javob emas
+                self.notifications += 1
+            elif method != "editMessageText":
+                self._replied(int(params["chat_id"]))
+            return self._message(params["chat_id"], text)
+        return True
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    async def start(self, host: str, port: int) -> web.AppRunner:
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
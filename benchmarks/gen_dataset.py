@@ -0,0 +1,142 @@
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import migrations  # noqa: E402
+
+# Katta sintetik baza: bot sxemasi migratsiyalar orqali yaratiladi, foydalanuvchilar, referrallar,
+# kanallar va a'zoliklar partiyalab (executemany) yoziladi. Referrallar "preferential attachment"
+# bilan taqsimlanadi: ko'p taklif qilganlar yana ko'proq taklif oladi (power-law, bir nechta "yulduz").
+#
+#   python benchmarks/gen_dataset.py /tmp/bench_1m.sqlite3 --users 1000000
+
+BASE_USER_ID = 100_000_000
+BATCH = 50_000
+TRIGGERS = ("trg_users_insert", "trg_users_registered", "trg_referrals_insert",
+            "trg_channels_insert", "trg_channels_delete")
+INDEXES = ("idx_users_refs", "idx_users_phone", "idx_referrals_ref_id")
+
+
+def _batches(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def generate(path: str, users: int, registered_share: float = 0.8, referral_share: float = 0.6,
+             channels: int = 3, membership_share: float = 0.3, days: int = 60,
+             weights=(1, 1), seed: int = 1):
+    rng = random.Random(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    started = time.perf_counter()
+
+    ids = [BASE_USER_ID + i for i in range(users)]
+    now = int(time.time())
+    first = now - days * 86400
+    created = sorted(rng.randrange(first, now) for _ in range(users))
+    registered_at = [None] * users
+    referrer = [None] * users
+    refs = [0] * users
+    # Har bir ro'yxatdan o'tgan foydalanuvchi bitta "chipta"ga ega, har bir olgan referrali uchun yana bittadan
+    tickets = []
+    for i in range(users):
+        if rng.random() >= registered_share:
+            continue
+        registered_at[i] = min(now, created[i] + rng.randrange(5, 600))
+        if tickets and rng.random() < referral_share:
+            ref = rng.choice(tickets)
+            referrer[i] = ref
+            tickets.append(ref)
+            # Zanjir bo'ylab ball: to'g'ridan-to'g'ri referrer weights[0], uning referreri weights[1] ...
+            level, node = 0, ref
+            while node is not None and level < len(weights):
+                refs[node] += weights[level]
+                node = referrer[node]
+                level += 1
+        tickets.append(i)
+
+    conn = sqlite3.connect(path, isolation_level=None)
+    migrations.migrate(conn)
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("BEGIN")
+    # Triggerlar hisoblagichlarni hozirgi soatga yozadi; yuklashdan keyin ular qayta hisoblanadi
+    for name in TRIGGERS:
+        conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+    for name in INDEXES:
+        conn.execute(f"DROP INDEX IF EXISTS {name}")
+
+    for batch in _batches(
+        (ids[i], f"user{i}" if rng.random() < 0.6 else None,
+         f"+998{900000000 + i}" if registered_at[i] else None,
+         refs[i], created[i], registered_at[i])
+        for i in range(users)
+    ):
+        conn.executemany(
+            "INSERT INTO users (user_id, username, phone, refs, created_at, registered_at) VALUES (?,?,?,?,?,?)",
+            batch
+        )
+    for batch in _batches(
+        (ids[i], ids[referrer[i]], registered_at[i]) for i in range(users) if referrer[i] is not None
+    ):
+        conn.executemany("INSERT INTO referrals (user_id, ref_id, created_at) VALUES (?,?,?)", batch)
+
+    channel_names = [f"@channel_{k}" for k in range(channels)]
+    conn.executemany("INSERT INTO channels (username) VALUES (?)", [(c,) for c in channel_names])
+    for batch in _batches(
+        (ids[i], channel, "member" if rng.random() < 0.95 else "left", registered_at[i])
+        for i in range(users) if registered_at[i] and rng.random() < membership_share
+        for channel in channel_names
+    ):
+        conn.executemany(
+            "INSERT INTO memberships (user_id, channel, status, updated_at) VALUES (?,?,?,?)", batch
+        )
+
+    conn.execute("DELETE FROM counter_buckets")
+    migrations._hot_query_indexes(conn)
+    migrations._counters(conn)
+    conn.execute("COMMIT")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA optimize")
+    conn.close()
+
+    linked = sum(1 for r in referrer if r is not None)
+    print(
+        f"✅ {path}: {users} foydalanuvchi, {sum(1 for r in registered_at if r)} ro'yxatdan o'tgan, "
+        f"{linked} referral, eng ko'p ball {max(refs, default=0)} ({time.perf_counter() - started:.1f} s)"
+    )
+    return path
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Bot bazasi uchun sintetik ma'lumotlar")
+    parser.add_argument("path")
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--registered-share", type=float, default=0.8)
+    parser.add_argument("--referral-share", type=float, default=0.6, help="referral orqali kelgan ro'yxatdagilar ulushi")
+    parser.add_argument("--channels", type=int, default=3)
+    parser.add_argument("--membership-share", type=float, default=0.3, help="a'zolik indeksida bor foydalanuvchilar ulushi")
+    parser.add_argument("--days", type=int, default=60, help="created_at shuncha kunga yoyiladi")
+    parser.add_argument("--weights", default=os.getenv("REFERRAL_WEIGHTS", "1,1"))
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    generate(
+        args.path, args.users, args.registered_share, args.referral_share, args.channels,
+        args.membership_share, args.days, tuple(int(w) for w in args.weights.split(",")), args.seed,
+    )
@@ -0,0 +1,328 @@
+import argparse
+import asyncio
+import os
+import random
+import re
+import signal
+import socket
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import aiohttp
+
+from fake_bot_api import FakeBotApi
+
+# End-to-end yuklama testi: main.py alohida jarayon sifatida (main() orqali, webhook yoki polling
+# rejimida) soxta Bot API serverga ulangan holda ishga tushiriladi, so'ng unga sintetik update'lar
+# berilgan tezlikda yuboriladi (webhook'ga POST yoki getUpdates navbatiga). Natijada update/s va
+# har bir ssenariy uchun javob kechikishi (update yuborilgandan Bot API'ga birinchi javob kelguncha)
+# foizlarda chiqariladi.
+#
+#   python benchmarks/loadtest.py --rate 200 --duration 30 --latency 0.05 --rate-429 0.01
+#   python benchmarks/loadtest.py --env UPDATE_QUEUE_WORKERS=8 --env TELEGRAM_GLOBAL_RATE=1000
+#   python benchmarks/loadtest.py --mode polling --backlog 5000   # uzilishdan keyingi backlog
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = "123456:BENCHMARK"
+ADMIN_ID = 1
+CALLBACKS = ("get_ref", "my_refs", "top_refs", "help")
+ADMIN_COMMANDS = ("/stats", "/channels", "/stats hours 6")
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Traffic:
+    # Sintetik foydalanuvchilar: /start (ba'zan referral bilan) -> kontakt -> "Menyu" -> callback'lar
+    def __init__(self, api: FakeBotApi, callbacks_per_user: int, referral_share: float, think: float):
+        self.api = api
+        self.callbacks_per_user = callbacks_per_user
+        self.referral_share = referral_share
+        self.think = think
+        self.update_id = 0
+        self.next_user = 10_000_000
+        # Kechikishlar jadvalida ssenariy nomi oldidan qo'shiladi (masalan, backlog uchun)
+        self.tag = ""
+        self.registered = []
+        # user_id -> (qolgan qadamlar, keyingi qadam vaqti)
+        self.active = {}
+
+    def _base(self, user_id: int):
+        self.update_id += 1
+        return {"update_id": self.update_id}, {"id": user_id, "is_bot": False, "first_name": "u", "username": f"u{user_id}"}
+
+    def message(self, user_id: int, kind: str, text: str = None, contact: dict = None):
+        update, user = self._base(user_id)
+        message = {
+            "message_id": self.update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user,
+        }
+        if text is not None:
+            message["text"] = text
+        if contact is not None:
+            message["contact"] = contact
+        update["message"] = message
+        self.api.expect_reply(user_id, self.tag + kind)
+        return update
+
+    def callback(self, user_id: int, data: str):
+        update, user = self._base(user_id)
+        update["callback_query"] = {
+            "id": f"{user_id}:{self.update_id}",
+            "from": user,
+            "chat_instance": "bench",
+            "data": data,
+            "message": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "menu",
+            },
+        }
+        self.api.expect_reply(user_id, f"{self.tag}callback:{data}", callback=True)
+        return update
+
+    def _script(self, user_id: int):
+        payload = ""
+        if self.registered and random.random() < self.referral_share:
+            payload = f" {random.choice(self.registered)}"
+        steps = [
+            lambda: self.message(user_id, "start", f"/start{payload}"),
+            lambda: self.message(user_id, "contact", contact={
+                "phone_number": f"+998{user_id}", "first_name": "u", "user_id": user_id,
+            }),
+            lambda: self.message(user_id, "menu", "Menyu"),
+        ]
+        for _ in range(self.callbacks_per_user):
+            data = random.choice(CALLBACKS)
+            steps.append(lambda data=data: self.callback(user_id, data))
+        return steps
+
+    def next(self, concurrent_users: int):
+        now = time.monotonic()
+        if len(self.active) < concurrent_users:
+            self.next_user += 1
+            self.active[self.next_user] = (self._script(self.next_user), now)
+        ready = [uid for uid, (_, at) in self.active.items() if at <= now]
+        if not ready:
+            return None
+        user_id = random.choice(ready)
+        steps, _ = self.active[user_id]
+        update = steps.pop(0)()
+        if "contact" in update.get("message", {}):
+            self.registered.append(user_id)
+        if steps:
+            self.active[user_id] = (steps, now + self.think)
+        else:
+            del self.active[user_id]
+        return update
+
+    def admin(self):
+        return self.message(ADMIN_ID, "admin", random.choice(ADMIN_COMMANDS))
+
+
+async def _wait_port(port: int, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"Bot {port}-portda ishga tushmadi")
+
+
+def _handler_report(text: str):
+    # /metrics dagi bot_handler_seconds gistogrammasidan handler bo'yicha taxminiy foizlar
+    buckets = defaultdict(list)
+    counts = {}
+    for line in text.splitlines():
+        m = re.match(r'bot_handler_seconds_bucket\{handler="([^"]+)",le="([^"]+)"\} (\S+)', line)
+        if m:
+            le = float("inf") if m.group(2) == "+Inf" else float(m.group(2))
+            buckets[m.group(1)].append((le, float(m.group(3))))
+        m = re.match(r'bot_handler_seconds_count\{handler="([^"]+)"\} (\S+)', line)
+        if m:
+            counts[m.group(1)] = int(float(m.group(2)))
+    rows = []
+    for name, series in sorted(buckets.items()):
+        total = counts.get(name, 0)
+
+        def quantile(q):
+            for le, cumulative in series:
+                if cumulative >= q * total:
+                    return le
+            return float("inf")
+        rows.append((name, total, quantile(0.5), quantile(0.95), quantile(0.99)))
+    return rows
+
+
+async def run(args):
+    api = FakeBotApi(args.latency, args.jitter, args.rate_429, args.retry_after)
+    api_port, bot_port = _free_port(), _free_port()
+    api_runner = await api.start("127.0.0.1", api_port)
+
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    env = dict(os.environ)
+    env.update({
+        "API_TOKEN": TOKEN,
+        "ADMIN_ID": str(ADMIN_ID),
+        "BOT_USERNAME": "benchbot",
+        "RENDER_EXTERNAL_HOSTNAME": "bench.local",
+        "PORT": str(bot_port),
+        "DB_PATH": os.path.join(workdir, "bench.sqlite3"),
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{api_port}",
+        "DEDUP_PERSIST": "0",
+        "BOT_MODE": args.mode,
+    })
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    traffic = Traffic(api, args.callbacks, args.referral_share, args.think)
+    if args.backlog:
+        # Bot o'chiq paytda to'plangan update'lar: foydalanuvchi qadamlari pauzasiz ketma-ket
+        traffic.tag, traffic.think = "backlog ", 0
+        for _ in range(args.backlog):
+            update = traffic.next(args.users)
+            if update is not None:
+                api.push_update(update)
+        traffic.tag, traffic.think = "", args.think
+    log_path = os.path.join(workdir, "bot.log")
+    with open(log_path, "wb") as log:
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.join(ROOT, "main.py"),
+            cwd=workdir, env=env, stdout=log, stderr=asyncio.subprocess.STDOUT,
+        )
+    try:
+        await _wait_port(bot_port, 30)
+        await asyncio.wait_for((api.polling if args.mode == "polling" else api.webhook_set).wait(), 30)
+        url = f"http://127.0.0.1:{bot_port}/{TOKEN}"
+        backlog_seconds = None
+        if args.backlog:
+            backlog_started = time.perf_counter()
+            deadline = time.monotonic() + args.drain
+            while api.outstanding() and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+            backlog_seconds = time.perf_counter() - backlog_started
+
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.connections)) as http:
+            statuses = defaultdict(int)
+
+            async def post(update):
+                if args.mode == "polling":
+                    api.push_update(update)
+                    statuses["getUpdates"] += 1
+                    return
+                try:
+                    async with http.post(url, json=update) as resp:
+                        statuses[resp.status] += 1
+                except aiohttp.ClientError as e:
+                    statuses[type(e).__name__] += 1
+
+            if args.channel:
+                await post(traffic.message(ADMIN_ID, "admin", f"/addchannel {args.channel}"))
+
+            tasks = set()
+            sent = 0
+            interval = 1 / args.rate
+            started = time.perf_counter()
+            next_at = started
+            while time.perf_counter() - started < args.duration:
+                now = time.perf_counter()
+                if now < next_at:
+                    await asyncio.sleep(next_at - now)
+                next_at += interval
+                if args.admin_every and sent and sent % args.admin_every == 0:
+                    update = traffic.admin()
+                else:
+                    update = traffic.next(args.users)
+                if update is None:
+                    continue
+                task = asyncio.create_task(post(update))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                sent += 1
+            if tasks:
+                await asyncio.gather(*tasks)
+            elapsed = time.perf_counter() - started
+
+            # Qolgan javoblarni kutamiz
+            deadline = time.monotonic() + args.drain
+            while api.outstanding() and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+            total = time.perf_counter() - started
+            async with http.get(f"http://127.0.0.1:{bot_port}/metrics") as resp:
+                metrics_text = await resp.text() if resp.status == 200 else ""
+    finally:
+        if proc.returncode is None:
+            proc.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(proc.wait(), 30)
+            except asyncio.TimeoutError:
+                proc.kill()
+        await api_runner.cleanup()
+
+    replied = sum(len(v) for v in api.latencies.values())
+    print(f"\nYuborildi: {sent} update, {elapsed:.1f} s ({sent / elapsed:.1f} update/s)")
+    print(f"Javob olindi: {replied} ({replied / total:.1f}/s), javobsiz qoldi: {api.outstanding()}")
+    if backlog_seconds is not None:
+        print(f"Backlog: {args.backlog} update {backlog_seconds:.1f} s da ishlandi "
+              f"({args.backlog / backlog_seconds:.1f} update/s)")
+    print(f"{'Webhook javoblari' if args.mode == 'webhook' else 'getUpdates navbatiga'}: {dict(statuses)}")
+    print(f"Bot API chaqiruvlari: {dict(api.calls.most_common())}")
+    print(f"Kiritilgan 429: {api.injected_429}, referral bildirishnomalari: {api.notifications}")
+    print(f"\n{'ssenariy':<22}{'soni':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for kind, values in sorted(api.latencies.items()):
+        print(
+            f"{kind:<22}{len(values):>7}"
+            f"{_percentile(values, 0.5) * 1000:>10.1f}{_percentile(values, 0.95) * 1000:>10.1f}"
+            f"{_percentile(values, 0.99) * 1000:>10.1f}{max(values) * 1000:>10.1f}"
+        )
+    rows = _handler_report(metrics_text)
+    if rows:
+        print(f"\n{'handler (/metrics)':<30}{'soni':>7}{'p50 <=':>10}{'p95 <=':>10}{'p99 <=':>10}")
+        for name, count, p50, p95, p99 in rows:
+            print(f"{name:<30}{count:>7}{p50 * 1000:>10g}{p95 * 1000:>10g}{p99 * 1000:>10g}")
+    print(f"\nBot logi: {log_path}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Referral bot uchun end-to-end yuklama testi")
+    parser.add_argument("--mode", choices=("webhook", "polling"), default="webhook", help="bot rejimi (BOT_MODE)")
+    parser.add_argument("--backlog", type=int, default=0,
+                        help="polling: bot ishga tushishidan oldin navbatda turgan update'lar")
+    parser.add_argument("--rate", type=float, default=100, help="update/s")
+    parser.add_argument("--duration", type=float, default=20, help="yuklama davomiyligi, s")
+    parser.add_argument("--users", type=int, default=200, help="bir vaqtdagi faol foydalanuvchilar")
+    parser.add_argument("--callbacks", type=int, default=4, help="har bir foydalanuvchi bosadigan menyu tugmalari")
+    parser.add_argument("--referral-share", type=float, default=0.7, help="referral link bilan kelganlar ulushi")
+    parser.add_argument("--think", type=float, default=1.0, help="bir foydalanuvchi qadamlari orasidagi pauza, s")
+    parser.add_argument("--admin-every", type=int, default=500, help="har N-update admin buyrug'i (0 - yo'q)")
+    parser.add_argument("--channel", default="@bench_channel", help="majburiy kanal ('' - kanalsiz)")
+    parser.add_argument("--latency", type=float, default=0.03, help="Bot API kechikishi, s")
+    parser.add_argument("--jitter", type=float, default=0.02, help="kechikishga qo'shiladigan tasodifiy qism, s")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="send*/edit* so'rovlarida 429 ehtimoli")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--connections", type=int, default=100, help="webhook'ga parallel ulanishlar")
+    parser.add_argument("--drain", type=float, default=30, help="oxirgi javoblarni kutish, s")
+    parser.add_argument("--env", action="append", default=[], help="bot uchun KEY=VALUE (takrorlanadi)")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import os
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+import database as db
+from ratelimit import TokenBucket
+from telegram_session import use_bulk_priority
+
+# Broadcast ulushi: jarayon limiti (TELEGRAM_GLOBAL_RATE / BOT_WORKERS) ichida javoblarga joy qoldiriladi
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 20))
+# Progress har bir sahifadan keyin bazaga yoziladi; qayta ishga tushganda shu joydan davom etadi
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", 500))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", 5))
+BROADCAST_MAX_RETRIES = 3
+
+SENT, FAILED, BLOCKED = range(3)
+
+# Shu jarayonda ketayotganlar: broadcast_id -> asyncio.Task. Umumiy holat broadcasts jadvalida:
+# /stopbroadcast boshqa jarayonga tushsa ham status 'cancelled' bo'ladi va _run uni keyingi sahifada ko'radi.
+_tasks = {}
+
+
+def is_running():
+    return bool(_tasks)
+
+
+def _progress_text(sent: int, failed: int, blocked: int, done: bool = False):
+    title = "📢 Xabar yuborildi!" if done else "📢 Xabar yuborilmoqda..."
+    return (
+        f"{title}\n\n"
+        f"✅ Muvaffaqiyatli: {sent}\n"
+        f"❌ Xatolik: {failed}\n"
+        f"🚫 Botni bloklaganlar: {blocked}"
+    )
+
+
+async def _report(bot: Bot, chat_id: int, message_id: int, text: str):
+    try:
+        await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+    except TelegramBadRequest:
+        # "message is not modified" va shunga o'xshash xatolar - e'tiborsiz qoldiramiz
+        pass
+    except Exception as e:
+        logging.error(f"Broadcast progressini yangilashda xato: {e}")
+
+
+async def _send(bot: Bot, bucket: TokenBucket, user_id: int, text: str):
+    for _ in range(BROADCAST_MAX_RETRIES):
+        await bucket.acquire()
+        try:
+            await bot.send_message(user_id, text)
+            return SENT
+        except TelegramRetryAfter as e:
+            logging.warning(f"Broadcast: Telegram {e.retry_after} soniya kutishni so'radi")
+            bucket.pause(e.retry_after)
+        except TelegramForbiddenError:
+            return BLOCKED
+        except Exception as e:
+            logging.error(f"Broadcast: {user_id} ga yuborishda xato: {e}")
+            return FAILED
+    return FAILED
+
+
+async def _run(bot: Bot, broadcast_id: int):
+    # Umumiy limiterda broadcast foydalanuvchi javoblaridan keyin navbat oladi
+    use_bulk_priority()
+    _, text, admin_chat_id, message_id, last_user_id, sent, failed, blocked, _ = await db.get_broadcast(broadcast_id)
+    bucket = TokenBucket(BROADCAST_RATE)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    last_report = time.monotonic()
+
+    async def send_one(user_id: int):
+        async with semaphore:
+            return await _send(bot, bucket, user_id, text)
+
+    try:
+        while True:
+            if (await db.get_broadcast(broadcast_id))[-1] != 'running':
+                logging.info(f"📢 Broadcast #{broadcast_id} bekor qilindi (oxirgi user_id: {last_user_id})")
+                return
+            batch = await db.get_broadcast_batch(last_user_id, BROADCAST_BATCH_SIZE)
+            if not batch:
+                break
+            results = await asyncio.gather(*(send_one(user_id) for user_id in batch))
+            blocked_ids = [user_id for user_id, res in zip(batch, results) if res == BLOCKED]
+            batch_sent = results.count(SENT)
+            batch_failed = results.count(FAILED)
+            last_user_id = batch[-1]
+            await db.save_broadcast_progress(broadcast_id, last_user_id, batch_sent, batch_failed, blocked_ids)
+            sent += batch_sent
+            failed += batch_failed
+            blocked += len(blocked_ids)
+
+            if message_id and time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+                last_report = time.monotonic()
+                await _report(bot, admin_chat_id, message_id, _progress_text(sent, failed, blocked))
+
+        await db.finish_broadcast(broadcast_id)
+        logging.info(f"📢 Broadcast #{broadcast_id} tugadi: {sent} yuborildi, {failed} xato, {blocked} bloklangan")
+        if message_id:
+            await _report(bot, admin_chat_id, message_id, _progress_text(sent, failed, blocked, done=True))
+    except asyncio.CancelledError:
+        # Holat 'running' bo'lib qoladi - keyingi ishga tushishda oxirgi saqlangan sahifadan davom etadi
+        logging.info(f"📢 Broadcast #{broadcast_id} to'xtatildi (oxirgi user_id: {last_user_id})")
+        raise
+    except Exception as e:
+        logging.error(f"Broadcast #{broadcast_id} xato bilan to'xtadi: {e}")
+    finally:
+        _tasks.pop(broadcast_id, None)
+
+
+def _spawn(bot: Bot, broadcast_id: int):
+    _tasks[broadcast_id] = asyncio.create_task(_run(bot, broadcast_id))
+
+
+async def start_broadcast(bot: Bot, text: str, admin_chat_id: int):
+    # Boshqa broadcast (istalgan jarayonda) ketayotgan bo'lsa None
+    broadcast_id = await db.create_broadcast(text, admin_chat_id)
+    if broadcast_id is None:
+        return None
+    progress = await bot.send_message(admin_chat_id, _progress_text(0, 0, 0))
+    await db.set_broadcast_message(broadcast_id, progress.message_id)
+    _spawn(bot, broadcast_id)
+    return broadcast_id
+
+
+async def cancel_broadcasts():
+    # Bazada bekor qilinadi; boshqa jarayonlardagilar keyingi sahifada to'xtaydi, bu yerdagilar darhol
+    ids = await db.cancel_broadcasts()
+    await stop_broadcasts()
+    return len(ids)
+
+
+async def resume_broadcasts(bot: Bot):
+    for broadcast_id in await db.get_running_broadcasts():
+        if broadcast_id not in _tasks:
+            logging.info(f"📢 Broadcast #{broadcast_id} davom ettirilmoqda")
+            _spawn(bot, broadcast_id)
+
+
+async def stop_broadcasts():
+    tasks = list(_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,291 @@
+import logging
+import os
+import time
+from dataclasses import dataclass
+
+import storage
+from storage import REFERRAL_DEPTH, REFERRAL_EXPORT_COLUMNS, REFERRAL_WEIGHTS, USER_EXPORT_COLUMNS  # noqa: F401
+
+# Bot kodi uchun yagona kirish nuqtasi. So'rovlarning o'zi tanlangan backend'da
+# (storage_sqlite yoki storage_postgres), bu yerda esa backend'ga bog'liq bo'lmagan qism:
+# kanallar keshi, refs tinglovchilari va DbUser.
+_backend = None
+# Kanallar ro'yxati xotirada saqlanadi, add_channel/remove_channel uni yangilaydi.
+# Bir nechta jarayon bo'lsa boshqasidagi o'zgarish CHANNELS_CACHE_TTL soniyada ko'rinadi.
+CHANNELS_CACHE_TTL = float(os.getenv("CHANNELS_CACHE_TTL", 60))
+_channels = None
+_channels_loaded_at = 0.0
+# add_referral ballarni o'zgartirganda chaqiriladigan funksiyalar (masalan, leaderboard keshi).
+# Ular event loop oqimida [(user_id, yangi_refs), ...] bilan chaqiriladi.
+_refs_listeners = []
+
+
+def _store():
+    if _backend is None:
+        raise RuntimeError("Ma'lumotlar bazasi ochilmagan: avval init_db() chaqiring")
+    return _backend
+
+
+async def init_db(path: str = None):
+    global _backend
+    # Fayl yo'lini DB_PATH orqali almashtirish mumkin (test va benchmark uchun);
+    # DATABASE_URL=postgresql://... bo'lsa PostgreSQL ishlatiladi
+    backend, target = storage.select(path)
+    await backend.open(target)
+    _backend = backend
+    where = target if backend.__name__ == "storage_sqlite" else target.rsplit("@", 1)[-1]
+    logging.info(f"🗄️ Ma'lumotlar bazasi ochildi: {where}")
+
+
+async def close_db():
+    global _backend
+    if _backend is None:
+        return
+    await _backend.close()
+    _backend = None
+    invalidate_channels()
+
+
+def on_refs_changed(callback):
+    _refs_listeners.append(callback)
+    return callback
+
+
+def _notify_refs_changed(changes):
+    for callback in _refs_listeners:
+        try:
+            callback(changes)
+        except Exception as e:
+            logging.error(f"refs listener xatosi: {e}")
+
+
+# --- KANALLAR ---
+
+def _normalize_channel(username: str):
+    # Telegram username'lari katta-kichik harfni farqlamaydi: @MyChannel va @mychannel bitta kanal
+    username = username.strip().lower()
+    if not username.startswith('@'):
+        username = '@' + username
+    return username
+
+
+async def get_channels():
+    global _channels, _channels_loaded_at
+    expired = CHANNELS_CACHE_TTL and time.monotonic() - _channels_loaded_at >= CHANNELS_CACHE_TTL
+    if _channels is None or expired:
+        _channels = await _store().load_channels()
+        _channels_loaded_at = time.monotonic()
+    return list(_channels)
+
+
+def invalidate_channels():
+    global _channels
+    _channels = None
+
+
+async def add_channel(username: str):
+    added = await _store().insert_channel(_normalize_channel(username))
+    invalidate_channels()
+    return added
+
+
+async def remove_channel(username: str):
+    await _store().delete_channel(_normalize_channel(username))
+    invalidate_channels()
+
+
+# --- REFERRALLAR VA REYTING ---
+
+async def add_referral(user_id: int, ref_id: int) -> bool:
+    changes = await _store().add_referral(user_id, ref_id)
+    if changes is None:
+        return False
+    _notify_refs_changed(changes)
+    return True
+
+
+async def get_user_refs(user_id: int):
+    return await _store().get_user_refs(user_id)
+
+
+async def get_top_refs(limit=10):
+    return await _store().get_top_refs(limit)
+
+
+async def get_user_rank(refs: int):
+    return await _store().get_user_rank(refs)
+
+
+async def get_all_users():
+    return await _store().get_all_users()
+
+
+async def draw_winners(n: int, seed: int, weighted: bool = False):
+    return await _store().draw_winners(n, seed, weighted)
+
+
+# --- STATISTIKA ---
+
+async def get_stats():
+    counters = await _store().get_counters()
+    return (counters.get('users', 0), counters.get('registered', 0),
+            counters.get('referrals', 0), counters.get('channels', 0))
+
+
+async def get_counter_totals(windows):
+    # windows: soniyalar ro'yxati (masalan, [3600, 86400]) -> {name: [har bir oyna uchun yig'indi]}
+    now = int(time.time())
+    start = (now - max(windows)) // 3600 * 3600
+    result = {}
+    for name, bucket, value in await _store().get_counter_buckets(start):
+        sums = result.setdefault(name, [0] * len(windows))
+        for i, window in enumerate(windows):
+            if bucket >= (now - window) // 3600 * 3600:
+                sums[i] += value
+    return result
+
+
+async def get_counter_series(name: str, bucket_seconds: int, count: int):
+    # Soatlik qatorlarni bucket_seconds (3600 - soat, 86400 - kun) bo'yicha guruhlaydi, oxirgi `count` ta
+    now = int(time.time())
+    start = (now // bucket_seconds - count + 1) * bucket_seconds
+    rows = await _store().sum_counter_buckets(name, bucket_seconds, start)
+    return [(start + i * bucket_seconds, rows.get(start + i * bucket_seconds, 0)) for i in range(count)]
+
+
+# --- A'ZOLIK INDEKSI VA HOLAT ---
+
+async def get_memberships(user_id: int, channels):
+    return await _store().get_memberships(user_id, channels)
+
+
+async def upsert_memberships(rows):
+    return await _store().upsert_memberships(rows)
+
+
+async def get_state(key: str, default=None):
+    return await _store().get_state(key, default)
+
+
+async def set_state(key: str, value):
+    await _store().set_state(key, value)
+
+
+# --- EKSPORT ---
+# Generatorlar sinxron: ularni asyncio.to_thread ichida iste'mol qilish kerak.
+
+def stream_users(registered_only: bool = False, min_refs: int = 0):
+    return _store().stream_users(registered_only, min_refs)
+
+
+def stream_referrals():
+    return _store().stream_referrals()
+
+
+# --- REFERRAL GRAFI ---
+
+async def get_duplicate_phones(limit: int = 100):
+    # -> [(telefon, [user_id, ...]), ...], eng ko'p takrorlanganlari birinchi
+    return await _store().duplicate_phones(limit)
+
+
+async def repair_refs(rows):
+    # rows: (user_id, o'qilgan_refs, to'g'ri_refs). O'qilgandan beri o'zgarganlar o'tkazib yuboriladi.
+    changes = await _store().set_refs(rows)
+    if changes:
+        _notify_refs_changed(changes)
+    return changes
+
+
+# --- BROADCAST ---
+
+async def create_broadcast(text: str, admin_chat_id: int):
+    # Boshqa broadcast ketayotgan bo'lsa None
+    return await _store().create_broadcast(text, admin_chat_id)
+
+
+async def set_broadcast_message(broadcast_id: int, message_id: int):
+    await _store().set_broadcast_message(broadcast_id, message_id)
+
+
+async def get_broadcast(broadcast_id: int):
+    return await _store().get_broadcast(broadcast_id)
+
+
+async def get_running_broadcasts():
+    return await _store().get_running_broadcasts()
+
+
+async def get_broadcast_batch(after_user_id: int, limit: int):
+    return await _store().get_broadcast_batch(after_user_id, limit)
+
+
+async def save_broadcast_progress(broadcast_id: int, last_user_id: int, sent: int, failed: int, blocked_ids):
+    await _store().save_broadcast_progress(broadcast_id, last_user_id, sent, failed, blocked_ids)
+
+
+async def finish_broadcast(broadcast_id: int):
+    await _store().finish_broadcast(broadcast_id)
+
+
+async def cancel_broadcasts():
+    # Barcha jarayonlardagi 'running' broadcastlar bekor qilinadi -> ularning id'lari
+    return await _store().cancel_broadcasts()
+
+
+# --- OUTBOX ---
+
+async def get_due_notifications(limit: int, lease: int = 60):
+    # Olingan yozuvlar `lease` soniya boshqa jarayonlarga ko'rinmaydi
+    return await _store().claim_notifications(limit, lease)
+
+
+async def delete_notifications(ids):
+    await _store().delete_notifications(ids)
+
+
+async def retry_notifications(ids, delay: int):
+    await _store().retry_notifications(ids, delay)
+
+
+# --- FOYDALANUVCHI KONTEKSTI ---
+
+@dataclass
+class DbUser:
+    # Bitta update davomida handlerlarga uzatiladigan foydalanuvchi qatori.
+    # O'zgarishlar shu obyekt orqali yoziladi, shunda maydonlar DB bilan mos qoladi.
+    user_id: int
+    username: str = None
+    phone: str = None
+    refs: int = 0
+    pending_ref_id: int = None
+    has_referral: bool = False
+
+    async def set_pending_ref(self, ref_id: int):
+        await set_pending_ref(self.user_id, ref_id)
+        self.pending_ref_id = ref_id
+
+    async def register(self, phone: str):
+        # Telefonni saqlaydi va kutilayotgan referralni hisoblaydi; hisoblangan ref_id qaytadi
+        ref_id = await register_user(self.user_id, phone)
+        self.phone = phone
+        if ref_id:
+            self.pending_ref_id = None
+            self.has_referral = True
+        return ref_id
+
+
+async def load_user(user_id: int, username: str = None) -> DbUser:
+    # Bitta so'rov bilan yuklaydi; yo'q bo'lsa yaratadi, username o'zgargan bo'lsa yangilaydi
+    return DbUser(user_id, *await _store().load_user(user_id, username))
+
+
+async def set_pending_ref(user_id: int, ref_id: int):
+    await _store().set_pending_ref(user_id, ref_id)
+
+
+async def register_user(user_id: int, phone: str):
+    ref_id, changes = await _store().register_user(user_id, phone)
+    if changes:
+        _notify_refs_changed(changes)
+    return ref_id
@@ -0,0 +1,90 @@
+import asyncio
+import csv
+import gzip
+import json
+import logging
+import os
+import tempfile
+import time
+
+from aiogram import Bot
+from aiogram.types import FSInputFile
+
+import database as db
+
+# Fonda ishlayotgan eksportlar (handler darhol qaytadi)
+_tasks = set()
+
+
+def _write(path: str, fmt: str, columns, rows):
+    # Qatorlar generatordan o'qiladi va to'g'ridan-to'g'ri gzip faylga yoziladi - xotirada yig'ilmaydi.
+    # Xato bo'lsa ham generator shu oqimda yopiladi: aks holda uni GC event loop'da yopib, loop'ni bloklaydi.
+    count = 0
+    try:
+        with gzip.open(path, "wt", encoding="utf-8", newline="") as f:
+            if fmt == "csv":
+                writer = csv.writer(f)
+                writer.writerow(columns)
+                for row in rows:
+                    writer.writerow(row)
+                    count += 1
+            else:
+                for row in rows:
+                    f.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n")
+                    count += 1
+    finally:
+        rows.close()
+    return count
+
+
+async def _run(bot: Bot, chat_id: int, kind: str, fmt: str, registered_only: bool, min_refs: int):
+    if kind == "referrals":
+        columns, rows = db.REFERRAL_EXPORT_COLUMNS, db.stream_referrals()
+    else:
+        columns, rows = db.USER_EXPORT_COLUMNS, db.stream_users(registered_only, min_refs)
+
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}.gz")
+    os.close(fd)
+    started = time.monotonic()
+    try:
+        count = await asyncio.to_thread(_write, path, fmt, columns, rows)
+        if not count:
+            await bot.send_message(chat_id, "📋 Eksport uchun mos yozuvlar topilmadi.")
+            return
+        filename = f"{kind}_{time.strftime('%Y%m%d_%H%M%S')}.{fmt}.gz"
+        await bot.send_document(
+            chat_id,
+            FSInputFile(path, filename=filename),
+            caption=f"📦 {count} ta yozuv ({time.monotonic() - started:.1f} s)",
+            parse_mode=None,
+        )
+    except Exception as e:
+        logging.error(f"Eksportda xato ({kind}): {e}")
+        await bot.send_message(chat_id, "❌ Eksportda xatolik yuz berdi.")
+    finally:
+        os.unlink(path)
+
+
+def start_export(bot: Bot, chat_id: int, kind: str = "users", fmt: str = "csv",
+                 registered_only: bool = False, min_refs: int = 0):
+    task = asyncio.create_task(_run(bot, chat_id, kind, fmt, registered_only, min_refs))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+def parse_args(args):
+    # Masalan: ["referrals", "jsonl"] yoki ["registered", "5"] (5 - minimal ball)
+    options = {"kind": "users", "fmt": "csv", "registered_only": False, "min_refs": 0}
+    for arg in args:
+        arg = arg.lower()
+        if arg in ("users", "referrals"):
+            options["kind"] = arg
+        elif arg in ("csv", "jsonl"):
+            options["fmt"] = arg
+        elif arg == "registered":
+            options["registered_only"] = True
+        elif arg.isdigit():
+            options["min_refs"] = int(arg)
+        else:
+            return None
+    return options
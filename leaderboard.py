@@ -0,0 +1,83 @@
+import asyncio
+import os
+import time
+
+import database as db
+import metrics
+
+LEADERBOARD_SIZE = 10
+# >0 bo'lsa, ball o'zgargandan keyin ham kesh shuncha soniya eskirgan holda berilishi mumkin
+# (finallarda har bir referral uchun qayta yuklamaslik uchun)
+LEADERBOARD_STALE_SECONDS = float(os.getenv("LEADERBOARD_STALE_SECONDS", 0))
+# Boshqa jarayonlardagi ball o'zgarishlari listener orqali kelmaydi: kesh eng ko'pi shuncha soniya yashaydi
+# (0 - cheklovsiz, bitta jarayon uchun yetarli)
+LEADERBOARD_MAX_AGE = float(os.getenv("LEADERBOARD_MAX_AGE", 30))
+
+# Top-N qatorlari (user_id, username, phone, refs), refs bo'yicha kamayish tartibida
+_top = None
+_text = None
+_loaded_at = 0.0
+_dirty = False
+_lock = asyncio.Lock()
+
+
+def _expired():
+    age = time.monotonic() - _loaded_at
+    if LEADERBOARD_MAX_AGE and age >= LEADERBOARD_MAX_AGE:
+        return True
+    return _dirty and age >= LEADERBOARD_STALE_SECONDS
+
+
+def invalidate():
+    global _dirty
+    _dirty = True
+
+
+def _threshold():
+    # Top-N ga kirish uchun kerak bo'lgan eng kichik ball (ro'yxat to'lmagan bo'lsa - istalgan)
+    if len(_top) < LEADERBOARD_SIZE:
+        return None
+    return _top[-1][3]
+
+
+@db.on_refs_changed
+def _on_refs_changed(changes):
+    global _top, _text
+    if _top is None:
+        return
+    in_top = {row[0]: idx for idx, row in enumerate(_top)}
+    threshold = _threshold()
+    patched = False
+    for user_id, refs in changes:
+        if user_id in in_top:
+            # Top ichidagi foydalanuvchi - qatorni joyida yangilaymiz
+            idx = in_top[user_id]
+            uid, username, phone, _ = _top[idx]
+            _top[idx] = (uid, username, phone, refs)
+            patched = True
+        elif threshold is None or refs >= threshold:
+            # Tashqaridan kimdir topga kirishi mumkin - qayta yuklash kerak
+            invalidate()
+    if patched:
+        _top.sort(key=lambda row: row[3], reverse=True)
+        _text = None
+
+
+async def get_top(render):
+    # render: qatorlar ro'yxatidan xabar matnini yasaydigan funksiya; natija keshlanadi
+    global _top, _text, _loaded_at, _dirty
+    if _top is None or _expired():
+        async with _lock:
+            if _top is None or _expired():
+                metrics.CACHE.inc("leaderboard", "miss")
+                _dirty = False
+                _top = await db.get_top_refs(LEADERBOARD_SIZE)
+                _loaded_at = time.monotonic()
+                _text = None
+    else:
+        metrics.CACHE.inc("leaderboard", "hit")
+    if not _top:
+        return None
+    if _text is None:
+        _text = render(_top)
+    return _text
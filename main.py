@@ -1,12 +1,15 @@
 import asyncio
 import logging
 import os
+import signal
+import time
 import aiohttp
 from aiohttp import web
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.enums import ParseMode
 from aiogram.filters import Command
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.types import (
     ReplyKeyboardMarkup, KeyboardButton,
     InlineKeyboardMarkup, InlineKeyboardButton,
@@ -15,6 +18,22 @@ from aiogram.types import (
 from aiogram.exceptions import TelegramBadRequest
 from dotenv import load_dotenv
 
+import broadcast
+import database as db
+import export
+import leaderboard
+import metrics
+import notifications
+import referral_graph
+import rendering
+import tracing
+from middlewares import UserMiddleware, DedupMiddleware, ThrottlingMiddleware, HandlerMetricsMiddleware
+from telegram_session import PooledSession, RateLimitMiddleware, ApiMetricsMiddleware
+from update_queue import UpdateQueue, QueuedRequestHandler
+from polling import UpdatePoller
+import subscriptions
+from subscriptions import is_subscribed, track_chat_member, start_membership_sync, stop_membership_sync
+
 # Import the correct webhook handler for aiogram 3.x
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 
@@ -23,6 +42,9 @@ load_dotenv()
 
 # Loglashni sozlash
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Log yozuvlari alohida oqimda chiqariladi, event loop diskni/konsolni kutmaydi
+if os.getenv("LOG_QUEUE", "1") == "1":
+    tracing.start_log_queue()
 
 # Bot tokeni va admin ID'ni olish
 API_TOKEN = os.getenv("API_TOKEN")
@@ -34,186 +56,169 @@ BOT_USERNAME = os.getenv("BOT_USERNAME")
 if not BOT_USERNAME:
     logging.error("BOT_USERNAME muhit o'zgaruvchisi topilmadi. Bot username'i kerak.")
 
-# Agar RENDER_EXTERNAL_HOSTNAME mavjud bo'lmasa, u ishlamaydi
-if not WEB_APP_NAME:
+# Ishlash rejimi: "webhook" (standart) yoki "polling" - ochiq HTTPS manzilsiz serverlar uchun
+# va uzilishdan keyin to'plangan update'larni getUpdates partiyalari bilan tez olish uchun
+BOT_MODE = os.getenv("BOT_MODE", "webhook")
+POLLING_LIMIT = int(os.getenv("POLLING_LIMIT", 100))
+POLLING_TIMEOUT = int(os.getenv("POLLING_TIMEOUT", 25))
+# Polling rejimida HTTP server faqat /metrics uchun: METRICS_PATH bo'sh bo'lsa port umuman ochilmaydi,
+# aks holda standart port 8080 (root'siz ishlaydigan serverlarda 80 ni ochib bo'lmaydi)
+PORT = int(os.getenv("PORT", 80 if BOT_MODE == "webhook" else 8080))
+
+# Agar RENDER_EXTERNAL_HOSTNAME mavjud bo'lmasa, webhook ishlamaydi
+if BOT_MODE == "webhook" and not WEB_APP_NAME:
     logging.error("RENDER_EXTERNAL_HOSTNAME muhit o'zgaruvchisi topilmadi. Webhook uchun manzil kerak.")
 
+# Bir nechta jarayon (DATABASE_URL=postgresql://...) ishlaganda faqat bittasi PRIMARY_WORKER=1 bo'ladi:
+# u webhookni o'rnatadi/o'chiradi va to'xtab qolgan broadcastlarni davom ettiradi.
+PRIMARY_WORKER = os.getenv("PRIMARY_WORKER", "1") == "1"
+# Jami bot jarayonlari soni: Telegram limiti bot bo'yicha, shuning uchun har bir jarayon
+# TELEGRAM_GLOBAL_RATE ning BOT_WORKERS ga bo'lingan ulushini oladi
+BOT_WORKERS = max(1, int(os.getenv("BOT_WORKERS", 1)))
+# 1 bo'lsa jarayonlar bitta portni SO_REUSEPORT bilan bo'lishadi (yadro ulanishlarni taqsimlaydi)
+WEB_REUSE_PORT = os.getenv("WEB_REUSE_PORT", "0") == "1"
+
+# Update navbati: 0 bo'lsa webhook update'larni to'g'ridan-to'g'ri dispatcher'ga beradi.
+# Polling rejimida navbat har doim ishlatiladi (standart 32 worker, kamida 1).
+UPDATE_QUEUE_WORKERS = int(os.getenv("UPDATE_QUEUE_WORKERS", 32 if BOT_MODE == "polling" else 0))
+if BOT_MODE == "polling":
+    UPDATE_QUEUE_WORKERS = max(1, UPDATE_QUEUE_WORKERS)
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 10000))
+UPDATE_QUEUE_PUT_TIMEOUT = float(os.getenv("UPDATE_QUEUE_PUT_TIMEOUT", 5))
+
+# Telegram API ga chiqish so'rovlari: ulanishlar puli va umumiy rate limit.
+# TELEGRAM_GLOBAL_RATE - butun bot uchun (barcha jarayonlar birgalikda), jarayon ulushi pastda hisoblanadi.
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", 100))
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 30))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", 1))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", 3))
+# Lokal Bot API server (yoki benchmarks/ dagi soxta server) manzili; bo'sh bo'lsa api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
 # Bot va dispatcher'ni ishga tushirish
-bot = Bot(token=API_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN))
+session = PooledSession(limit=TELEGRAM_POOL_SIZE)
+if TELEGRAM_API_URL:
+    session.api = TelegramAPIServer.from_base(TELEGRAM_API_URL)
+rate_limiter = RateLimitMiddleware(
+    global_rate=TELEGRAM_GLOBAL_RATE / BOT_WORKERS,
+    chat_rate=TELEGRAM_CHAT_RATE,
+    max_retries=TELEGRAM_MAX_RETRIES,
+)
+session.middleware(rate_limiter)
+# Ichkarida turadi: har bir qayta urinish alohida o'lchanadi
+session.middleware(ApiMetricsMiddleware())
+bot = Bot(token=API_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN))
 dp = Dispatcher()
-
-# --- DATABASE FUNKSIYALARI ---
-import sqlite3
-
-def init_db():
-    conn = sqlite3.connect('bot_db.sqlite3')
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS channels (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            phone TEXT,
-            refs INTEGER DEFAULT 0,
-            pending_ref_id INTEGER
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS referrals (
-            user_id INTEGER UNIQUE,
-            ref_id INTEGER
-        )
-    ''')
-    conn.commit()
-    conn.close()
-
-def get_channels():
-    with sqlite3.connect('bot_db.sqlite3') as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT username FROM channels")
-        return [row[0] for row in cursor.fetchall()]
-
-def add_channel(username: str):
-    username = username.strip()
-    if not username.startswith('@'):
-        username = '@' + username
-    with sqlite3.connect('bot_db.sqlite3') as conn:
-        cursor = conn.cursor()
-        try:
-            cursor.execute("INSERT INTO channels (username) VALUES (?)", (username,))
-            conn.commit()
-            return True
-        except sqlite3.IntegrityError:
-            return False
-
-def remove_channel(username: str):
-    username = username.strip()
-    if not username.startswith('@'):
-        username = '@' + username
-    with sqlite3.connect('bot_db.sqlite3') as conn:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM channels WHERE username=?", (username,))
-        conn.commit()
-
-def user_exists(user_id: int):
-    with sqlite3.connect('bot_db.sqlite3') as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id FROM users WHERE user_id=?", (user_id,))
-        return cursor.fetchone() is not None
-
-def has_referral(user_id: int):
-    with sqlite3.connect('bot_db.sqlite3') as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1 FROM referrals WHERE user_id=?", (user_id,))
-        return cursor.fetchone() is not None
-
-def add_user(user_id: int, username: str = None):
-    if not user_exists(user_id):
-        with sqlite3.connect('bot_db.sqlite3') as conn:
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO users (user_id, username, refs) VALUES (?,?,0)", (user_id, username))
-            conn.commit()
-
-def set_user_phone(user_id: int, phone: str):
-    with sqlite3.connect('bot_db.sqlite3') as conn:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET phone=? WHERE user_id=?", (phone, user_id))
-        conn.commit()
-
-def get_user_phone(user_id: int):
-    with sqlite3.connect('bot_db.sqlite3') as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT phone FROM users WHERE user_id=?", (user_id,))
-        res = cursor.fetchone()
-        return res[0] if res else None
-
-def get_user_info(user_id: int):
-    with sqlite3.connect('bot_db.sqlite3') as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT username, phone FROM users WHERE user_id=?", (user_id,))
-        res = cursor.fetchone()
-        return res if res else (None, None)
-
-def add_referral(user_id: int, ref_id: int) -> bool:
-    with sqlite3.connect('bot_db.sqlite3') as conn:
-        cursor = conn.cursor()
-        if user_id == ref_id:
-            return False
-        cursor.execute("SELECT ref_id FROM referrals WHERE user_id=?", (user_id,))
-        if cursor.fetchone():
-            return False
-        
-        cursor.execute("INSERT INTO referrals (user_id, ref_id) VALUES (?,?)", (user_id, ref_id))
-        
-        current = ref_id
-        level = 1
-        while current and level <= 2:
-            cursor.execute("UPDATE users SET refs = refs + 1 WHERE user_id=?", (current,))
-            cursor.execute("SELECT ref_id FROM referrals WHERE user_id=?", (current,))
-            row = cursor.fetchone()
-            current = row[0] if row else None
-            level += 1
-        
-        conn.commit()
-    return True
-
-def get_user_refs(user_id: int):
-    with sqlite3.connect('bot_db.sqlite3') as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT refs FROM users WHERE user_id=?", (user_id,))
-        res = cursor.fetchone()
-        return res[0] if res else 0
-
-def get_top_refs(limit=10):
-    with sqlite3.connect('bot_db.sqlite3') as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id, username, phone, refs FROM users ORDER BY refs DESC LIMIT ?", (limit,))
-        return cursor.fetchall()
-
-def get_all_users():
-    with sqlite3.connect('bot_db.sqlite3') as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id, username, phone, refs FROM users ORDER BY user_id")
-        return cursor.fetchall()
-
-# --- END DATABASE FUNKSIYALARI ---
+update_queue = (
+    UpdateQueue(dp, bot, UPDATE_QUEUE_WORKERS, UPDATE_QUEUE_SIZE, UPDATE_QUEUE_PUT_TIMEOUT)
+    if UPDATE_QUEUE_WORKERS > 0 else None
+)
+poller = (
+    UpdatePoller(bot, update_queue, limit=POLLING_LIMIT, timeout=POLLING_TIMEOUT)
+    if BOT_MODE == "polling" else None
+)
+# Bir foydalanuvchidan juda tez kelayotgan update'lar bazaga yetmasdan tashlanadi (admin bundan mustasno).
+# Tartib muhim: throttling UserMiddleware'dan oldin ro'yxatdan o'tadi.
+THROTTLE_TTL = float(os.getenv("THROTTLE_TTL", 60))
+THROTTLE_NOTICE = "⏳ Juda tez! Iltimos, biroz kuting."
+message_throttle = ThrottlingMiddleware(
+    rate=float(os.getenv("THROTTLE_MESSAGE_RATE", 1)),
+    burst=float(os.getenv("THROTTLE_MESSAGE_BURST", 5)),
+    ttl=THROTTLE_TTL, exempt={ADMIN_ID}, notice=THROTTLE_NOTICE,
+)
+callback_throttle = ThrottlingMiddleware(
+    rate=float(os.getenv("THROTTLE_CALLBACK_RATE", 2)),
+    burst=float(os.getenv("THROTTLE_CALLBACK_BURST", 6)),
+    ttl=THROTTLE_TTL, exempt={ADMIN_ID}, notice=THROTTLE_NOTICE,
+)
+dp.message.outer_middleware(message_throttle)
+dp.callback_query.outer_middleware(callback_throttle)
+# Har bir update uchun foydalanuvchi qatori bitta so'rov bilan yuklanadi
+dp.message.outer_middleware(UserMiddleware())
+dp.callback_query.outer_middleware(UserMiddleware())
+# TRACE_SLOW_MS berilsa, shundan sekin ishlangan update'lar DB/API span'lari bilan JSON qilib loglanadi
+TRACE_SLOW_MS = os.getenv("TRACE_SLOW_MS")
+if TRACE_SLOW_MS:
+    dp.update.outer_middleware(tracing.TracingMiddleware(float(TRACE_SLOW_MS)))
+# Qayta yuborilgan update'lar (update_id bo'yicha) dispatcher'ga yetmasdan tashlanadi.
+# Cheklov: bir nechta jarayonda har birining oynasi o'ziniki, shuning uchun boshqa jarayonga tushgan
+# qayta yuborish tashlanmaydi. Umumiy last_update_id ni jarayonlar bir-birining ustidan yozmasligi
+# uchun uni faqat PRIMARY_WORKER saqlaydi va tiklaydi.
+dedup = DedupMiddleware(
+    window=int(os.getenv("DEDUP_WINDOW", 100000)),
+    persist=os.getenv("DEDUP_PERSIST", "1") == "1" and PRIMARY_WORKER,
+)
+dp.update.outer_middleware(dedup)
+# Handler nomi bo'yicha soni va vaqti (/metrics)
+for observer in (dp.message, dp.callback_query, dp.chat_member):
+    observer.middleware(HandlerMetricsMiddleware())
+
+# /metrics: navbatlar va keshlar holati so'rov paytida o'qiladi
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+metrics.Gauge("bot_update_queue_size", "Ishlanishini kutayotgan update'lar",
+              lambda: update_queue.qsize() if update_queue else 0)
+metrics.Gauge("bot_telegram_limiter_waiting", "Umumiy rate limiterda navbat kutayotgan so'rovlar",
+              lambda: rate_limiter.global_bucket.waiting())
+metrics.Gauge("bot_subscriptions", "Obuna keshi hajmi va yozilmagan chat_member hodisalari",
+              subscriptions.stats, label="kind")
+metrics.Gauge("bot_broadcast_running", "Shu jarayonda broadcast ketyaptimi", lambda: int(broadcast.is_running()))
+metrics.Gauge("bot_dropped_updates_total", "Dispatcher'gacha tashlangan update'lar",
+              lambda: {"duplicate": dedup.dropped, "throttled_message": message_throttle.dropped,
+                       "throttled_callback": callback_throttle.dropped},
+              label="reason", kind="counter")
 
 # --- YORDAMCHI FUNKSIYALAR ---
-import random
-
-async def is_subscribed(bot: Bot, user_id: int):
-    channels = get_channels()
-    if not channels:
-        return True
-    for ch in channels:
-        try:
-            member = await bot.get_chat_member(ch, user_id)
-            if member.status in ['left', 'kicked']:
-                return False
-        except Exception as e:
-            logging.error(f"Error checking subscription for {ch}: {e}")
-            return False
-    return True
+import secrets
+
+# Statik klaviaturalar va matnlar bir marta yaratiladi
+MAIN_MENU_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔗 Referral link", callback_data="get_ref"),
+     InlineKeyboardButton(text="📊 Statistikam", callback_data="my_refs")],
+    [InlineKeyboardButton(text="🏆 Top 10", callback_data="top_refs"),
+     InlineKeyboardButton(text="ℹ️ Yordam", callback_data="help")]
+])
+
+MENU_TRIGGER_KEYBOARD = ReplyKeyboardMarkup(resize_keyboard=True, keyboard=[
+    [KeyboardButton(text="Menyu")]
+])
+
+MAIN_MENU_TEXT = "🚀 *Asosiy menyu:*"
+
+# Ball qoidalari REFERRAL_WEIGHTS dan olinadi: chuqurlik yoki ballar o'zgarsa matnlar ham o'zgaradi
+_LEVEL_NAMES = ("To'g'ridan-to'g'ri", "Ikkinchi darajadagi", "Uchinchi darajadagi",
+                "To'rtinchi darajadagi", "Beshinchi darajadagi")
+SCORING_LINES = [
+    f"{_LEVEL_NAMES[level] if level < len(_LEVEL_NAMES) else f'{level + 1}-darajadagi'} taklif: +{weight} ball"
+    for level, weight in enumerate(db.REFERRAL_WEIGHTS) if weight
+]
+
+def scoring_text(bullet: str):
+    return "".join(f"{bullet}{line}\n" for line in SCORING_LINES)
+
+HELP_TEXT = (
+    "ℹ️ *Yordam bo'limi*\n\n"
+    "Bu bot orqali do'stlaringizni taklif qilib ball to'plashingiz mumkin! 😎\n\n"
+    "🔍 *Bot qanday ishlaydi?*\n\n"
+    "1️⃣ *Ro'yxatdan o'tish:*\n"
+    "   • /start buyrug'ini bosing\n"
+    "   • Kanal va guruhlarga obuna bo'ling\n"
+    "   • Telefon raqamingizni yuboring\n\n"
+    "2️⃣ *Referral tizimi:*\n"
+    "   • Sizning maxsus linkingizni oling\n"
+    "   • Do'stlaringizga ulashing\n"
+    "   • Ular ro'yxatdan o'tganda ball oling\n\n"
+    "3️⃣ *Ball tizimi:*\n"
+    f"{scoring_text('   • ')}\n"
+    "🎯 *Maqsad:* Ko'proq ball to'plang va top reytingda bo'ling!\n\n"
+    "📞 *Yordam kerakmi?* Admin: @murojat_adm\n\n"
+    "🚀 *Muvaffaqiyatlar tilaymiz!*"
+)
 
 def get_main_menu_keyboard():
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔗 Referral link", callback_data="get_ref"),
-         InlineKeyboardButton(text="📊 Statistikam", callback_data="my_refs")],
-        [InlineKeyboardButton(text="🏆 Top 10", callback_data="top_refs"),
-         InlineKeyboardButton(text="ℹ️ Yordam", callback_data="help")]
-    ])
-    return kb
+    return MAIN_MENU_KEYBOARD
 
 def get_menu_trigger_keyboard():
-    kb = ReplyKeyboardMarkup(resize_keyboard=True, keyboard=[
-        [KeyboardButton(text="Menyu")]
-    ])
-    return kb
+    return MENU_TRIGGER_KEYBOARD
 
 def get_user_display_name(username, phone, user_id):
     if username:
@@ -226,21 +231,16 @@ def get_user_display_name(username, phone, user_id):
 # --- HANDLERS ---
 
 @dp.message(Command("start"))
-async def start_handler(message: types.Message):
+async def start_handler(message: types.Message, db_user: db.DbUser):
     user_id = message.from_user.id
     username = message.from_user.username
     args = message.text.split()[1:] if len(message.text.split()) > 1 else []
     ref_id = int(args[0]) if args and args[0].isdigit() else None
 
-    add_user(user_id, username)
+    if ref_id and ref_id != user_id and not db_user.phone and not db_user.has_referral:
+        await db_user.set_pending_ref(ref_id)
 
-    if ref_id and ref_id != user_id and not get_user_phone(user_id) and not has_referral(user_id):
-        with sqlite3.connect('bot_db.sqlite3') as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE users SET pending_ref_id = ? WHERE user_id=?", (ref_id, user_id))
-            conn.commit()
-
-    display_name = get_user_display_name(username, get_user_phone(user_id), user_id)
+    display_name = get_user_display_name(username, db_user.phone, user_id)
 
     welcome_msg = (
         "🎉 *Xush kelibsiz, {}!* 🎉\n\n"
@@ -256,7 +256,7 @@ async def start_handler(message: types.Message):
 
     subscribed = await is_subscribed(message.bot, user_id)
     if not subscribed:
-        channels = get_channels()
+        channels = await db.get_channels()
         if channels:
             kb = InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text=f"📢 {ch} ga obuna bo'lish", url=f"https://t.me/{ch.strip('@')}")]
@@ -270,7 +270,7 @@ async def start_handler(message: types.Message):
             )
         return
 
-    phone = get_user_phone(user_id)
+    phone = db_user.phone
     if not phone:
         phone_kb = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True, keyboard=[
             [KeyboardButton(text="📱 Telefon raqamni yuborish", request_contact=True)]
@@ -290,16 +290,15 @@ async def start_handler(message: types.Message):
             "📋 *Qanday ishlaydi?*\n"
             "• Do'stlaringizga linkingizni ulashing\n"
             "• Ular bot orqali ro'yxatdan o'tgach, sizga ball qo'shiladi\n"
-            "• Har bir to'g'ridan-to'g'ri taklif uchun +1 ball\n"
-            "• Ikkinchi darajadagi taklif uchun ham +1 ball\n\n"
+            f"{scoring_text('• ')}\n"
             "💰 Ko'proq ball to'plang va mukofotlarga ega bo'ling! 🏆"
         )
         await message.answer(final_msg, reply_markup=get_menu_trigger_keyboard())
 
 @dp.callback_query(F.data == 'check_sub')
-async def check_sub_handler(call: types.CallbackQuery):
+async def check_sub_handler(call: types.CallbackQuery, db_user: db.DbUser):
     user_id = call.from_user.id
-    subscribed = await is_subscribed(call.bot, user_id)
+    subscribed = await is_subscribed(call.bot, user_id, skip_negative=True)
     
     if subscribed:
         await call.answer("✅ Obuna muvaffaqiyatli tasdiqlandi!")
@@ -308,7 +307,7 @@ async def check_sub_handler(call: types.CallbackQuery):
         except Exception:
             pass
         
-        phone = get_user_phone(user_id)
+        phone = db_user.phone
         if not phone:
             phone_kb = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True, keyboard=[
                 [KeyboardButton(text="📱 Telefon raqamni yuborish", request_contact=True)]
@@ -321,8 +320,7 @@ async def check_sub_handler(call: types.CallbackQuery):
                 reply_markup=phone_kb
             )
         else:
-            username, phone = get_user_info(user_id)
-            display_name = get_user_display_name(username, phone, user_id)
+            display_name = get_user_display_name(db_user.username, phone, user_id)
             ref_link = f"https://t.me/{BOT_USERNAME}?start={user_id}"
             
             final_msg = (
@@ -336,7 +334,7 @@ async def check_sub_handler(call: types.CallbackQuery):
         await call.answer("❌ Hali barcha kanallarga obuna bo'lmadingiz! Iltimos, avval obuna bo'lib, keyin qayta urinib ko'ring.", show_alert=True)
 
 @dp.message(F.content_type == types.ContentType.CONTACT)
-async def contact_handler(message: types.Message):
+async def contact_handler(message: types.Message, db_user: db.DbUser):
     user_id = message.from_user.id
     
     if message.contact is None or message.contact.user_id != user_id:
@@ -344,7 +342,7 @@ async def contact_handler(message: types.Message):
         return
 
     phone = message.contact.phone_number
-    previous_phone = get_user_phone(user_id)
+    previous_phone = db_user.phone
 
     if not await is_subscribed(message.bot, user_id):
         await message.answer(
@@ -354,33 +352,18 @@ async def contact_handler(message: types.Message):
         )
         return
 
-    set_user_phone(user_id, phone)
+    # Telefon saqlanadi va kutilayotgan referral bitta tranzaksiyada hisoblanadi
+    ref_id = await db_user.register(phone)
 
     if previous_phone:
         await message.answer("📱 Telefon raqamingiz muvaffaqiyatli yangilandi! ✅", reply_markup=get_menu_trigger_keyboard())
         return
 
-    with sqlite3.connect('bot_db.sqlite3') as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT pending_ref_id FROM users WHERE user_id=?", (user_id,))
-        row = cursor.fetchone()
-        if row and row[0]:
-            ref_id = row[0]
-            if add_referral(user_id, ref_id):
-                cursor.execute("UPDATE users SET pending_ref_id = NULL WHERE user_id=?", (user_id,))
-                conn.commit()
-                try:
-                    await message.bot.send_message(
-                        ref_id, 
-                        "🎉 *Yangi referral!*\n\n"
-                        "Sizga yangi referral qo'shildi! Ballaringiz +1 ga oshdi! 🚀\n\n"
-                        "📊 Statistikangizni ko'rish uchun menyudan foydalaning."
-                    )
-                except Exception as e:
-                    logging.error(f"Error notifying referrer {ref_id}: {e}")
-
-    username, phone = get_user_info(user_id)
-    display_name = get_user_display_name(username, phone, user_id)
+    if ref_id:
+        # Bildirishnoma outbox'ga referral bilan birga yozilgan; dispatcher fon rejimida yuboradi
+        notifications.wake()
+
+    display_name = get_user_display_name(db_user.username, db_user.phone, user_id)
     ref_link = f"https://t.me/{BOT_USERNAME}?start={user_id}"
     
     success_msg = (
@@ -397,11 +380,8 @@ async def contact_handler(message: types.Message):
     await message.answer(success_msg, reply_markup=get_menu_trigger_keyboard())
 
 @dp.message(F.text == "Menyu")
-async def show_menu_handler(message: types.Message):
-    user_id = message.from_user.id
-    phone = get_user_phone(user_id)
-    
-    if not phone:
+async def show_menu_handler(message: types.Message, db_user: db.DbUser):
+    if not db_user.phone:
         await message.answer(
             "🚫 Siz hali ro'yxatdan o'tmadingiz!\n\n"
             "Iltimos, /start buyrug'ini bosing va ro'yxatdan o'ting. 😊",
@@ -409,21 +389,20 @@ async def show_menu_handler(message: types.Message):
         )
         return
 
-    await message.answer("🚀 *Asosiy menyu:*", reply_markup=get_main_menu_keyboard())
+    sent = await message.answer(MAIN_MENU_TEXT, reply_markup=get_main_menu_keyboard())
+    rendering.remember(sent, MAIN_MENU_TEXT, get_main_menu_keyboard())
 
 @dp.callback_query(F.data == 'get_ref')
-async def callback_get_ref_handler(call: types.CallbackQuery):
+async def callback_get_ref_handler(call: types.CallbackQuery, db_user: db.DbUser):
     user_id = call.from_user.id
-    phone = get_user_phone(user_id)
     
-    if not phone:
+    if not db_user.phone:
         await call.answer("🚫 Avval telefon raqamingizni yuboring!", show_alert=True)
         return
     
-    username, phone = get_user_info(user_id)
-    display_name = get_user_display_name(username, phone, user_id)
+    display_name = get_user_display_name(db_user.username, db_user.phone, user_id)
     ref_link = f"https://t.me/{BOT_USERNAME}?start={user_id}"
-    refs_count = get_user_refs(user_id)
+    refs_count = db_user.refs
     
     ref_msg = (
         f"🔗 *{display_name}, sizning referral linkingiz:*\n\n"
@@ -437,45 +416,31 @@ async def callback_get_ref_handler(call: types.CallbackQuery):
     )
     
     await call.answer()
-    await call.message.edit_text(ref_msg, reply_markup=get_main_menu_keyboard())
+    await rendering.edit_text(call.message, ref_msg, reply_markup=get_main_menu_keyboard())
 
 @dp.callback_query(F.data == 'my_refs')
-async def callback_my_refs_handler(call: types.CallbackQuery):
+async def callback_my_refs_handler(call: types.CallbackQuery, db_user: db.DbUser):
     user_id = call.from_user.id
-    refs = get_user_refs(user_id)
-    username, phone = get_user_info(user_id)
-    display_name = get_user_display_name(username, phone, user_id)
-    
-    all_users = get_top_refs(1000)
-    user_rank = None
-    for idx, (uid, _, _, _) in enumerate(all_users, 1):
-        if uid == user_id:
-            user_rank = idx
-            break
+    refs = db_user.refs
+    display_name = get_user_display_name(db_user.username, db_user.phone, user_id)
     
-    rank_text = f"🏅 *Sizning o'rningiz:* {user_rank}-o'rin" if user_rank else "🏅 *O'riningiz:* Aniqlanmagan"
+    user_rank = await db.get_user_rank(refs)
+    rank_text = f"🏅 *Sizning o'rningiz:* {user_rank}-o'rin"
     
     stats_msg = (
         f"📊 *{display_name} - Sizning statistikangiz:*\n\n"
         f"👥 *Jami referrallar:* {refs} ta\n"
         f"{rank_text}\n\n"
         "📋 *Tafsilot:*\n"
-        "• To'g'ridan-to'g'ri takliflar va ikkinchi darajadagi takliflar hisobga olinadi\n"
-        "• Har bir faol taklif +1 ball\n\n"
+        f"{scoring_text('• ')}\n"
         f"🎯 *Maqsad:* {max(10, refs + 5)} ta referral to'plang!\n\n"
         "💪 Ko'proq do'stlaringizni taklif qiling va yuqori o'rinlarga chiqing! 🚀"
     )
     
     await call.answer()
-    await call.message.edit_text(stats_msg, reply_markup=get_main_menu_keyboard())
+    await rendering.edit_text(call.message, stats_msg, reply_markup=get_main_menu_keyboard())
 
-@dp.callback_query(F.data == 'top_refs')
-async def callback_top_refs_handler(call: types.CallbackQuery):
-    top = get_top_refs(10)
-    if not top:
-        await call.answer("❌ Hali hech kim referral qilmagan!", show_alert=True)
-        return
-    
+def render_top_refs(top):
     msg = "🏆 *Top 10 Referral Liderlari:*\n\n"
     medals = ["🥇", "🥈", "🥉"]
     
@@ -485,34 +450,28 @@ async def callback_top_refs_handler(call: types.CallbackQuery):
         msg += f"{medal} {display_name} — *{refs} ball*\n"
     
     msg += "\n💡 *Sizning o'rningizni yaxshilash uchun ko'proq do'stlaringizni taklif qiling!*"
+    return msg
+
+@dp.callback_query(F.data == 'top_refs')
+async def callback_top_refs_handler(call: types.CallbackQuery):
+    # Top 10 xotiradan beriladi; add_referral ballarni o'zgartirganda kesh yangilanadi
+    msg = await leaderboard.get_top(render_top_refs)
+    if not msg:
+        await call.answer("❌ Hali hech kim referral qilmagan!", show_alert=True)
+        return
     
     await call.answer()
-    await call.message.edit_text(msg, reply_markup=get_main_menu_keyboard())
+    await rendering.edit_text(call.message, msg, reply_markup=get_main_menu_keyboard())
 
 @dp.callback_query(F.data == 'help')
 async def callback_help_handler(call: types.CallbackQuery):
-    help_msg = (
-        "ℹ️ *Yordam bo'limi*\n\n"
-        "Bu bot orqali do'stlaringizni taklif qilib ball to'plashingiz mumkin! 😎\n\n"
-        "🔍 *Bot qanday ishlaydi?*\n\n"
-        "1️⃣ *Ro'yxatdan o'tish:*\n"
-        "   • /start buyrug'ini bosing\n"
-        "   • Kanal va guruhlarga obuna bo'ling\n"
-        "   • Telefon raqamingizni yuboring\n\n"
-        "2️⃣ *Referral tizimi:*\n"
-        "   • Sizning maxsus linkingizni oling\n"
-        "   • Do'stlaringizga ulashing\n"
-        "   • Ular ro'yxatdan o'tganda ball oling\n\n"
-        "3️⃣ *Ball tizimi:*\n"
-        "   • To'g'ridan-to'g'ri taklif: +1 ball\n"
-        "   • Ikkinchi darajadagi taklif: +1 ball\n\n"
-        "🎯 *Maqsad:* Ko'proq ball to'plang va top reytingda bo'ling!\n\n"
-        "📞 *Yordam kerakmi?* Admin: @murojat_adm\n\n"
-        "🚀 *Muvaffaqiyatlar tilaymiz!*"
-    )
-    
     await call.answer()
-    await call.message.edit_text(help_msg, reply_markup=get_main_menu_keyboard())
+    await rendering.edit_text(call.message, HELP_TEXT, reply_markup=get_main_menu_keyboard())
+
+@dp.chat_member()
+async def chat_member_handler(update: types.ChatMemberUpdated):
+    # Majburiy kanallardagi a'zolik o'zgarishlari lokal indeksga yoziladi
+    await track_chat_member(update)
 
 @dp.message(Command("addchannel"))
 async def addchannel_handler(message: types.Message):
@@ -525,7 +484,7 @@ async def addchannel_handler(message: types.Message):
         return
     
     username = args[0]
-    success = add_channel(username)
+    success = await db.add_channel(username)
     if success:
         await message.answer(f"✅ Kanal/guruh `{username}` muvaffaqiyatli qo'shildi!")
     else:
@@ -541,7 +500,7 @@ async def removechannel_handler(message: types.Message):
         await message.answer("📥 Iltimos, kanal yoki guruh username'ini kiriting.\n\nMisol: `/removechannel @kanalim`")
         return
     username = args[0]
-    remove_channel(username)
+    await db.remove_channel(username)
     await message.answer(f"🗑️ Kanal/guruh `{username}` ro'yxatdan olib tashlandi!")
 
 @dp.message(Command("channels"))
@@ -549,7 +508,7 @@ async def channels_handler(message: types.Message):
     if message.from_user.id != ADMIN_ID:
         await message.answer("🔐 Faqat adminlar uchun!")
         return
-    channels = get_channels()
+    channels = await db.get_channels()
     if not channels:
         await message.answer("📋 Hozircha kanallar ro'yxati bo'sh.")
         return
@@ -563,56 +522,71 @@ async def random_handler(message: types.Message):
     if message.from_user.id != ADMIN_ID:
         await message.answer("🔐 Faqat adminlar uchun!")
         return
+    # /random N [weighted] [seed] - weighted: ehtimollik ballarga proporsional
     args = message.text.split()[1:]
     try:
         n = int(args[0])
+        weighted = "weighted" in args[1:]
+        rest = [a for a in args[1:] if a != "weighted"]
+        seed = int(rest[0]) if rest else secrets.randbelow(2 ** 31)
+        if n <= 0 or len(rest) > 1:
+            raise ValueError
     except (ValueError, IndexError):
-        await message.answer("📥 Iltimos, to'g'ri son kiriting.\n\nMisol: `/random 5`")
+        await message.answer(
+            "📥 Iltimos, to'g'ri son kiriting.\n\n"
+            "Misol: `/random 5`, `/random 5 weighted` yoki `/random 5 12345` (seed bilan)"
+        )
         return
 
-    with sqlite3.connect('bot_db.sqlite3') as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id FROM users WHERE phone IS NOT NULL")
-        all_users = [row[0] for row in cursor.fetchall()]
+    chosen = await db.draw_winners(n, seed, weighted)
     
-    if n > len(all_users):
-        await message.answer(f"⚠️ Botda faqat {len(all_users)} ta ro'yxatdan o'tgan foydalanuvchi bor.")
+    if len(chosen) < n:
+        if weighted:
+            await message.answer(f"⚠️ Botda faqat {len(chosen)} ta balli ro'yxatdan o'tgan foydalanuvchi bor.")
+        else:
+            await message.answer(f"⚠️ Botda faqat {len(chosen)} ta ro'yxatdan o'tgan foydalanuvchi bor.")
         return
 
-    chosen = random.sample(all_users, n)
+    mode = "ballarga proporsional" if weighted else "teng ehtimollik"
     msg = f"🎲 *Tasodifiy tanlangan {n} ta foydalanuvchi:*\n\n"
-    for i, u in enumerate(chosen, 1):
-        username, phone = get_user_info(u)
+    for i, (u, username, phone, refs) in enumerate(chosen, 1):
         display_name = get_user_display_name(username, phone, u)
         msg += f"{i}. {display_name} (ID: {u})\n"
+    msg += f"\n🔑 Seed: `{seed}` ({mode})"
     await message.answer(msg)
 
-@dp.message(Command("allusers"))
+EXPORT_USAGE = (
+    "📥 Foydalanish: `/export [users|referrals] [csv|jsonl] [registered] [min_ball]`\n\n"
+    "Misol: `/export users registered 5` yoki `/export referrals jsonl`"
+)
+
+@dp.message(Command("allusers", "export"))
 async def allusers_handler(message: types.Message):
     if message.from_user.id != ADMIN_ID:
         await message.answer("🔐 Faqat adminlar uchun!")
         return
-    users = get_all_users()
-    if not users:
-        await message.answer("📋 Hozircha ro'yxatdan o'tgan foydalanuvchilar yo'q.")
+    options = export.parse_args(message.text.split()[1:])
+    if options is None:
+        await message.answer(EXPORT_USAGE)
         return
     
-    lines = ["📋 *Barcha foydalanuvchilar:*\n\n"]
-    for u in users:
-        user_id, username, phone, refs = u
-        display_name = get_user_display_name(username, phone, user_id)
-        status = "✅" if phone else "❌"
-        lines.append(f"{status} {display_name} | 🏆 {refs} ball")
-    
-    current_msg = ""
-    for line in lines:
-        if len(current_msg) + len(line) + 1 > 4096:
-            await message.answer(current_msg, parse_mode=ParseMode.MARKDOWN)
-            current_msg = ""
-        current_msg += line + "\n"
-    
-    if current_msg:
-        await message.answer(current_msg, parse_mode=ParseMode.MARKDOWN)
+    # Fayl fonda tayyorlanadi va bitta hujjat sifatida yuboriladi
+    export.start_export(message.bot, message.chat.id, **options)
+    await message.answer("⏳ Eksport tayyorlanmoqda, fayl tayyor bo'lgach yuboriladi...")
+
+@dp.message(Command("graph"))
+async def graph_handler(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("🔐 Faqat adminlar uchun!")
+        return
+    args = message.text.split()[1:]
+    if args not in ([], ["repair"]):
+        await message.answer("📥 Foydalanish: `/graph` - hisobot, `/graph repair` - refs'ni grafdan qayta hisoblash")
+        return
+
+    # Butun graf fonda bir marta o'qiladi va tahlil qilinadi, natija alohida xabar bo'lib keladi
+    referral_graph.start_scan(message.bot, message.chat.id, repair=bool(args))
+    await message.answer("⏳ Referral grafi tahlil qilinmoqda...")
 
 @dp.message(Command("stats"))
 async def stats_handler(message: types.Message):
@@ -620,16 +594,17 @@ async def stats_handler(message: types.Message):
         await message.answer("🔐 Faqat adminlar uchun!")
         return
     
-    with sqlite3.connect('bot_db.sqlite3') as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM users")
-        total_users = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM users WHERE phone IS NOT NULL")
-        registered_users = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM referrals")
-        total_referrals = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM channels")
-        total_channels = cursor.fetchone()[0]
+    args = message.text.split()[1:]
+    if args and args[0] in ("hours", "days"):
+        await message.answer(await render_stats_series(args[0]))
+        return
+    
+    total_users, registered_users, total_referrals, total_channels = await db.get_stats()
+    recent = await db.get_counter_totals([3600, 86400, 7 * 86400])
+    
+    def velocity(name):
+        hour, day, week = recent.get(name, [0, 0, 0])
+        return f"+{hour} / +{day} / +{week}"
     
     stats_msg = (
         "📊 *Bot statistikasi:*\n\n"
@@ -637,10 +612,30 @@ async def stats_handler(message: types.Message):
         f"✅ *Ro'yxatdan o'tganlar:* {registered_users}\n"
         f"🔗 *Jami referrallar:* {total_referrals}\n"
         f"📢 *Kanallar soni:* {total_channels}\n\n"
-        f"📈 *Ro'yxatdan o'tish foizi:* {round(registered_users/total_users*100, 1) if total_users > 0 else 0}%"
+        f"📈 *Ro'yxatdan o'tish foizi:* {round(registered_users/total_users*100, 1) if total_users > 0 else 0}%\n\n"
+        "⏱ *Soat / 24 soat / 7 kun:*\n"
+        f"👥 Yangi foydalanuvchilar: {velocity('users')}\n"
+        f"✅ Ro'yxatdan o'tganlar: {velocity('registered')}\n"
+        f"🔗 Referrallar: {velocity('referrals')}\n\n"
+        "📉 Batafsil: `/stats hours` yoki `/stats days`"
     )
     await message.answer(stats_msg)
 
+async def render_stats_series(period: str):
+    # Oxirgi 24 soat yoki 14 kun bo'yicha ro'yxatdan o'tish va referrallar
+    if period == "hours":
+        bucket, count, fmt, title = 3600, 24, "%d.%m %H:00", "soatlik"
+    else:
+        bucket, count, fmt, title = 86400, 14, "%d.%m", "kunlik"
+    registered = await db.get_counter_series('registered', bucket, count)
+    referrals = await db.get_counter_series('referrals', bucket, count)
+    
+    lines = [f"📉 *Kampaniya tezligi ({title}, UTC):*\n", "`vaqt         ro'yx.  ref.`"]
+    for (ts, reg), (_, refs) in zip(registered, referrals):
+        label = time.strftime(fmt, time.gmtime(ts))
+        lines.append(f"`{label:<12} {reg:>6} {refs:>5}`")
+    return "\n".join(lines)
+
 @dp.message(Command("broadcast"))
 async def broadcast_handler(message: types.Message):
     if message.from_user.id != ADMIN_ID:
@@ -653,33 +648,24 @@ async def broadcast_handler(message: types.Message):
         await message.answer("📥 Foydalanish: `/broadcast xabar matni`")
         return
     
-    users = get_all_users()
-    if not users:
-        await message.answer("❌ Hali foydalanuvchilar yo'q.")
+    # Yuborish fonda bajariladi; progress shu chatdagi xabarda yangilanib boriladi
+    if await broadcast.start_broadcast(message.bot, msg_text, message.chat.id) is None:
+        await message.answer("⚠️ Boshqa xabar hali yuborilmoqda. To'xtatish uchun: `/stopbroadcast`")
+
+@dp.message(Command("stopbroadcast"))
+async def stopbroadcast_handler(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("🔐 Faqat adminlar uchun!")
         return
     
-    success = 0
-    fail = 0
-    for u in users:
-        user_id = u[0]
-        try:
-            await message.bot.send_message(user_id, msg_text)
-        except Exception:
-            fail += 1
-            continue
-    
-    await message.answer(
-        f"📢 Xabar yuborildi!\n\n"
-        f"✅ Muvaffaqiyatli: {success}\n"
-        f"❌ Xatolik: {fail}"
-    )
+    if await broadcast.cancel_broadcasts():
+        await message.answer("🛑 Xabar yuborish to'xtatildi.")
+    else:
+        await message.answer("📋 Hozir hech qanday xabar yuborilmayapti.")
 
 @dp.message()
-async def default_handler(message: types.Message):
-    user_id = message.from_user.id
-    phone = get_user_phone(user_id)
-    
-    if not phone:
+async def default_handler(message: types.Message, db_user: db.DbUser):
+    if not db_user.phone:
         await message.answer(
             "🚫 Siz hali ro'yxatdan o'tmadingiz!\n\n"
             "Iltimos, /start buyrug'ini bosing va ro'yxatdan o'ting. 😊",
@@ -698,9 +684,25 @@ WEBHOOK_URL = f"https://{WEB_APP_NAME}{WEBHOOK_PATH}"
 
 # This on_startup function is an async handler that will be automatically called by aiohttp.
 async def on_startup(app):
-    # Initializes the database.
-    init_db()
+    # Opens the long-lived database connection.
+    await db.init_db()
+    await dedup.load()
+    start_membership_sync()
+    notifications.start_notifier(bot)
+    if update_queue:
+        update_queue.start()
     logging.info("🚀 Bot ishga tushirildi va ma'lumotlar bazasi tayyorlandi!")
+    if not PRIMARY_WORKER:
+        return
+    # Qayta ishga tushishdan oldin tugallanmagan broadcastlar davom ettiriladi
+    await broadcast.resume_broadcasts(bot)
+    if poller:
+        # Webhook o'rnatilgan bo'lsa getUpdates ishlamaydi; kutayotgan update'lar saqlanib qoladi
+        await bot.delete_webhook(drop_pending_updates=False)
+        poller.allowed_updates = dp.resolve_used_update_types()
+        poller.start()
+        logging.info(f"✅ Polling boshlandi: {UPDATE_QUEUE_WORKERS} worker, partiya {poller.limit}")
+        return
     logging.info(f"✅ Webhook o'rnatilmoqda: {WEBHOOK_URL}")
     try:
         # Sets the bot's webhook URL.
@@ -711,31 +713,76 @@ async def on_startup(app):
 
 # This on_shutdown function is an async handler that will be automatically called by aiohttp.
 async def on_shutdown(app):
-    logging.info("🛑 Bot o'chirilmoqda. Webhook o'chirilmoqda...")
-    # Deletes the webhook before shutting down.
-    await bot.delete_webhook()
+    logging.info("🛑 Bot o'chirilmoqda..." if poller else "🛑 Bot o'chirilmoqda. Webhook o'chirilmoqda...")
+    # Deletes the webhook before shutting down (only the primary worker owns it).
+    if poller:
+        await poller.stop()
+    elif PRIMARY_WORKER:
+        await bot.delete_webhook()
+    # Finishes updates that were already accepted into the queue.
+    if update_queue:
+        await update_queue.drain()
+    # Confirms the polling offset so handled updates are not delivered again.
+    if poller:
+        await poller.commit()
+    # Stops running broadcasts; their progress is already saved and they resume on next start.
+    await broadcast.stop_broadcasts()
+    # Stops the outbox dispatcher; undelivered notifications stay in the table for the next start.
+    await notifications.stop_notifier()
     # Closes the bot's session to free up resources.
     await bot.session.close()
-    logging.info("✅ Webhook muvaffaqiyatli o'chirildi!")
+    # Flushes pending membership updates and the last update_id, then closes the database connection and its worker thread.
+    await stop_membership_sync()
+    await dedup.save()
+    await db.close_db()
+    logging.info("✅ Bot to'xtatildi!" if poller else "✅ Webhook muvaffaqiyatli o'chirildi!")
 
 # The main entry point for the application.
 def main():
-    if not WEB_APP_NAME:
+    if BOT_MODE not in ("webhook", "polling"):
+        logging.error(f"Noma'lum BOT_MODE: {BOT_MODE} (webhook yoki polling bo'lishi kerak)")
+        return
+    if BOT_MODE == "webhook" and not WEB_APP_NAME:
         logging.error("RENDER_EXTERNAL_HOSTNAME topilmadi. Webhook rejimida ishga tushirish mumkin emas.")
         return
 
+    if BOT_MODE == "polling" and not METRICS_PATH:
+        asyncio.run(_run_without_server())
+        return
+
     # Creates the aiohttp application.
     app = web.Application()
     app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown)
     
     # Correctly adds the webhook handler to the application router.
-    app.router.add_post(WEBHOOK_PATH, SimpleRequestHandler(dispatcher=dp, bot=bot))
+    # With UPDATE_QUEUE_WORKERS set, updates are queued and Telegram gets an immediate 200.
+    # In polling mode the server only serves /metrics; updates come from the poller started in on_startup.
+    if BOT_MODE == "webhook":
+        if update_queue:
+            webhook_handler = QueuedRequestHandler(dispatcher=dp, bot=bot, queue=update_queue)
+        else:
+            webhook_handler = SimpleRequestHandler(dispatcher=dp, bot=bot)
+        app.router.add_post(WEBHOOK_PATH, webhook_handler)
+    if METRICS_PATH:
+        app.router.add_get(METRICS_PATH, metrics.handler)
     
     # Uses web.run_app to start the server, which handles the entire lifecycle
     # including graceful shutdown and keeping the event loop running.
-    web.run_app(app, host='0.0.0.0', port=int(os.getenv("PORT", 80)))
+    web.run_app(app, host='0.0.0.0', port=PORT, reuse_port=WEB_REUSE_PORT or None)
     logging.info("🚀 Web server da ishlamoqda...")
 
+async def _run_without_server():
+    # Polling rejimi, /metrics o'chirilgan: web.run_app o'rniga SIGINT/SIGTERM kutiladi
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await on_startup(None)
+    try:
+        await stop.wait()
+    finally:
+        await on_shutdown(None)
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,118 @@
+from bisect import bisect_left
+
+from aiohttp import web
+
+# Prometheus text formatidagi oddiy metrikalar. Tashqi kutubxona kerak emas:
+# qiymatlar oddiy dict'larda saqlanadi va faqat /metrics so'ralganda matnga aylantiriladi.
+
+_registry = []
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra="") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in list(self._values.items()):
+            yield f"{self.name}{_labels(self.labels, labels)} {value}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # labels -> [har bir bucket uchun (kumulyativ emas) sanoq..., +Inf, yig'indi]
+        self._values = {}
+        _registry.append(self)
+
+    def observe(self, value: float, *labels):
+        row = self._values.get(labels)
+        if row is None:
+            row = self._values[labels] = [0] * (len(self.buckets) + 2)
+        row[bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, row in list(self._values.items()):
+            row = list(row)
+            total = 0
+            for bound, count in zip(self.buckets, row):
+                total += count
+                le = 'le="%s"' % bound
+                yield f"{self.name}_bucket{_labels(self.labels, labels, le)} {total}"
+            total += row[len(self.buckets)]
+            le = 'le="+Inf"'
+            yield f"{self.name}_bucket{_labels(self.labels, labels, le)} {total}"
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {row[-1]}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {total}"
+
+
+class Gauge:
+    # Qiymat faqat /metrics so'ralganda `fn()` orqali olinadi (navbat uzunligi, kesh hajmi va h.k.).
+    # fn son yoki {label qiymati: son} qaytarishi mumkin.
+    def __init__(self, name: str, help: str, fn, label: str = None, kind: str = "gauge"):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.label = label
+        self.kind = kind
+        _registry.append(self)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        value = self.fn()
+        if isinstance(value, dict):
+            for key, v in value.items():
+                yield f"{self.name}{_labels((self.label,), (key,))} {v}"
+        else:
+            yield f"{self.name} {value}"
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def handler(request: web.Request):
+    return web.Response(
+        body=render().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+UPDATES = Counter("bot_updates_total", "Handler bo'yicha ishlangan update'lar", ("handler",))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Handler ichida ko'tarilgan xatolar", ("handler",))
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Handler bajarilish vaqti", ("handler",))
+DB_SECONDS = Histogram("bot_db_query_seconds", "SQLite so'rovlari bajarilish vaqti (DB oqimida)", ("query",))
+API_SECONDS = Histogram("bot_telegram_request_seconds", "Telegram Bot API so'rovlari vaqti", ("method",))
+API_ERRORS = Counter("bot_telegram_errors_total", "Telegram Bot API xatolari", ("method", "error"))
+CACHE = Counter("bot_cache_requests_total", "Keshlar bo'yicha hit/miss", ("cache", "result"))
@@ -0,0 +1,183 @@
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+import database as db
+import metrics
+
+
+class UserMiddleware(BaseMiddleware):
+    # Har bir update uchun foydalanuvchi qatorini bitta so'rov bilan yuklaydi (yo'q bo'lsa yaratadi)
+    # va uni handlerlarga `db_user` argumenti sifatida uzatadi.
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is not None and not user.is_bot:
+            data["db_user"] = await db.load_user(user.id, user.username)
+        return await handler(event, data)
+
+
+class UpdateWindow:
+    # Oxirgi `size` ta update_id uchun halqa-bitset: id % size katakchasi shu id ko'rilganini bildiradi.
+    def __init__(self, size: int, high: int = 0):
+        self.size = size
+        self.high = high
+        self._bits = bytearray(size)
+
+    def restore(self, high: int):
+        # Saqlangan eng katta id tiklanadi: (high - size, high] oralig'i ko'rilgan deb belgilanadi,
+        # qayta ishga tushgandan keyin Telegram qayta yuborgan update'lar tashlanadi
+        if high <= self.high:
+            return
+        self.high = high
+        self._bits = bytearray(b"\x01") * self.size
+
+    def seen(self, update_id: int) -> bool:
+        # True - avval ko'rilgan; aks holda id belgilanadi va False qaytadi
+        if update_id <= self.high - self.size:
+            # Oynadan ancha past id takror emas: bir hafta update bo'lmasa Bot API update_id'ni
+            # tasodifiy qiymatdan qayta boshlaydi. Oyna shu id'dan boshlab yangilanadi.
+            logging.warning(f"⚠️ update_id {update_id} oynadan past (oxirgisi {self.high}), oyna qayta boshlandi")
+            self._bits = bytearray(self.size)
+            self.high = update_id
+        elif update_id > self.high:
+            if update_id - self.high >= self.size:
+                self._bits = bytearray(self.size)
+            else:
+                for i in range(self.high + 1, update_id + 1):
+                    self._bits[i % self.size] = 0
+            self.high = update_id
+        slot = update_id % self.size
+        if self._bits[slot]:
+            return True
+        self._bits[slot] = 1
+        return False
+
+
+class DedupMiddleware(BaseMiddleware):
+    # Telegram qayta yuborgan update'larni dispatcher'ga yetmasdan tashlab yuboradi.
+    # persist=True bo'lsa eng katta update_id bazaga yoziladi va qayta ishga tushganda tiklanadi.
+    # Oyna jarayon ichida: bir nechta jarayon bo'lsa dedup faqat shu jarayonga kelganlar orasida ishlaydi.
+    STATE_KEY = "last_update_id"
+
+    def __init__(self, window: int, persist: bool = True, persist_every: int = 100):
+        self.window = UpdateWindow(window)
+        self.persist = persist
+        self.persist_every = persist_every
+        self.dropped = 0
+        self._saved = 0
+
+    async def load(self):
+        if self.persist:
+            self._saved = int(await db.get_state(self.STATE_KEY, 0))
+            self.window.restore(self._saved)
+
+    async def save(self):
+        # != : update_id ketma-ketligi qayta boshlangan bo'lsa (UpdateWindow.seen) kichik qiymat ham yoziladi
+        if self.persist and self.window.high != self._saved:
+            self._saved = self.window.high
+            await db.set_state(self.STATE_KEY, self._saved)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if self.window.seen(event.update_id):
+            self.dropped += 1
+            logging.info(f"♻️ Takroriy update {event.update_id} tashlab yuborildi")
+            return None
+        if self.persist and abs(self.window.high - self._saved) >= self.persist_every:
+            await self.save()
+        return await handler(event, data)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    # Har bir foydalanuvchi uchun token bucket: `rate` ta update/soniya, `burst` tagacha zaxira.
+    # Limitdan oshgan update'lar handler va bazaga yetmasdan tashlanadi; foydalanuvchi bir marta ogohlantiriladi.
+    # Jadval ixcham: user_id -> [tokens, oxirgi vaqt, ogohlantirilganmi]; `ttl` soniya jim turganlar o'chiriladi
+    # (shuncha vaqtda bucket baribir to'lgan bo'ladi).
+    def __init__(self, rate: float, burst: float, ttl: float = 60, exempt=(), notice: str = None):
+        self.rate = rate
+        self.burst = burst
+        self.ttl = max(ttl, burst / rate)
+        self.exempt = frozenset(exempt)
+        self.notice = notice
+        self.dropped = 0
+        self._buckets = {}
+        self._next_sweep = time.monotonic() + self.ttl
+
+    def _sweep(self, now: float):
+        cutoff = now - self.ttl
+        self._buckets = {uid: b for uid, b in self._buckets.items() if b[1] > cutoff}
+        self._next_sweep = now + self.ttl
+
+    def allow(self, user_id: int):
+        # True - o'tkaziladi; False - tashlanadi; None - tashlanadi, lekin birinchi marta (ogohlantirish uchun)
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self._sweep(now)
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            self._buckets[user_id] = [self.burst - 1, now, False]
+            return True
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            bucket[2] = False
+            return True
+        bucket[0] = tokens
+        if bucket[2]:
+            return False
+        bucket[2] = True
+        return None
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None or user.id in self.exempt:
+            return await handler(event, data)
+        allowed = self.allow(user.id)
+        if allowed:
+            return await handler(event, data)
+        self.dropped += 1
+        if allowed is None and self.notice:
+            try:
+                if isinstance(event, (CallbackQuery, Message)):
+                    await event.answer(self.notice)
+            except Exception as e:
+                logging.debug(f"Throttling ogohlantirishi yuborilmadi: {e}")
+        return None
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    # Inner middleware: handler nomi bo'yicha update soni, bajarilish vaqti va xatolar
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        name = data["handler"].callback.__name__
+        metrics.UPDATES.inc(name)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            metrics.HANDLER_SECONDS.observe(time.perf_counter() - start, name)
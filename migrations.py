@@ -0,0 +1,250 @@
+import logging
+import sqlite3
+
+# Sxema versiyasi PRAGMA user_version da saqlanadi. Har bir migratsiya bir marta,
+# o'z tranzaksiyasida bajariladi. Yangi o'zgarishlar faqat ro'yxat oxiriga qo'shiladi.
+
+
+def _add_column(conn: sqlite3.Connection, table: str, column: str, decl: str):
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def _initial_schema(conn: sqlite3.Connection):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS channels (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            phone TEXT,
+            refs INTEGER DEFAULT 0,
+            pending_ref_id INTEGER
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS referrals (
+            user_id INTEGER UNIQUE,
+            ref_id INTEGER
+        )
+    ''')
+
+
+def _memberships_and_broadcasts(conn: sqlite3.Connection):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS memberships (
+            user_id INTEGER,
+            channel TEXT,
+            status TEXT,
+            updated_at INTEGER,
+            PRIMARY KEY (user_id, channel)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT,
+            admin_chat_id INTEGER,
+            progress_message_id INTEGER,
+            last_user_id INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            status TEXT DEFAULT 'running',
+            created_at INTEGER
+        )
+    ''')
+    # Botni bloklagan foydalanuvchilar keyingi xabarnomalarda o'tkazib yuboriladi
+    _add_column(conn, 'users', 'blocked', 'INTEGER DEFAULT 0')
+
+
+def _referrals_keys_and_timestamps(conn: sqlite3.Connection):
+    # referrals jadvali kalitlar bilan qayta quriladi (SQLite ALTER orqali PRIMARY KEY qo'sha olmaydi)
+    conn.execute('''
+        CREATE TABLE referrals_new (
+            user_id INTEGER PRIMARY KEY REFERENCES users(user_id),
+            ref_id INTEGER NOT NULL REFERENCES users(user_id),
+            created_at INTEGER
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO referrals_new (user_id, ref_id)
+        SELECT user_id, ref_id FROM referrals WHERE user_id IS NOT NULL AND ref_id IS NOT NULL
+    ''')
+    conn.execute("DROP TABLE referrals")
+    conn.execute("ALTER TABLE referrals_new RENAME TO referrals")
+    # Eski qatorlarda vaqt yo'q (NULL), yangilari yozilganda to'ldiriladi
+    _add_column(conn, 'users', 'created_at', 'INTEGER')
+    _add_column(conn, 'users', 'registered_at', 'INTEGER')
+
+
+def _hot_query_indexes(conn: sqlite3.Connection):
+    # Leaderboard va reyting (ORDER BY refs, COUNT(*) WHERE refs > ?)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_refs ON users(refs)")
+    # Ro'yxatdan o'tganlar soni, /random va takroriy telefonlar
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_phone ON users(phone)")
+    # Referrer bo'yicha qidiruvlar
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_referrals_ref_id ON referrals(ref_id)")
+
+
+def _bot_state(conn: sqlite3.Connection):
+    # Kichik kalit-qiymat holatlari (masalan, oxirgi ishlangan update_id)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS bot_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+
+
+def _draws(conn: sqlite3.Connection):
+    # /random natijalari: seed va g'oliblar audit uchun saqlanadi
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS draws (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            seed INTEGER,
+            n INTEGER,
+            weighted INTEGER,
+            winners TEXT,
+            created_at INTEGER
+        )
+    ''')
+
+
+def _counters(conn: sqlite3.Connection):
+    # /stats uchun tayyor hisoblagichlar va soatlik qatorlar. Ular triggerlar orqali
+    # o'sha tranzaksiyada yangilanadi, shuning uchun COUNT(*) bilan farq qilmaydi.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS counter_buckets (
+            name TEXT,
+            bucket INTEGER,
+            value INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (name, bucket)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        INSERT OR REPLACE INTO counters (name, value) VALUES
+            ('users', (SELECT COUNT(*) FROM users)),
+            ('registered', (SELECT COUNT(*) FROM users WHERE phone IS NOT NULL)),
+            ('referrals', (SELECT COUNT(*) FROM referrals)),
+            ('channels', (SELECT COUNT(*) FROM channels))
+    ''')
+    # Vaqt belgisi bor eski yozuvlar soatlik qatorlarga to'ldiriladi
+    for name, table, column, where in (
+        ('users', 'users', 'created_at', ''),
+        ('registered', 'users', 'registered_at', 'AND phone IS NOT NULL'),
+        ('referrals', 'referrals', 'created_at', ''),
+    ):
+        conn.execute(f'''
+            INSERT OR REPLACE INTO counter_buckets (name, bucket, value)
+            SELECT '{name}', ({column} / 3600) * 3600, COUNT(*) FROM {table}
+            WHERE {column} IS NOT NULL {where} GROUP BY 2
+        ''')
+
+    def bump(name: str, delta: int = 1, bucket: bool = True):
+        sql = f"UPDATE counters SET value = value + ({delta}) WHERE name = '{name}';"
+        if bucket:
+            sql += f'''
+                INSERT INTO counter_buckets (name, bucket, value)
+                VALUES ('{name}', (CAST(strftime('%s', 'now') AS INTEGER) / 3600) * 3600, {delta})
+                ON CONFLICT(name, bucket) DO UPDATE SET value = value + ({delta});
+            '''
+        return sql
+
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS trg_users_insert AFTER INSERT ON users BEGIN {bump('users')} END")
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_users_registered AFTER UPDATE OF phone ON users
+        WHEN OLD.phone IS NULL AND NEW.phone IS NOT NULL BEGIN {bump('registered')} END
+    ''')
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS trg_referrals_insert AFTER INSERT ON referrals BEGIN {bump('referrals')} END")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS trg_channels_insert AFTER INSERT ON channels BEGIN {bump('channels', 1, False)} END")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS trg_channels_delete AFTER DELETE ON channels BEGIN {bump('channels', -1, False)} END")
+
+
+def _outbox(conn: sqlite3.Connection):
+    # Yuborilishi kerak bo'lgan bildirishnomalar: referral bilan bitta tranzaksiyada yoziladi,
+    # fon dispatcher yetkazib bo'lgach o'chiradi
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            points INTEGER NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_next_attempt ON outbox(next_attempt_at)")
+
+
+def _single_running_broadcast(conn: sqlite3.Connection):
+    # Bir nechta jarayon bitta bazada ishlaganda ham bir vaqtda faqat bitta broadcast 'running' bo'ladi
+    conn.execute('''
+        UPDATE broadcasts SET status = 'cancelled'
+        WHERE status = 'running' AND id < (SELECT MAX(id) FROM broadcasts WHERE status = 'running')
+    ''')
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_broadcasts_running ON broadcasts(status) WHERE status = 'running'")
+
+
+def _lowercase_channels(conn: sqlite3.Connection):
+    # Kanal nomlari kichik harfga: chat_member hodisalaridagi username bilan aniq solishtiriladi.
+    # Faqat harf katta-kichikligi bilan farq qiladigan takrorlardan birinchi kanal va eng yangi a'zolik qoladi.
+    conn.execute("DELETE FROM channels WHERE id NOT IN (SELECT MIN(id) FROM channels GROUP BY lower(username))")
+    conn.execute("UPDATE channels SET username = lower(username) WHERE username != lower(username)")
+    conn.execute('''
+        DELETE FROM memberships WHERE EXISTS (
+            SELECT 1 FROM memberships x
+            WHERE x.user_id = memberships.user_id AND lower(x.channel) = lower(memberships.channel)
+              AND (x.updated_at, x.channel) > (memberships.updated_at, memberships.channel)
+        )
+    ''')
+    conn.execute("UPDATE memberships SET channel = lower(channel) WHERE channel != lower(channel)")
+
+
+MIGRATIONS = [
+    _initial_schema,
+    _memberships_and_broadcasts,
+    _referrals_keys_and_timestamps,
+    _hot_query_indexes,
+    _bot_state,
+    _draws,
+    _counters,
+    _outbox,
+    _single_running_broadcast,
+    _lowercase_channels,
+]
+
+
+def migrate(conn: sqlite3.Connection):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= len(MIGRATIONS):
+        return
+    # Jadvallarni qayta qurish uchun foreign key tekshiruvi vaqtincha o'chiriladi
+    # (tranzaksiya ichida o'zgartirib bo'lmaydi)
+    conn.execute("PRAGMA foreign_keys=OFF")
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute("BEGIN")
+        try:
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logging.error(f"❌ Migratsiya {number} ({migration.__name__}) bajarilmadi")
+            raise
+        logging.info(f"🗄️ Migratsiya {number} bajarildi: {migration.__name__}")
+    violations = conn.execute("PRAGMA foreign_key_check").fetchall()
+    if violations:
+        logging.warning(f"⚠️ Bazada {len(violations)} ta foreign key buzilishi bor (eski ma'lumotlar)")
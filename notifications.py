@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import os
+from collections import defaultdict
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
+
+import database as db
+
+# Outbox dispatcher sozlamalari
+NOTIFY_INTERVAL = float(os.getenv("NOTIFY_INTERVAL", 2))
+NOTIFY_BATCH_SIZE = int(os.getenv("NOTIFY_BATCH_SIZE", 200))
+NOTIFY_CONCURRENCY = int(os.getenv("NOTIFY_CONCURRENCY", 10))
+NOTIFY_MAX_ATTEMPTS = int(os.getenv("NOTIFY_MAX_ATTEMPTS", 5))
+NOTIFY_RETRY_DELAY = int(os.getenv("NOTIFY_RETRY_DELAY", 30))
+
+_task = None
+_wake_event = asyncio.Event()
+
+
+def wake():
+    # Yangi yozuv qo'shilganda intervalni kutmasdan yetkazish
+    _wake_event.set()
+
+
+def _referral_text(count: int, points: int):
+    if count == 1:
+        return (
+            "🎉 *Yangi referral!*\n\n"
+            f"Sizga yangi referral qo'shildi! Ballaringiz +{points} ga oshdi! 🚀\n\n"
+            "📊 Statistikangizni ko'rish uchun menyudan foydalaning."
+        )
+    return (
+        f"🎉 *{count} ta yangi referral!*\n\n"
+        f"Sizga {count} ta yangi referral qo'shildi! Ballaringiz +{points} ga oshdi! 🚀\n\n"
+        "📊 Statistikangizni ko'rish uchun menyudan foydalaning."
+    )
+
+
+async def _deliver(bot: Bot, semaphore: asyncio.Semaphore, user_id: int, rows):
+    # Bitta foydalanuvchiga yig'ilgan barcha referrallar bitta xabarga birlashtiriladi
+    async with semaphore:
+        try:
+            await bot.send_message(user_id, _referral_text(len(rows), sum(r[3] for r in rows)))
+            return True
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Botni bloklagan yoki chat topilmadi: qayta urinishdan foyda yo'q
+            logging.info(f"🚫 Referrer {user_id} ga bildirishnoma yuborilmadi: {e}")
+            return True
+        except Exception as e:
+            logging.error(f"Error notifying referrer {user_id}: {e}")
+            return False
+
+
+async def dispatch(bot: Bot):
+    rows = await db.get_due_notifications(NOTIFY_BATCH_SIZE)
+    if not rows:
+        return 0
+    by_user = defaultdict(list)
+    for row in rows:
+        by_user[row[1]].append(row)
+
+    semaphore = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+    users = list(by_user)
+    results = await asyncio.gather(*(_deliver(bot, semaphore, u, by_user[u]) for u in users))
+
+    done, retry, dropped = [], defaultdict(list), []
+    for user_id, ok in zip(users, results):
+        for row in by_user[user_id]:
+            if ok:
+                done.append(row[0])
+            elif row[4] + 1 >= NOTIFY_MAX_ATTEMPTS:
+                dropped.append(row[0])
+            else:
+                retry[NOTIFY_RETRY_DELAY * 2 ** row[4]].append(row[0])
+    if done or dropped:
+        await db.delete_notifications(done + dropped)
+    for delay, ids in retry.items():
+        await db.retry_notifications(ids, delay)
+    if dropped:
+        logging.warning(f"⚠️ {len(dropped)} ta bildirishnoma {NOTIFY_MAX_ATTEMPTS} urinishdan keyin tashlab yuborildi")
+    return len(rows)
+
+
+async def _loop(bot: Bot):
+    while True:
+        try:
+            await asyncio.wait_for(_wake_event.wait(), NOTIFY_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _wake_event.clear()
+        try:
+            # To'liq partiya chiqsa navbatda yana yozuvlar bo'lishi mumkin
+            while await dispatch(bot) >= NOTIFY_BATCH_SIZE:
+                pass
+        except Exception as e:
+            logging.error(f"❌ Outbox dispatcher xatosi: {e}")
+
+
+def start_notifier(bot: Bot):
+    global _task
+    if _task is None:
+        _task = asyncio.create_task(_loop(bot))
+
+
+async def stop_notifier():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
@@ -0,0 +1,72 @@
+import asyncio
+import logging
+
+from aiogram import Bot
+from aiogram.methods import GetUpdates
+
+from update_queue import UpdateQueue
+
+
+class UpdatePoller:
+    # Webhook o'rniga getUpdates: har safar `limit` tagacha update olinadi va UpdateQueue'ga beriladi.
+    # Navbat foydalanuvchi bo'yicha shardlangan, shuning uchun bitta foydalanuvchining update'lari
+    # tartibi webhook rejimidagidek saqlanadi, turli foydalanuvchilar esa parallel ishlanadi.
+    # Keyingi partiya oldingisi ishlanayotganda olinadi; shard to'lsa poller kutadi (update'lar
+    # Telegram'da qoladi), shuning uchun uzilishdan keyingi backlog navbat sig'imi bilan tez tortiladi.
+    def __init__(self, bot: Bot, queue: UpdateQueue, limit: int = 100, timeout: int = 25,
+                 allowed_updates=None, max_backoff: float = 30):
+        self.bot = bot
+        self.queue = queue
+        self.limit = max(1, min(limit, 100))  # Bot API cheklovi
+        self.timeout = timeout
+        self.allowed_updates = allowed_updates
+        self.max_backoff = max_backoff
+        self.offset = None
+        self.fetched = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        kwargs = {}
+        if self.bot.session.timeout:
+            # Long polling so'rovi sessiya timeout'idan uzoqroq kutishi mumkin
+            kwargs["request_timeout"] = int(self.bot.session.timeout + self.timeout)
+        delay = 1
+        while True:
+            method = GetUpdates(offset=self.offset, limit=self.limit, timeout=self.timeout,
+                                allowed_updates=self.allowed_updates)
+            try:
+                updates = await self.bot(method, **kwargs)
+            except Exception as e:
+                logging.error(f"❌ getUpdates xatosi: {type(e).__name__}: {e}. {delay} s dan keyin qayta urinish")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+                continue
+            delay = 1
+            if len(updates) == self.limit:
+                logging.info(f"📥 To'liq partiya olindi ({len(updates)} ta), navbatda {self.queue.qsize()} ta")
+            for update in updates:
+                if not await self.queue.put(update, wait=True):
+                    return
+                # offset faqat navbatga qabul qilingan update'dan keyin suriladi
+                self.offset = update.update_id + 1
+                self.fetched += 1
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def commit(self):
+        # Navbatdagilar ishlangandan keyin chaqiriladi: oxirgi offset Telegram'da tasdiqlanadi,
+        # aks holda qayta ishga tushganda o'sha update'lar yana keladi
+        if self.offset is None:
+            return
+        try:
+            await self.bot(GetUpdates(offset=self.offset, limit=1, timeout=0))
+        except Exception as e:
+            logging.warning(f"⚠️ getUpdates offset tasdiqlanmadi: {e}")
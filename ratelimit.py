@@ -0,0 +1,84 @@
+import asyncio
+import time
+from collections import deque
+
+
+class TokenBucket:
+    # Oddiy token bucket: soniyasiga `rate` ta token, eng ko'pi bilan `capacity` ta to'planadi.
+    # pause() - TelegramRetryAfter kelganda butun oqimni to'xtatib turish uchun.
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._tokens = 0
+        self._updated = now
+
+
+INTERACTIVE, BULK = 0, 1
+
+
+class PriorityTokenBucket(TokenBucket):
+    # Token bucket bilan navbat: token bo'shaganda avval INTERACTIVE, keyin BULK kutuvchilar oladi.
+    # Shu tufayli broadcast kabi ommaviy yuborishlar foydalanuvchi javoblarini kechiktirmaydi.
+    def __init__(self, rate: float, capacity: float = None):
+        super().__init__(rate, capacity)
+        self._lanes = (deque(), deque())
+        self._pump_task = None
+
+    def waiting(self):
+        return sum(len(lane) for lane in self._lanes)
+
+    async def acquire(self, priority: int = INTERACTIVE):
+        now = time.monotonic()
+        if now >= self._paused_until and not self.waiting():
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+        future = asyncio.get_running_loop().create_future()
+        self._lanes[priority].append(future)
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        await future
+
+    async def _pump(self):
+        while self.waiting():
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._refill(now)
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                continue
+            lane = self._lanes[0] if self._lanes[0] else self._lanes[1]
+            future = lane.popleft()
+            if future.done():
+                # Kutuvchi bekor qilingan
+                continue
+            self._tokens -= 1
+            future.set_result(None)
@@ -0,0 +1,314 @@
+import argparse
+import asyncio
+import bisect
+import heapq
+import json
+import logging
+import os
+import sys
+import time
+from array import array
+from collections import Counter
+
+from aiogram import Bot
+
+import database as db
+import leaderboard
+
+# Referral grafi (referrals jadvali - har bir foydalanuvchida bitta ota) xotiraga ixcham massivlar
+# ko'rinishida yuklanadi va bir necha chiziqli o'tishda tahlil qilinadi: subtree hajmlari, chuqurlik
+# taqsimoti, referrerlar tezligi, shubhali holatlar va refs'ning grafdan qayta hisoblangan qiymati.
+#
+#   python referral_graph.py            # hisobot (DB_PATH yoki DATABASE_URL)
+#   python referral_graph.py --repair   # farq qilgan refs'larni tuzatish
+#
+# Bot ichida: /graph yoki /graph repair (admin).
+
+# Bir referrerdan shuncha soniyalik oynada FRAUD_BURST_THRESHOLD tadan ko'p ro'yxatdan o'tish - shubhali
+FRAUD_BURST_WINDOW = int(os.getenv("FRAUD_BURST_WINDOW", 3600))
+FRAUD_BURST_THRESHOLD = int(os.getenv("FRAUD_BURST_THRESHOLD", 20))
+TOP = 10
+
+_tasks = set()
+
+
+class Graph:
+    # i - foydalanuvchi indeksi (user_id bo'yicha tartiblangan). parent[i] = -1 - referrer yo'q,
+    # edge_at[i] - i ning referral yozuvi vaqti, 0 - noma'lum (created_at ustunidan oldingi yozuvlar).
+    def __init__(self):
+        self.ids = array('q')
+        self.refs = array('q')
+        self.parent = array('q')
+        self.edge_at = array('q')
+        self.skipped = 0
+
+
+def load(users, referrals) -> Graph:
+    # Sinxron: asyncio.to_thread ichida chaqiriladi. users va referrals user_id bo'yicha tartiblangan
+    # generatorlar; avval users to'liq o'qiladi (refs'ni solishtirish uchun muhim - scan() ga qarang).
+    # Ikkalasi ham shu oqimda yopiladi (export._write'dagi kabi).
+    try:
+        return _load(users, referrals)
+    finally:
+        users.close()
+        referrals.close()
+
+
+def _load(users, referrals) -> Graph:
+    g = Graph()
+    for user_id, _, _, refs, _, _ in users:
+        g.ids.append(user_id)
+        g.refs.append(refs or 0)
+    n = len(g.ids)
+    g.parent = array('q', [-1]) * n
+    g.edge_at = array('q', [0]) * n
+    i = 0
+    for user_id, ref_id, created_at in referrals:
+        while i < n and g.ids[i] < user_id:
+            i += 1
+        p = bisect.bisect_left(g.ids, ref_id)
+        if i == n or g.ids[i] != user_id or p == n or g.ids[p] != ref_id:
+            # users o'qilgandan keyin qo'shilgan yozuv
+            g.skipped += 1
+            continue
+        g.parent[i] = p
+        g.edge_at[i] = created_at or 0
+    return g
+
+
+def expected_refs(g: Graph, weights):
+    # add_referral bilan bir xil qoida: yangi referral ota-bobolar zanjiri bo'ylab k-darajadagiga
+    # weights[k] ball beradi; sikl bo'lsa zanjir foydalanuvchining o'zida to'xtaydi va har bir ajdod
+    # bir marta (eng yaqin darajasi bo'yicha) hisoblanadi. Zanjir referral paytidagi holatda olinadi:
+    # ajdodning referral yozuvi undan keyin paydo bo'lgan bo'lsa, zanjir uziladi.
+    # Vaqt noma'lum yoki bir xil soniyada bo'lsa zanjir davom etganmi - aniq emas: keyingi ajdodlar
+    # balli `extra` ga yoziladi. Natija: to'g'ri refs [low[i], low[i] + extra[i]] oralig'ida.
+    n = len(g.ids)
+    parent, edge_at = g.parent, g.edge_at
+    depth = len(weights)
+    low = array('q', [0]) * n
+    extra = array('q', [0]) * n
+    for child in range(n):
+        anc = parent[child]
+        if anc < 0:
+            continue
+        at = edge_at[child]
+        credited = []
+        unsure = False
+        for level in range(depth):
+            if anc not in credited:
+                if unsure:
+                    extra[anc] += weights[level]
+                else:
+                    low[anc] += weights[level]
+                credited.append(anc)
+            nxt = parent[anc]
+            if nxt < 0 or nxt == child:
+                break
+            anc_at = edge_at[anc]
+            if not anc_at or not at or anc_at == at:
+                unsure = True
+            elif anc_at > at:
+                break
+            anc = nxt
+    return low, extra
+
+
+def analyze(g: Graph, weights, burst_window: int = FRAUD_BURST_WINDOW, burst_threshold: int = FRAUD_BURST_THRESHOLD):
+    n = len(g.ids)
+    ids, parent, edge_at = g.ids, g.parent, g.edge_at
+
+    # Bolalar ro'yxati CSR ko'rinishida: kids[start[p]:start[p + 1]] - p ning to'g'ridan-to'g'ri referrallari
+    start = array('q', [0]) * (n + 1)
+    for i in range(n):
+        if parent[i] >= 0:
+            start[parent[i] + 1] += 1
+    for i in range(n):
+        start[i + 1] += start[i]
+    edges = start[n]
+    kids = array('q', [0]) * edges
+    fill = array('q', start)
+    for i in range(n):
+        p = parent[i]
+        if p >= 0:
+            kids[fill[p]] = i
+            fill[p] += 1
+
+    # Ildizlardan BFS: chuqurlik. Ildizdan yetib bo'lmaydigan tugunlar - sikl ichida yoki unga osilgan.
+    depth = array('q', [-1]) * n
+    order = array('q', (i for i in range(n) if parent[i] < 0))
+    for i in order:
+        depth[i] = 0
+    pos = 0
+    while pos < len(order):
+        i = order[pos]
+        pos += 1
+        for k in range(start[i], start[i + 1]):
+            depth[kids[k]] = depth[i] + 1
+            order.append(kids[k])
+    in_cycles = [ids[i] for i in range(n) if depth[i] < 0]
+
+    # Subtree hajmi (o'zi bilan): BFS tartibining teskarisida bolalar otaga qo'shiladi
+    subtree = array('q', [1]) * n
+    for i in reversed(order):
+        if parent[i] >= 0:
+            subtree[parent[i]] += subtree[i]
+
+    # Referrerlar tezligi va portlashlar: har bir referrerning bolalari vaqt oynalari bo'yicha sanaladi
+    velocity, bursts = [], []
+    referrers = 0
+    for p in range(n):
+        lo, hi = start[p], start[p + 1]
+        if lo == hi:
+            continue
+        referrers += 1
+        # Vaqti noma'lum yozuvlar tezlik va portlashlarda hisobga olinmaydi
+        times = [edge_at[kids[k]] for k in range(lo, hi) if edge_at[kids[k]]]
+        if not times:
+            continue
+        first, last = min(times), max(times)
+        days = max((last - first) / 86400, 1)
+        velocity.append((ids[p], len(times), round(len(times) / days, 1)))
+        if len(times) < burst_threshold:
+            continue
+        window, count = Counter(t // burst_window for t in times).most_common(1)[0]
+        if count >= burst_threshold:
+            bursts.append((ids[p], count, window * burst_window))
+
+    # drift - aniq hisoblangan va farq qilgan refs (tuzatiladi). unverified - vaqti noma'lum/bir xil
+    # yozuvlarga bog'liq, qiymat mumkin bo'lgan oraliqdan tashqarida: faqat ko'rsatiladi, tuzatilmaydi.
+    low, extra = expected_refs(g, weights)
+    drift, unverified, uncertain = [], [], 0
+    for i in range(n):
+        refs = g.refs[i]
+        if not extra[i]:
+            if refs != low[i]:
+                drift.append((ids[i], refs, low[i]))
+            continue
+        uncertain += 1
+        if not low[i] <= refs <= low[i] + extra[i]:
+            unverified.append((ids[i], refs, low[i], low[i] + extra[i]))
+
+    roots_with_kids = sum(1 for i in range(n) if parent[i] < 0 and start[i + 1] > start[i])
+    return {
+        "users": n,
+        "referrals": edges,
+        "skipped": g.skipped,
+        "referrers": referrers,
+        "trees": roots_with_kids,
+        "depth": dict(sorted(Counter(depth[i] for i in order).items())),
+        "in_cycles": in_cycles,
+        "largest_trees": heapq.nlargest(
+            TOP, ((ids[i], subtree[i] - 1) for i in range(n) if parent[i] < 0 and subtree[i] > 1),
+            key=lambda row: row[1]
+        ),
+        "largest_subtrees": heapq.nlargest(
+            TOP, ((ids[i], subtree[i] - 1) for i in range(n) if subtree[i] > 1), key=lambda row: row[1]
+        ),
+        "velocity": heapq.nlargest(TOP, velocity, key=lambda row: row[2]),
+        "bursts": sorted(bursts, key=lambda row: row[1], reverse=True),
+        "drift": drift,
+        "uncertain": uncertain,
+        "unverified": unverified,
+    }
+
+
+async def scan(repair: bool = False):
+    # Hisobot; repair=True bo'lsa refs grafdan hisoblangan qiymatga tenglashtiriladi
+    started = time.monotonic()
+    users, referrals = db.stream_users(), db.stream_referrals()
+    g = await asyncio.to_thread(load, users, referrals)
+    report = await asyncio.to_thread(analyze, g, db.REFERRAL_WEIGHTS)
+    report["duplicate_phones"] = await db.get_duplicate_phones()
+    report["repaired"] = None
+    if repair and report["drift"]:
+        # Solishtirish o'qilgan qiymat bo'yicha: skan paytida yangi referral kelgan foydalanuvchilar
+        # o'tkazib yuboriladi (ularning refs'i endi boshqa), keyingi skan ularni tekshiradi
+        changes = await db.repair_refs(report["drift"])
+        report["repaired"] = len(changes)
+        leaderboard.invalidate()
+        logging.warning(f"🛠 refs tuzatildi: {len(changes)} ta foydalanuvchi ({len(report['drift'])} ta farq)")
+    report["seconds"] = round(time.monotonic() - started, 2)
+    return report
+
+
+def render(report) -> str:
+    depth = ", ".join(f"{d}: {count}" for d, count in report["depth"].items())
+    lines = [
+        "🕸 *Referral grafi:*\n",
+        f"👥 Foydalanuvchilar: {report['users']}",
+        f"🔗 Referrallar: {report['referrals']} ({report['referrers']} ta referrer, {report['trees']} ta daraxt)",
+        f"📏 Chuqurlik taqsimoti: {depth}",
+    ]
+    if report["largest_trees"]:
+        lines.append("\n🌳 *Eng katta daraxtlar (ildiz: avlodlar):*")
+        lines += [f"`{uid}`: {size}" for uid, size in report["largest_trees"]]
+    if report["velocity"]:
+        lines.append("\n⚡ *Eng tez referrerlar (jami, kuniga):*")
+        lines += [f"`{uid}`: {count}, {per_day}/kun" for uid, count, per_day in report["velocity"]]
+
+    lines.append("\n🚩 *Shubhali holatlar:*")
+    bursts = report["bursts"]
+    lines.append(f"Bir referrerdan {FRAUD_BURST_WINDOW // 60} daqiqada ≥{FRAUD_BURST_THRESHOLD}: {len(bursts)}")
+    for uid, count, at in bursts[:TOP]:
+        lines.append(f"  `{uid}`: {count} ta, {time.strftime('%d.%m %H:%M', time.gmtime(at))} UTC")
+    dups = report["duplicate_phones"]
+    lines.append(f"Bir nechta akkauntdagi telefonlar: {len(dups)}")
+    for phone, user_ids in dups[:TOP]:
+        lines.append(f"  `{phone}`: {', '.join(str(u) for u in user_ids[:5])}{' ...' if len(user_ids) > 5 else ''}")
+    if report["in_cycles"]:
+        lines.append(f"Sikldagi akkauntlar: {len(report['in_cycles'])} ({', '.join(map(str, report['in_cycles'][:5]))})")
+
+    drift = report["drift"]
+    lines.append(f"\n🧮 refs grafga mos kelmaydi: {len(drift)}")
+    for uid, refs, expected in drift[:5]:
+        lines.append(f"  `{uid}`: {refs} → {expected}")
+    if report["uncertain"]:
+        lines.append(f"❔ Vaqti noma'lum/bir xil referrallarga bog'liq (aniq tekshirib bo'lmaydi): {report['uncertain']}")
+    unverified = report["unverified"]
+    if unverified:
+        lines.append(f"⚠️ Mumkin bo'lgan oraliqdan tashqarida (avtomatik tuzatilmaydi): {len(unverified)}")
+        for uid, refs, lo, hi in unverified[:5]:
+            lines.append(f"  `{uid}`: {refs} ∉ [{lo}, {hi}]")
+    if report["repaired"] is not None:
+        lines.append(f"🛠 Tuzatildi: {report['repaired']}")
+    elif drift:
+        lines.append("Tuzatish: `/graph repair`")
+    lines.append(f"\n⏱ {report['seconds']} s")
+    return "\n".join(lines)
+
+
+async def _run(bot: Bot, chat_id: int, repair: bool):
+    try:
+        report = await scan(repair)
+        await bot.send_message(chat_id, render(report))
+    except Exception as e:
+        logging.exception(f"Referral grafi tahlilida xato: {e}")
+        await bot.send_message(chat_id, "❌ Referral grafini tahlil qilishda xatolik yuz berdi.")
+
+
+def start_scan(bot: Bot, chat_id: int, repair: bool = False):
+    task = asyncio.create_task(_run(bot, chat_id, repair))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def _main(args):
+    await db.init_db(args.db)
+    try:
+        report = await scan(args.repair)
+    finally:
+        await db.close_db()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    print(render(report))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Referral grafi tahlili va refs'ni qayta hisoblash")
+    parser.add_argument("--db", help="SQLite fayli (berilmasa DB_PATH yoki DATABASE_URL)")
+    parser.add_argument("--repair", action="store_true", help="grafga mos kelmagan refs'larni tuzatish")
+    parser.add_argument("--json", help="to'liq hisobotni JSON faylga yozish")
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    asyncio.run(_main(parser.parse_args(sys.argv[1:])))
@@ -0,0 +1,62 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest
+
+import metrics
+
+# Har bir (chat, message_id) uchun oxirgi ko'rsatilgan matn va klaviatura xeshi.
+# Bir xil kontent qayta tahrirlanmaydi: Telegram baribir "message is not modified" qaytaradi.
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", 50000))
+
+_rendered = OrderedDict()
+# Statik klaviaturalarning JSON ko'rinishi bir marta hisoblanadi
+_markup_json = {}
+
+
+def _markup_key(markup):
+    if markup is None:
+        return ""
+    key = id(markup)
+    cached = _markup_json.get(key)
+    if cached is None or cached[0] is not markup:
+        cached = (markup, markup.model_dump_json(exclude_none=True))
+        # Faqat modul darajasidagi (statik) klaviaturalar uchun kesh kichik bo'lib qoladi
+        if len(_markup_json) < 64:
+            _markup_json[key] = cached
+    return cached[1]
+
+
+def _digest(text: str, markup) -> bytes:
+    return hashlib.blake2b(f"{text}\0{_markup_key(markup)}".encode(), digest_size=16).digest()
+
+
+def _remember(key, digest):
+    _rendered[key] = digest
+    _rendered.move_to_end(key)
+    if len(_rendered) > RENDER_CACHE_SIZE:
+        _rendered.popitem(last=False)
+
+
+def remember(message: types.Message, text: str, reply_markup=None):
+    # Yangi yuborilgan xabarning kontenti ham yoziladi, shunda birinchi bosish ham tejaladi
+    _remember((message.chat.id, message.message_id), _digest(text, reply_markup))
+
+
+async def edit_text(message: types.Message, text: str, reply_markup=None) -> bool:
+    key = (message.chat.id, message.message_id)
+    digest = _digest(text, reply_markup)
+    if _rendered.get(key) == digest:
+        _rendered.move_to_end(key)
+        metrics.CACHE.inc("render", "hit")
+        return False
+    metrics.CACHE.inc("render", "miss")
+    try:
+        await message.edit_text(text, reply_markup=reply_markup)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+    _remember(key, digest)
+    return True
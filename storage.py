@@ -0,0 +1,58 @@
+import heapq
+import importlib
+import os
+import random
+
+# Saqlash qatlami: database.py barcha so'rovlarni shu yerda tanlangan backend moduliga uzatadi.
+# Backend - quyidagi INTERFACE'dagi async funksiyalarni (stream_* - sinxron generator) beruvchi modul:
+#   storage_sqlite   - bitta fayl, bitta jarayon (standart)
+#   storage_postgres - DATABASE_URL=postgresql://... bo'lsa; bir nechta bot jarayoni bitta bazada ishlay oladi
+
+# Har bir daraja uchun ball: "1,1" - to'g'ridan-to'g'ri +1, ikkinchi daraja +1.
+# Chuqurlik ro'yxat uzunligiga teng.
+REFERRAL_WEIGHTS = [int(w) for w in os.getenv("REFERRAL_WEIGHTS", "1,1").split(",")]
+REFERRAL_DEPTH = len(REFERRAL_WEIGHTS)
+
+USER_EXPORT_COLUMNS = ("user_id", "username", "phone", "refs", "created_at", "registered_at")
+REFERRAL_EXPORT_COLUMNS = ("user_id", "ref_id", "created_at")
+
+INTERFACE = (
+    "open", "close",
+    "load_channels", "insert_channel", "delete_channel",
+    "load_user", "set_pending_ref", "add_referral", "register_user",
+    "get_user_refs", "get_top_refs", "get_user_rank", "get_all_users", "draw_winners",
+    "get_counters", "get_counter_buckets", "sum_counter_buckets",
+    "get_memberships", "upsert_memberships", "get_state", "set_state",
+    "stream_users", "stream_referrals",
+    "duplicate_phones", "set_refs",
+    "create_broadcast", "set_broadcast_message", "get_broadcast", "get_running_broadcasts",
+    "get_broadcast_batch", "save_broadcast_progress", "finish_broadcast", "cancel_broadcasts",
+    "claim_notifications", "delete_notifications", "retry_notifications",
+)
+
+POSTGRES_SCHEMES = ("postgres://", "postgresql://")
+
+
+def pick_winners(ids, n: int, seed: int, weights=None):
+    # ids: user_id bo'yicha tartiblangan ro'yxat, weights: har biriga mos ball (None - teng ehtimollik).
+    # Natija faqat seed va shu ro'yxatga bog'liq: saqlangan seed bilan tanlovni qayta tekshirish mumkin.
+    rng = random.Random(seed)
+    if weights is None:
+        return rng.sample(ids, min(n, len(ids)))
+    # Efraimidis-Spirakis: kalit u^(1/ball), eng katta n ta kalit - ballarga proporsional tanlov
+    keys = [rng.random() ** (1 / w) for w in weights]
+    return [ids[i] for i in heapq.nlargest(n, range(len(ids)), key=keys.__getitem__)]
+
+
+def select(path: str = None):
+    # -> (backend moduli, ochish uchun manzil). Aniq fayl yo'li berilsa har doim SQLite.
+    url = os.getenv("DATABASE_URL", "")
+    if path is None and url.startswith(POSTGRES_SCHEMES):
+        name, target = "storage_postgres", url
+    else:
+        name, target = "storage_sqlite", path or os.getenv("DB_PATH", "bot_db.sqlite3")
+    backend = importlib.import_module(name)
+    missing = [fn for fn in INTERFACE if not hasattr(backend, fn)]
+    if missing:
+        raise RuntimeError(f"{name} backend'ida yo'q: {', '.join(missing)}")
+    return backend, target
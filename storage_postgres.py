@@ -0,0 +1,644 @@
+import asyncio
+import functools
+import logging
+import os
+import time
+
+import asyncpg
+
+import metrics
+import tracing
+from storage import REFERRAL_DEPTH, REFERRAL_EXPORT_COLUMNS, REFERRAL_WEIGHTS, USER_EXPORT_COLUMNS, pick_winners
+
+# PostgreSQL backend (asyncpg ulanishlar puli). Bir nechta bot jarayoni bitta bazadan foydalana oladi:
+# referral faqat bir marta yoziladi (ON CONFLICT), ballar UPDATE ... SET refs = refs + n bilan
+# atomik oshiriladi, outbox yozuvlari FOR UPDATE SKIP LOCKED bilan jarayonlar o'rtasida bo'linadi.
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 2))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 10))
+# Deadlock yoki serialization xatosida tranzaksiya shuncha marta qayta bajariladi
+DB_TX_RETRIES = int(os.getenv("DB_TX_RETRIES", 3))
+
+_pool = None
+_loop = None
+
+
+def _timed(fn):
+    # Har bir so'rov vaqti /metrics va kuzatuv (tracing) span'iga yoziladi
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        if _pool is None:
+            raise RuntimeError("Ma'lumotlar bazasi ochilmagan: avval init_db() chaqiring")
+        start = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            metrics.DB_SECONDS.observe(time.perf_counter() - start, fn.__name__)
+            tracing.record("db", fn.__name__, start)
+    return wrapper
+
+
+def _transactional(fn):
+    # fn(conn, ...) bitta tranzaksiyada bajariladi; deadlock bo'lsa boshidan qayta urinadi
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        for attempt in range(DB_TX_RETRIES + 1):
+            async with _pool.acquire() as conn:
+                try:
+                    async with conn.transaction():
+                        return await fn(conn, *args, **kwargs)
+                except (asyncpg.DeadlockDetectedError, asyncpg.SerializationError) as e:
+                    if attempt >= DB_TX_RETRIES:
+                        raise
+                    logging.warning(f"⚠️ {fn.__name__}: {type(e).__name__}, qayta urinish")
+                    await asyncio.sleep(0.01 * 2 ** attempt)
+    return wrapper
+
+
+# --- SXEMA ---
+# Migratsiyalar schema_version jadvalida hisoblanadi. Bir vaqtda ishga tushgan jarayonlar
+# advisory lock orqali navbat bilan kutadi.
+
+_BUMP_COUNTER = '''
+    CREATE OR REPLACE FUNCTION bump_counter() RETURNS trigger AS $$
+    BEGIN
+        -- TG_ARGV: nom, o'zgarish, soatlik qatorga yozilsinmi
+        UPDATE counters SET value = value + TG_ARGV[1]::int WHERE name = TG_ARGV[0];
+        IF TG_ARGV[2]::boolean THEN
+            INSERT INTO counter_buckets (name, bucket, value)
+            VALUES (TG_ARGV[0], (extract(epoch FROM now())::bigint / 3600) * 3600, TG_ARGV[1]::int)
+            ON CONFLICT (name, bucket) DO UPDATE SET value = counter_buckets.value + excluded.value;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+'''
+
+
+async def _initial_schema(conn):
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS channels (
+            id SERIAL PRIMARY KEY,
+            username TEXT UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            phone TEXT,
+            refs INTEGER NOT NULL DEFAULT 0,
+            pending_ref_id BIGINT,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            created_at BIGINT,
+            registered_at BIGINT
+        );
+        CREATE TABLE IF NOT EXISTS referrals (
+            user_id BIGINT PRIMARY KEY REFERENCES users(user_id),
+            ref_id BIGINT NOT NULL REFERENCES users(user_id),
+            created_at BIGINT
+        );
+        CREATE INDEX IF NOT EXISTS idx_users_refs ON users(refs);
+        CREATE INDEX IF NOT EXISTS idx_users_phone ON users(phone);
+        CREATE INDEX IF NOT EXISTS idx_referrals_ref_id ON referrals(ref_id);
+        CREATE TABLE IF NOT EXISTS memberships (
+            user_id BIGINT,
+            channel TEXT,
+            status TEXT,
+            updated_at BIGINT,
+            PRIMARY KEY (user_id, channel)
+        );
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id SERIAL PRIMARY KEY,
+            text TEXT,
+            admin_chat_id BIGINT,
+            progress_message_id BIGINT,
+            last_user_id BIGINT DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            status TEXT DEFAULT 'running',
+            created_at BIGINT
+        );
+        -- bir nechta jarayon bo'lsa ham bir vaqtda faqat bitta broadcast 'running'
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_broadcasts_running ON broadcasts(status) WHERE status = 'running';
+        CREATE TABLE IF NOT EXISTS bot_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS draws (
+            id SERIAL PRIMARY KEY,
+            seed BIGINT,
+            n INTEGER,
+            weighted INTEGER,
+            winners TEXT,
+            created_at BIGINT
+        );
+        CREATE TABLE IF NOT EXISTS outbox (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            kind TEXT NOT NULL,
+            points INTEGER NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at BIGINT NOT NULL DEFAULT 0,
+            created_at BIGINT
+        );
+        CREATE INDEX IF NOT EXISTS idx_outbox_next_attempt ON outbox(next_attempt_at);
+    ''')
+
+
+async def _counters(conn):
+    # /stats uchun hisoblagichlar: SQLite'dagi kabi triggerlar bilan o'sha tranzaksiyada yangilanadi
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value BIGINT NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS counter_buckets (
+            name TEXT,
+            bucket BIGINT,
+            value BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (name, bucket)
+        );
+        INSERT INTO counters (name, value) VALUES
+            ('users', (SELECT COUNT(*) FROM users)),
+            ('registered', (SELECT COUNT(*) FROM users WHERE phone IS NOT NULL)),
+            ('referrals', (SELECT COUNT(*) FROM referrals)),
+            ('channels', (SELECT COUNT(*) FROM channels))
+        ON CONFLICT (name) DO UPDATE SET value = excluded.value;
+    ''')
+    await conn.execute(_BUMP_COUNTER)
+    for name, table, event, when, args in (
+        ("trg_users_insert", "users", "INSERT", "", "'users', '1', 'true'"),
+        ("trg_users_registered", "users", "UPDATE OF phone",
+         "WHEN (OLD.phone IS NULL AND NEW.phone IS NOT NULL)", "'registered', '1', 'true'"),
+        ("trg_referrals_insert", "referrals", "INSERT", "", "'referrals', '1', 'true'"),
+        ("trg_channels_insert", "channels", "INSERT", "", "'channels', '1', 'false'"),
+        ("trg_channels_delete", "channels", "DELETE", "", "'channels', '-1', 'false'"),
+    ):
+        # DEFERRED: counters qatori commit paytida, boshqa qulflardan keyin olinadi. Aks holda
+        # register_user (o'z qatori -> counters) va ajdodlarni yangilayotgan tranzaksiya
+        # (counters -> ajdod qatori) bir-birini kutib deadlock bo'ladi
+        await conn.execute(f"DROP TRIGGER IF EXISTS {name} ON {table}")
+        await conn.execute(
+            f"CREATE CONSTRAINT TRIGGER {name} AFTER {event} ON {table} "
+            f"DEFERRABLE INITIALLY DEFERRED FOR EACH ROW {when} "
+            f"EXECUTE FUNCTION bump_counter({args})"
+        )
+
+
+async def _lowercase_channels(conn):
+    # Kanal nomlari kichik harfga (SQLite migratsiyasi bilan bir xil); takrorlardan eng yangi a'zolik qoladi
+    await conn.execute('''
+        DELETE FROM channels c USING channels d WHERE lower(d.username) = lower(c.username) AND d.id < c.id;
+        UPDATE channels SET username = lower(username) WHERE username <> lower(username);
+        DELETE FROM memberships m USING memberships x
+        WHERE x.user_id = m.user_id AND lower(x.channel) = lower(m.channel)
+          AND (x.updated_at, x.channel) > (m.updated_at, m.channel);
+        UPDATE memberships SET channel = lower(channel) WHERE channel <> lower(channel);
+    ''')
+
+
+MIGRATIONS = [
+    _initial_schema,
+    _counters,
+    _lowercase_channels,
+]
+
+
+async def _migrate(conn):
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock(hashtext('bot_schema'))")
+        await conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+        version = await conn.fetchval("SELECT version FROM schema_version")
+        if version is None:
+            version = 0
+            await conn.execute("INSERT INTO schema_version (version) VALUES (0)")
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            await migration(conn)
+            await conn.execute("UPDATE schema_version SET version = $1", number)
+            logging.info(f"🗄️ Migratsiya {number} bajarildi: {migration.__name__}")
+
+
+async def open(url: str):
+    global _pool, _loop
+    _loop = asyncio.get_running_loop()
+    _pool = await asyncpg.create_pool(url, min_size=DB_POOL_MIN, max_size=DB_POOL_MAX)
+    async with _pool.acquire() as conn:
+        await _migrate(conn)
+
+
+async def close():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+# --- KANALLAR ---
+
+@_timed
+async def load_channels():
+    return [row[0] for row in await _pool.fetch("SELECT username FROM channels")]
+
+
+@_timed
+async def insert_channel(username: str):
+    status = await _pool.execute(
+        "INSERT INTO channels (username) VALUES ($1) ON CONFLICT (username) DO NOTHING", username
+    )
+    return status.endswith(" 1")
+
+
+@_timed
+async def delete_channel(username: str):
+    await _pool.execute("DELETE FROM channels WHERE username=$1", username)
+
+
+# --- FOYDALANUVCHILAR VA REFERRALLAR ---
+
+@_timed
+async def load_user(user_id: int, username: str = None):
+    # (username, phone, refs, pending_ref_id, has_referral); odatiy holatda bitta SELECT
+    row = await _pool.fetchrow(
+        "SELECT u.username, u.phone, u.refs, u.pending_ref_id, "
+        "EXISTS(SELECT 1 FROM referrals r WHERE r.user_id = u.user_id), u.blocked "
+        "FROM users u WHERE u.user_id=$1", user_id
+    )
+    if row is None:
+        await _pool.execute(
+            "INSERT INTO users (user_id, username, refs, created_at) VALUES ($1,$2,0,$3) "
+            "ON CONFLICT (user_id) DO NOTHING",
+            user_id, username, int(time.time())
+        )
+        return username, None, 0, None, False
+    if row[5]:
+        # Foydalanuvchi yana yozdi - demak botni blokdan chiqargan
+        await _pool.execute("UPDATE users SET blocked=0 WHERE user_id=$1", user_id)
+    if username and username != row[0]:
+        await _pool.execute("UPDATE users SET username=$1 WHERE user_id=$2", username, user_id)
+    else:
+        username = row[0]
+    return username, row[1], row[2] or 0, row[3], row[4]
+
+
+@_timed
+async def set_pending_ref(user_id: int, ref_id: int):
+    await _pool.execute("UPDATE users SET pending_ref_id = $1 WHERE user_id=$2", ref_id, user_id)
+
+
+# Ajdodlar zanjiri va har biriga beriladigan ball; UPDATE ... FROM bilan bitta so'rovda
+# oshiriladi va yangi qiymatlar RETURNING bilan qaytadi (parallel yozuvlarda ham ball yo'qolmaydi)
+_CREDIT_SQL = '''
+    WITH RECURSIVE
+        chain(user_id, level) AS (
+            SELECT $1::bigint, 1
+            UNION ALL
+            SELECT r.ref_id, c.level + 1 FROM chain c JOIN referrals r ON r.user_id = c.user_id
+            WHERE c.level < $2 AND r.ref_id != $5
+        ),
+        weights(level, points) AS (SELECT * FROM unnest($3::int[], $4::int[])),
+        -- Sikl bo'lsa zanjir yangi foydalanuvchida to'xtaydi, har bir ajdod eng yaqin darajasi bo'yicha bir marta
+        credit(user_id, points) AS (
+            SELECT c.user_id, w.points FROM (SELECT user_id, MIN(level) AS level FROM chain GROUP BY user_id) c
+            JOIN weights w ON w.level = c.level
+        )
+    UPDATE users SET refs = users.refs + credit.points FROM credit
+    WHERE users.user_id = credit.user_id
+    RETURNING users.user_id, users.refs
+'''
+_LEVELS = list(range(1, REFERRAL_DEPTH + 1))
+
+
+async def _add_referral(conn, user_id: int, ref_id: int):
+    # Chaqiruvchi tranzaksiya ichida bo'lishi kerak.
+    # Referral qo'shilmasa None, aks holda ball olganlar [(user_id, yangi_refs), ...] qaytadi.
+    if user_id == ref_id:
+        return None
+    # Mavjud bo'lmagan referrer (soxta /start parametri) hisobga olinmaydi
+    if not await conn.fetchval("SELECT 1 FROM users WHERE user_id=$1", ref_id):
+        return None
+    # Referral faqat bir marta yoziladi: boshqa jarayon oldinroq yozgan bo'lsa ball qayta berilmaydi
+    status = await conn.execute(
+        "INSERT INTO referrals (user_id, ref_id, created_at) VALUES ($1,$2,$3) ON CONFLICT (user_id) DO NOTHING",
+        user_id, ref_id, int(time.time())
+    )
+    if status.endswith(" 0"):
+        return None
+    changes = await conn.fetch(_CREDIT_SQL, ref_id, REFERRAL_DEPTH, _LEVELS, REFERRAL_WEIGHTS, user_id)
+    # Referrerga bildirishnoma shu tranzaksiyada outbox'ga yoziladi: crash bo'lsa ham yo'qolmaydi
+    await conn.execute(
+        "INSERT INTO outbox (user_id, kind, points, created_at) VALUES ($1, 'referral', $2, $3)",
+        ref_id, REFERRAL_WEIGHTS[0], int(time.time())
+    )
+    return [tuple(row) for row in changes]
+
+
+@_timed
+@_transactional
+async def add_referral(conn, user_id: int, ref_id: int):
+    return await _add_referral(conn, user_id, ref_id)
+
+
+@_timed
+@_transactional
+async def register_user(conn, user_id: int, phone: str):
+    # Telefon saqlanadi va kutilayotgan referral shu tranzaksiyada hisoblanadi -> (ref_id, changes).
+    # FOR UPDATE: bir foydalanuvchining ikki parallel kontakti ketma-ket bajariladi.
+    row = await conn.fetchrow(
+        "SELECT phone, pending_ref_id FROM users WHERE user_id=$1 FOR UPDATE", user_id
+    )
+    await conn.execute(
+        "UPDATE users SET phone=$1, registered_at=COALESCE(registered_at, $2) WHERE user_id=$3",
+        phone, int(time.time()), user_id
+    )
+    if not row or row[0] or not row[1]:
+        return None, None
+    ref_id = row[1]
+    changes = await _add_referral(conn, user_id, ref_id)
+    if changes is None:
+        return None, None
+    await conn.execute("UPDATE users SET pending_ref_id = NULL WHERE user_id=$1", user_id)
+    return ref_id, changes
+
+
+@_timed
+async def get_user_refs(user_id: int):
+    return await _pool.fetchval("SELECT refs FROM users WHERE user_id=$1", user_id) or 0
+
+
+@_timed
+async def get_top_refs(limit=10):
+    # Teng ballilar SQLite'dagidek (indeks teskari o'qilganda) user_id kamayishi bo'yicha
+    rows = await _pool.fetch(
+        "SELECT user_id, username, phone, refs FROM users ORDER BY refs DESC, user_id DESC LIMIT $1", limit
+    )
+    return [tuple(row) for row in rows]
+
+
+@_timed
+async def get_user_rank(refs: int):
+    # Bir xil balldagilar bir xil o'rinni oladi; faqat yuqoridagi indeks yozuvlari sanaladi
+    return await _pool.fetchval("SELECT COUNT(*) FROM users WHERE refs > $1", refs) + 1
+
+
+@_timed
+async def get_all_users():
+    rows = await _pool.fetch("SELECT user_id, username, phone, refs FROM users ORDER BY user_id")
+    return [tuple(row) for row in rows]
+
+
+@_timed
+async def draw_winners(n: int, seed: int, weighted: bool = False):
+    # Faqat id'lar (og'irlikli tanlovda ballar ham) olinadi, tanlov storage.pick_winners'da;
+    # to'liq qatorlar faqat g'oliblar uchun. Seed g'oliblar bilan birga saqlanadi.
+    if weighted:
+        rows = await _pool.fetch(
+            "SELECT user_id, refs FROM users WHERE phone IS NOT NULL AND refs > 0 ORDER BY user_id"
+        )
+        ids = pick_winners([row[0] for row in rows], n, seed, [row[1] for row in rows])
+    else:
+        rows = await _pool.fetch("SELECT user_id FROM users WHERE phone IS NOT NULL ORDER BY user_id")
+        ids = pick_winners([row[0] for row in rows], n, seed)
+    rows = {row[0]: tuple(row) for row in await _pool.fetch(
+        "SELECT user_id, username, phone, refs FROM users WHERE user_id = ANY($1::bigint[])", ids
+    )}
+    winners = [rows[user_id] for user_id in ids]
+    await _pool.execute(
+        "INSERT INTO draws (seed, n, weighted, winners, created_at) VALUES ($1,$2,$3,$4,$5)",
+        seed, n, int(weighted), ",".join(str(row[0]) for row in winners), int(time.time())
+    )
+    return winners
+
+
+# --- STATISTIKA ---
+
+@_timed
+async def get_counters():
+    return {row[0]: row[1] for row in await _pool.fetch("SELECT name, value FROM counters")}
+
+
+@_timed
+async def get_counter_buckets(start: int):
+    rows = await _pool.fetch("SELECT name, bucket, value FROM counter_buckets WHERE bucket >= $1", start)
+    return [tuple(row) for row in rows]
+
+
+@_timed
+async def sum_counter_buckets(name: str, bucket_seconds: int, start: int):
+    rows = await _pool.fetch(
+        "SELECT (bucket / $1) * $1, SUM(value)::bigint FROM counter_buckets WHERE name = $2 AND bucket >= $3 GROUP BY 1",
+        bucket_seconds, name, start
+    )
+    return {row[0]: row[1] for row in rows}
+
+
+# --- A'ZOLIK INDEKSI ---
+
+@_timed
+async def get_memberships(user_id: int, channels):
+    rows = await _pool.fetch(
+        "SELECT channel, status FROM memberships WHERE user_id=$1 AND channel = ANY($2::text[])",
+        user_id, list(channels)
+    )
+    return {row[0]: row[1] for row in rows}
+
+
+@_timed
+async def upsert_memberships(rows):
+    # rows: (user_id, channel, status, updated_at); eski hodisa yangisini bosib ketmaydi.
+    # Chiqib ketgan, lekin referral sifatida hisoblangan foydalanuvchilar ro'yxati qaytadi.
+    async with _pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.executemany(
+                "INSERT INTO memberships (user_id, channel, status, updated_at) VALUES ($1,$2,$3,$4) "
+                "ON CONFLICT (user_id, channel) DO UPDATE SET status=excluded.status, updated_at=excluded.updated_at "
+                "WHERE excluded.updated_at >= memberships.updated_at",
+                rows
+            )
+        left = list({row[0] for row in rows if row[2] in ('left', 'kicked')})
+        if not left:
+            return []
+        return [row[0] for row in await conn.fetch(
+            "SELECT user_id FROM referrals WHERE user_id = ANY($1::bigint[])", left
+        )]
+
+
+@_timed
+async def get_state(key: str, default=None):
+    value = await _pool.fetchval("SELECT value FROM bot_state WHERE key=$1", key)
+    return default if value is None else value
+
+
+@_timed
+async def set_state(key: str, value):
+    await _pool.execute(
+        "INSERT INTO bot_state (key, value) VALUES ($1,$2) ON CONFLICT (key) DO UPDATE SET value=excluded.value",
+        key, str(value)
+    )
+
+
+# --- EKSPORT ---
+# SQLite'dagi kabi sinxron generator (asyncio.to_thread ichida iste'mol qilinadi): har bir partiya
+# event loop'dagi server-side cursor'dan run_coroutine_threadsafe orqali olinadi.
+
+def _stream(sql: str, params=(), batch: int = 1000):
+    def call(coro):
+        return asyncio.run_coroutine_threadsafe(coro, _loop).result()
+
+    async def start():
+        conn = await _pool.acquire()
+        tx = conn.transaction(readonly=True)
+        await tx.start()
+        return conn, tx, await conn.cursor(sql, *params)
+
+    async def finish(conn, tx):
+        try:
+            await tx.rollback()
+        finally:
+            await _pool.release(conn)
+
+    conn, tx, cursor = call(start())
+    try:
+        while True:
+            rows = call(cursor.fetch(batch))
+            if not rows:
+                break
+            for row in rows:
+                yield tuple(row)
+    finally:
+        # Iste'molchi generatorni o'z oqimida yopishi kerak (export._write). Baribir event loop'da
+        # yopilsa (GC), .result() loop'ni abadiy kutadi - shuning uchun yopish fonga qo'yiladi
+        try:
+            on_loop = asyncio.get_running_loop() is _loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            _loop.create_task(finish(conn, tx))
+        else:
+            call(finish(conn, tx))
+
+
+def stream_users(registered_only: bool = False, min_refs: int = 0):
+    sql = f"SELECT {', '.join(USER_EXPORT_COLUMNS)} FROM users WHERE refs >= $1"
+    if registered_only:
+        sql += " AND phone IS NOT NULL"
+    return _stream(sql + " ORDER BY user_id", (min_refs,))
+
+
+def stream_referrals():
+    return _stream(f"SELECT {', '.join(REFERRAL_EXPORT_COLUMNS)} FROM referrals ORDER BY user_id")
+
+
+# --- REFERRAL GRAFI ---
+
+@_timed
+async def duplicate_phones(limit: int):
+    rows = await _pool.fetch(
+        "SELECT phone, array_agg(user_id ORDER BY user_id) FROM users WHERE phone IS NOT NULL "
+        "GROUP BY phone HAVING COUNT(*) > 1 ORDER BY COUNT(*) DESC LIMIT $1", limit
+    )
+    return [(row[0], list(row[1])) for row in rows]
+
+
+@_timed
+async def set_refs(rows):
+    # rows: (user_id, eski_refs, yangi_refs); o'qilgandan keyin o'zgargan qiymatlar yozilmaydi
+    if not rows:
+        return []
+    user_ids, old, new = (list(col) for col in zip(*rows))
+    changed = await _pool.fetch(
+        "UPDATE users u SET refs = v.new FROM unnest($1::bigint[], $2::int[], $3::int[]) AS v(user_id, old, new) "
+        "WHERE u.user_id = v.user_id AND u.refs = v.old RETURNING u.user_id, u.refs",
+        user_ids, old, new
+    )
+    return [tuple(row) for row in changed]
+
+
+# --- BROADCAST ---
+
+@_timed
+async def create_broadcast(text: str, admin_chat_id: int):
+    # Boshqa broadcast 'running' bo'lsa (idx_broadcasts_running) None qaytadi
+    return await _pool.fetchval(
+        "INSERT INTO broadcasts (text, admin_chat_id, created_at) VALUES ($1,$2,$3) "
+        "ON CONFLICT (status) WHERE status = 'running' DO NOTHING RETURNING id",
+        text, admin_chat_id, int(time.time())
+    )
+
+
+@_timed
+async def set_broadcast_message(broadcast_id: int, message_id: int):
+    await _pool.execute("UPDATE broadcasts SET progress_message_id=$1 WHERE id=$2", message_id, broadcast_id)
+
+
+@_timed
+async def get_broadcast(broadcast_id: int):
+    row = await _pool.fetchrow(
+        "SELECT id, text, admin_chat_id, progress_message_id, last_user_id, sent, failed, blocked, status "
+        "FROM broadcasts WHERE id=$1", broadcast_id
+    )
+    return tuple(row) if row else None
+
+
+@_timed
+async def get_running_broadcasts():
+    return [row[0] for row in await _pool.fetch("SELECT id FROM broadcasts WHERE status='running' ORDER BY id")]
+
+
+@_timed
+async def get_broadcast_batch(after_user_id: int, limit: int):
+    # Keyset pagination: user_id bo'yicha navbatdagi sahifa, bloklaganlar o'tkazib yuboriladi
+    return [row[0] for row in await _pool.fetch(
+        "SELECT user_id FROM users WHERE user_id > $1 AND blocked = 0 ORDER BY user_id LIMIT $2",
+        after_user_id, limit
+    )]
+
+
+@_timed
+async def save_broadcast_progress(broadcast_id: int, last_user_id: int, sent: int, failed: int, blocked_ids):
+    async with _pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(
+                "UPDATE broadcasts SET last_user_id=$1, sent=sent+$2, failed=failed+$3, blocked=blocked+$4 WHERE id=$5",
+                last_user_id, sent, failed, len(blocked_ids), broadcast_id
+            )
+            if blocked_ids:
+                await conn.execute("UPDATE users SET blocked=1 WHERE user_id = ANY($1::bigint[])", list(blocked_ids))
+
+
+@_timed
+async def finish_broadcast(broadcast_id: int):
+    # Bekor qilingan broadcast 'done' bilan ustidan yozilmaydi
+    await _pool.execute("UPDATE broadcasts SET status='done' WHERE id=$1 AND status='running'", broadcast_id)
+
+
+@_timed
+async def cancel_broadcasts():
+    rows = await _pool.fetch("UPDATE broadcasts SET status='cancelled' WHERE status='running' RETURNING id")
+    return [row[0] for row in rows]
+
+
+# --- OUTBOX ---
+
+@_timed
+async def claim_notifications(limit: int, lease: int):
+    # SKIP LOCKED: parallel dispatcherlar bir xil yozuvni olmaydi; `lease` o'tgach qayta yuboriladi
+    now = int(time.time())
+    rows = await _pool.fetch(
+        "UPDATE outbox SET next_attempt_at = $1 WHERE id IN "
+        "(SELECT id FROM outbox WHERE next_attempt_at <= $2 ORDER BY id LIMIT $3 FOR UPDATE SKIP LOCKED) "
+        "RETURNING id, user_id, kind, points, attempts",
+        now + lease, now, limit
+    )
+    return [tuple(row) for row in rows]
+
+
+@_timed
+async def delete_notifications(ids):
+    await _pool.execute("DELETE FROM outbox WHERE id = ANY($1::bigint[])", list(ids))
+
+
+@_timed
+async def retry_notifications(ids, delay: int):
+    await _pool.execute(
+        "UPDATE outbox SET attempts = attempts + 1, next_attempt_at = $1 WHERE id = ANY($2::bigint[])",
+        int(time.time()) + delay, list(ids)
+    )
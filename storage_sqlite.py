@@ -0,0 +1,511 @@
+import asyncio
+import functools
+import random
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import tracing
+from migrations import migrate
+from storage import REFERRAL_DEPTH, REFERRAL_EXPORT_COLUMNS, REFERRAL_WEIGHTS, USER_EXPORT_COLUMNS, pick_winners
+
+# Bitta uzoq yashovchi ulanish va unga xizmat qiluvchi bitta oqim.
+# SQLite yozuvlarni baribir ketma-ket bajaradi, shuning uchun bitta oqim
+# lock raqobatisiz barcha so'rovlarni navbat bilan bajaradi va event loop bloklanmaydi.
+_executor = None
+_conn = None
+_path = None
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=134217728",
+    "PRAGMA busy_timeout=5000",
+)
+
+
+def _threaded(fn):
+    # Sinxron funksiyani DB oqimida bajaradigan async funksiyaga aylantiradi
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        if _executor is None:
+            raise RuntimeError("Ma'lumotlar bazasi ochilmagan: avval init_db() chaqiring")
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            return await loop.run_in_executor(_executor, _timed, fn.__name__, functools.partial(fn, *args, **kwargs))
+        finally:
+            # Span DB oqimi navbatida kutishni ham o'z ichiga oladi
+            tracing.record("db", fn.__name__, start)
+    return wrapper
+
+
+def _timed(name: str, call):
+    # DB oqimida bajariladi: navbatda kutish emas, faqat so'rovning o'zi o'lchanadi
+    start = time.perf_counter()
+    try:
+        return call()
+    finally:
+        metrics.DB_SECONDS.observe(time.perf_counter() - start, name)
+
+
+def _connect(path: str):
+    global _conn, _path
+    _path = path
+    # cached_statements - tayyorlangan (prepared) so'rovlar keshi hajmi.
+    # IMMEDIATE: yozuv tranzaksiyalari boshidanoq write-lock oladi, shuning uchun bir nechta jarayon
+    # bitta faylda ishlaganda SQLITE_BUSY_SNAPSHOT o'rniga busy_timeout bo'yicha navbat kutiladi.
+    _conn = sqlite3.connect(path, check_same_thread=False, cached_statements=256, isolation_level="IMMEDIATE")
+    for pragma in PRAGMAS:
+        _conn.execute(pragma)
+    migrate(_conn)
+    _conn.execute("PRAGMA foreign_keys=ON")
+
+
+def _close():
+    global _conn
+    if _conn is not None:
+        _conn.execute("PRAGMA optimize")
+        _conn.close()
+        _conn = None
+
+
+async def open(path: str):
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_executor, _connect, path)
+
+
+async def close():
+    global _executor
+    if _executor is None:
+        return
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_executor, _close)
+    _executor.shutdown(wait=True)
+    _executor = None
+
+
+# --- KANALLAR ---
+
+@_threaded
+def load_channels():
+    return [row[0] for row in _conn.execute("SELECT username FROM channels")]
+
+
+@_threaded
+def insert_channel(username: str):
+    try:
+        with _conn:
+            _conn.execute("INSERT INTO channels (username) VALUES (?)", (username,))
+        return True
+    except sqlite3.IntegrityError:
+        return False
+
+
+@_threaded
+def delete_channel(username: str):
+    with _conn:
+        _conn.execute("DELETE FROM channels WHERE username=?", (username,))
+
+
+# --- FOYDALANUVCHILAR VA REFERRALLAR ---
+
+@_threaded
+def load_user(user_id: int, username: str = None):
+    # (username, phone, refs, pending_ref_id, has_referral); yangi foydalanuvchi shu yerda yaratiladi
+    row = _conn.execute(
+        "SELECT u.username, u.phone, u.refs, u.pending_ref_id, "
+        "EXISTS(SELECT 1 FROM referrals r WHERE r.user_id = u.user_id), u.blocked "
+        "FROM users u WHERE u.user_id=?", (user_id,)
+    ).fetchone()
+    if row is None:
+        with _conn:
+            _conn.execute(
+                "INSERT OR IGNORE INTO users (user_id, username, refs, created_at) VALUES (?,?,0,?)",
+                (user_id, username, int(time.time()))
+            )
+        return username, None, 0, None, False
+    if row[5]:
+        # Foydalanuvchi yana yozdi - demak botni blokdan chiqargan
+        with _conn:
+            _conn.execute("UPDATE users SET blocked=0 WHERE user_id=?", (user_id,))
+    if username and username != row[0]:
+        with _conn:
+            _conn.execute("UPDATE users SET username=? WHERE user_id=?", (username, user_id))
+    else:
+        username = row[0]
+    return username, row[1], row[2] or 0, row[3], bool(row[4])
+
+
+@_threaded
+def set_pending_ref(user_id: int, ref_id: int):
+    with _conn:
+        _conn.execute("UPDATE users SET pending_ref_id = ? WHERE user_id=?", (ref_id, user_id))
+
+
+_weight_params = [x for level, points in enumerate(REFERRAL_WEIGHTS, 1) for x in (level, points)]
+
+_CREDIT_SQL = f'''
+    WITH RECURSIVE
+        chain(user_id, level) AS (
+            SELECT ?, 1
+            UNION ALL
+            SELECT r.ref_id, c.level + 1 FROM chain c JOIN referrals r ON r.user_id = c.user_id
+            WHERE c.level < ? AND r.ref_id != ?
+        ),
+        weights(level, points) AS (VALUES {", ".join(["(?, ?)"] * REFERRAL_DEPTH)}),
+        credit(user_id, points) AS (
+            SELECT c.user_id, w.points FROM (SELECT user_id, MIN(level) AS level FROM chain GROUP BY user_id) c
+            JOIN weights w ON w.level = c.level
+        )
+    UPDATE users SET refs = refs + (SELECT points FROM credit WHERE credit.user_id = users.user_id)
+    WHERE user_id IN (SELECT user_id FROM credit)
+    RETURNING user_id, refs
+'''
+
+
+def _add_referral(user_id: int, ref_id: int):
+    # Chaqiruvchi tranzaksiya ichida bo'lishi kerak.
+    # Referral qo'shilmasa None, aks holda ball olganlar [(user_id, yangi_refs), ...] qaytadi.
+    if user_id == ref_id:
+        return None
+    # Mavjud bo'lmagan referrer (soxta /start parametri) hisobga olinmaydi
+    if not _conn.execute("SELECT 1 FROM users WHERE user_id=?", (ref_id,)).fetchone():
+        return None
+
+    # Referral faqat bir marta yoziladi: boshqa jarayon oldinroq yozgan bo'lsa ball qayta berilmaydi
+    cur = _conn.execute(
+        "INSERT INTO referrals (user_id, ref_id, created_at) VALUES (?,?,?) ON CONFLICT(user_id) DO NOTHING",
+        (user_id, ref_id, int(time.time()))
+    )
+    if cur.rowcount == 0:
+        return None
+
+    # Barcha ajdodlar bitta rekursiv CTE orqali topiladi va bitta UPDATE bilan ball oladi.
+    # Sikl bo'lsa (A -> B -> A) zanjir yangi foydalanuvchida to'xtaydi, har bir ajdod faqat
+    # eng yaqin darajasi bo'yicha bir marta ball oladi.
+    changes = _conn.execute(_CREDIT_SQL, (ref_id, REFERRAL_DEPTH, user_id, *_weight_params)).fetchall()
+    # Referrerga bildirishnoma shu tranzaksiyada outbox'ga yoziladi: crash bo'lsa ham yo'qolmaydi
+    _conn.execute(
+        "INSERT INTO outbox (user_id, kind, points, created_at) VALUES (?, 'referral', ?, ?)",
+        (ref_id, REFERRAL_WEIGHTS[0], int(time.time()))
+    )
+    return changes
+
+
+@_threaded
+def add_referral(user_id: int, ref_id: int):
+    with _conn:
+        return _add_referral(user_id, ref_id)
+
+
+@_threaded
+def register_user(user_id: int, phone: str):
+    # Telefon saqlanadi va kutilayotgan referral shu tranzaksiyada hisoblanadi -> (ref_id, changes)
+    with _conn:
+        row = _conn.execute("SELECT phone, pending_ref_id FROM users WHERE user_id=?", (user_id,)).fetchone()
+        _conn.execute(
+            "UPDATE users SET phone=?, registered_at=COALESCE(registered_at, ?) WHERE user_id=?",
+            (phone, int(time.time()), user_id)
+        )
+        if not row or row[0] or not row[1]:
+            return None, None
+        ref_id = row[1]
+        changes = _add_referral(user_id, ref_id)
+        if changes is None:
+            return None, None
+        _conn.execute("UPDATE users SET pending_ref_id = NULL WHERE user_id=?", (user_id,))
+    return ref_id, changes
+
+
+@_threaded
+def get_user_refs(user_id: int):
+    res = _conn.execute("SELECT refs FROM users WHERE user_id=?", (user_id,)).fetchone()
+    return res[0] if res else 0
+
+
+@_threaded
+def get_top_refs(limit=10):
+    return _conn.execute(
+        "SELECT user_id, username, phone, refs FROM users ORDER BY refs DESC LIMIT ?", (limit,)
+    ).fetchall()
+
+
+@_threaded
+def get_user_rank(refs: int):
+    # Bir xil balldagilar bir xil o'rinni oladi; faqat yuqoridagi indeks yozuvlari sanaladi
+    return _conn.execute("SELECT COUNT(*) FROM users WHERE refs > ?", (refs,)).fetchone()[0] + 1
+
+
+@_threaded
+def get_all_users():
+    return _conn.execute("SELECT user_id, username, phone, refs FROM users ORDER BY user_id").fetchall()
+
+
+# Shu sondan kam g'olib uchun id'lar Python'ga o'qilmaydi: har biri indeksdagi tasodifiy o'rindan olinadi
+DRAW_OFFSET_MAX = 20
+
+
+@_threaded
+def draw_winners(n: int, seed: int, weighted: bool = False):
+    # Tekis tanlov idx_users_phone indeksida: kam g'olibda tasodifiy OFFSET'lar (indeks C'da aylanadi),
+    # ko'pida faqat id'lar o'qiladi. Og'irlikli tanlov refs > 0 qatorlarni to'liq ko'radi.
+    # To'liq qatorlar faqat g'oliblar uchun olinadi; seed g'oliblar bilan birga saqlanadi.
+    if weighted:
+        rows = _conn.execute(
+            "SELECT user_id, refs FROM users WHERE phone IS NOT NULL AND refs > 0 ORDER BY user_id"
+        ).fetchall()
+        ids = pick_winners([row[0] for row in rows], n, seed, [row[1] for row in rows])
+    elif n <= DRAW_OFFSET_MAX:
+        count = _conn.execute("SELECT COUNT(*) FROM users WHERE phone IS NOT NULL").fetchone()[0]
+        ids = []
+        for offset in random.Random(seed).sample(range(count), min(n, count)):
+            row = _conn.execute(
+                "SELECT user_id FROM users WHERE phone IS NOT NULL ORDER BY phone, user_id LIMIT 1 OFFSET ?",
+                (offset,)
+            ).fetchone()
+            if row:
+                ids.append(row[0])
+    else:
+        ids = [row[0] for row in _conn.execute("SELECT user_id FROM users WHERE phone IS NOT NULL")]
+        ids.sort()
+        ids = pick_winners(ids, n, seed)
+    placeholders = ",".join("?" * len(ids))
+    rows = {row[0]: row for row in _conn.execute(
+        f"SELECT user_id, username, phone, refs FROM users WHERE user_id IN ({placeholders})", ids
+    )}
+    winners = [rows[user_id] for user_id in ids]
+    with _conn:
+        _conn.execute(
+            "INSERT INTO draws (seed, n, weighted, winners, created_at) VALUES (?,?,?,?,?)",
+            (seed, n, int(weighted), ",".join(str(row[0]) for row in winners), int(time.time()))
+        )
+    return winners
+
+
+# --- STATISTIKA ---
+
+@_threaded
+def get_counters():
+    # Hisoblagichlar triggerlar orqali yuritiladi (migrations._counters) - jadval skanerlanmaydi
+    return dict(_conn.execute("SELECT name, value FROM counters"))
+
+
+@_threaded
+def get_counter_buckets(start: int):
+    return _conn.execute(
+        "SELECT name, bucket, value FROM counter_buckets WHERE bucket >= ?", (start,)
+    ).fetchall()
+
+
+@_threaded
+def sum_counter_buckets(name: str, bucket_seconds: int, start: int):
+    return dict(_conn.execute(
+        "SELECT (bucket / ?) * ?, SUM(value) FROM counter_buckets WHERE name = ? AND bucket >= ? GROUP BY 1",
+        (bucket_seconds, bucket_seconds, name, start)
+    ))
+
+
+# --- A'ZOLIK INDEKSI ---
+
+@_threaded
+def get_memberships(user_id: int, channels):
+    # chat_member update'laridan yig'ilgan a'zolik holatlari: channel -> status
+    placeholders = ",".join("?" * len(channels))
+    return dict(_conn.execute(
+        f"SELECT channel, status FROM memberships WHERE user_id=? AND channel IN ({placeholders})",
+        (user_id, *channels)
+    ).fetchall())
+
+
+@_threaded
+def upsert_memberships(rows):
+    # rows: (user_id, channel, status, updated_at); eski hodisa yangisini bosib ketmaydi.
+    # Chiqib ketgan, lekin referral sifatida hisoblangan foydalanuvchilar ro'yxati qaytadi.
+    with _conn:
+        _conn.executemany(
+            "INSERT INTO memberships (user_id, channel, status, updated_at) VALUES (?,?,?,?) "
+            "ON CONFLICT(user_id, channel) DO UPDATE SET status=excluded.status, updated_at=excluded.updated_at "
+            "WHERE excluded.updated_at >= memberships.updated_at",
+            rows
+        )
+    left = {row[0] for row in rows if row[2] in ('left', 'kicked')}
+    if not left:
+        return []
+    placeholders = ",".join("?" * len(left))
+    return [row[0] for row in _conn.execute(
+        f"SELECT user_id FROM referrals WHERE user_id IN ({placeholders})", tuple(left)
+    )]
+
+
+@_threaded
+def get_state(key: str, default=None):
+    row = _conn.execute("SELECT value FROM bot_state WHERE key=?", (key,)).fetchone()
+    return row[0] if row else default
+
+
+@_threaded
+def set_state(key: str, value):
+    with _conn:
+        _conn.execute(
+            "INSERT INTO bot_state (key, value) VALUES (?,?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+            (key, str(value))
+        )
+
+
+# --- EKSPORT ---
+# Katta eksportlar asosiy ulanishni band qilmasligi uchun alohida faqat-o'qish ulanishida
+# qatorma-qator o'qiladi (WAL rejimida yozuvlar bilan parallel ishlaydi).
+# Generatorlar sinxron: ularni asyncio.to_thread ichida iste'mol qilish kerak.
+
+def _stream(sql: str, params=(), batch: int = 1000):
+    conn = sqlite3.connect(f"file:{_path}?mode=ro", uri=True)
+    try:
+        cursor = conn.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(batch)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        conn.close()
+
+
+def stream_users(registered_only: bool = False, min_refs: int = 0):
+    sql = f"SELECT {', '.join(USER_EXPORT_COLUMNS)} FROM users WHERE refs >= ?"
+    if registered_only:
+        sql += " AND phone IS NOT NULL"
+    return _stream(sql + " ORDER BY user_id", (min_refs,))
+
+
+def stream_referrals():
+    return _stream(f"SELECT {', '.join(REFERRAL_EXPORT_COLUMNS)} FROM referrals ORDER BY user_id")
+
+
+# --- REFERRAL GRAFI ---
+
+@_threaded
+def duplicate_phones(limit: int):
+    # Bir nechta akkauntda uchragan telefonlar; GROUP BY idx_users_phone indeksi bo'yicha o'qiladi
+    rows = _conn.execute(
+        "SELECT phone, GROUP_CONCAT(user_id) FROM users WHERE phone IS NOT NULL "
+        "GROUP BY phone HAVING COUNT(*) > 1 ORDER BY COUNT(*) DESC LIMIT ?", (limit,)
+    ).fetchall()
+    return [(phone, [int(u) for u in ids.split(",")]) for phone, ids in rows]
+
+
+@_threaded
+def set_refs(rows):
+    # rows: (user_id, eski_refs, yangi_refs). Qiymat o'qilgandan keyin o'zgargan bo'lsa (parallel referral)
+    # yozilmaydi. Haqiqatan yozilganlar [(user_id, yangi_refs), ...] qaytadi.
+    changed = []
+    with _conn:
+        for user_id, old, new in rows:
+            cur = _conn.execute("UPDATE users SET refs=? WHERE user_id=? AND refs=?", (new, user_id, old))
+            if cur.rowcount:
+                changed.append((user_id, new))
+    return changed
+
+
+# --- BROADCAST ---
+
+@_threaded
+def create_broadcast(text: str, admin_chat_id: int):
+    # Boshqa broadcast 'running' bo'lsa (idx_broadcasts_running) None qaytadi
+    with _conn:
+        rows = _conn.execute(
+            "INSERT INTO broadcasts (text, admin_chat_id, created_at) VALUES (?,?,strftime('%s','now')) "
+            "ON CONFLICT (status) WHERE status = 'running' DO NOTHING RETURNING id",
+            (text, admin_chat_id)
+        ).fetchall()
+    return rows[0][0] if rows else None
+
+
+@_threaded
+def set_broadcast_message(broadcast_id: int, message_id: int):
+    with _conn:
+        _conn.execute("UPDATE broadcasts SET progress_message_id=? WHERE id=?", (message_id, broadcast_id))
+
+
+@_threaded
+def get_broadcast(broadcast_id: int):
+    return _conn.execute(
+        "SELECT id, text, admin_chat_id, progress_message_id, last_user_id, sent, failed, blocked, status "
+        "FROM broadcasts WHERE id=?", (broadcast_id,)
+    ).fetchone()
+
+
+@_threaded
+def get_running_broadcasts():
+    return [row[0] for row in _conn.execute("SELECT id FROM broadcasts WHERE status='running' ORDER BY id")]
+
+
+@_threaded
+def get_broadcast_batch(after_user_id: int, limit: int):
+    # Keyset pagination: user_id bo'yicha navbatdagi sahifa, bloklaganlar o'tkazib yuboriladi
+    return [row[0] for row in _conn.execute(
+        "SELECT user_id FROM users WHERE user_id > ? AND blocked = 0 ORDER BY user_id LIMIT ?",
+        (after_user_id, limit)
+    )]
+
+
+@_threaded
+def save_broadcast_progress(broadcast_id: int, last_user_id: int, sent: int, failed: int, blocked_ids):
+    with _conn:
+        _conn.execute(
+            "UPDATE broadcasts SET last_user_id=?, sent=sent+?, failed=failed+?, blocked=blocked+? WHERE id=?",
+            (last_user_id, sent, failed, len(blocked_ids), broadcast_id)
+        )
+        _conn.executemany("UPDATE users SET blocked=1 WHERE user_id=?", [(uid,) for uid in blocked_ids])
+
+
+@_threaded
+def finish_broadcast(broadcast_id: int):
+    # Bekor qilingan broadcast 'done' bilan ustidan yozilmaydi
+    with _conn:
+        _conn.execute("UPDATE broadcasts SET status='done' WHERE id=? AND status='running'", (broadcast_id,))
+
+
+@_threaded
+def cancel_broadcasts():
+    with _conn:
+        return [row[0] for row in _conn.execute(
+            "UPDATE broadcasts SET status='cancelled' WHERE status='running' RETURNING id"
+        ).fetchall()]
+
+
+# --- OUTBOX ---
+
+@_threaded
+def claim_notifications(limit: int, lease: int):
+    # Muddati kelgan yozuvlar `lease` soniyaga band qilinadi: boshqa jarayon ularni olmaydi,
+    # dispatcher yiqilsa esa muddat o'tgach qayta yuboriladi
+    now = int(time.time())
+    with _conn:
+        return _conn.execute(
+            "UPDATE outbox SET next_attempt_at = ? WHERE id IN "
+            "(SELECT id FROM outbox WHERE next_attempt_at <= ? ORDER BY id LIMIT ?) "
+            "RETURNING id, user_id, kind, points, attempts",
+            (now + lease, now, limit)
+        ).fetchall()
+
+
+@_threaded
+def delete_notifications(ids):
+    with _conn:
+        _conn.executemany("DELETE FROM outbox WHERE id=?", [(i,) for i in ids])
+
+
+@_threaded
+def retry_notifications(ids, delay: int):
+    with _conn:
+        _conn.executemany(
+            "UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ? WHERE id=?",
+            [(int(time.time()) + delay, i) for i in ids]
+        )
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import os
+import time
+
+from aiogram import Bot
+from aiogram.types import ChatMemberUpdated
+
+import database as db
+import metrics
+import tracing
+
+# Obuna tekshiruvi keshi sozlamalari (soniyalarda)
+SUB_CACHE_TTL = float(os.getenv("SUB_CACHE_TTL", 300))
+# Obuna bo'lmaganlik natijasi qisqa saqlanadi: foydalanuvchi obuna bo'lib qaytishi mumkin
+SUB_CACHE_NEGATIVE_TTL = float(os.getenv("SUB_CACHE_NEGATIVE_TTL", 5))
+# Bir vaqtda yuboriladigan get_chat_member so'rovlari chegarasi
+SUB_CHECK_CONCURRENCY = int(os.getenv("SUB_CHECK_CONCURRENCY", 10))
+SUB_CACHE_MAX_SIZE = int(os.getenv("SUB_CACHE_MAX_SIZE", 100000))
+# chat_member hodisalari bazaga shu oraliqda (yoki bufer to'lganda) bitta tranzaksiyada yoziladi
+MEMBERSHIP_FLUSH_INTERVAL = float(os.getenv("MEMBERSHIP_FLUSH_INTERVAL", 1))
+MEMBERSHIP_FLUSH_SIZE = int(os.getenv("MEMBERSHIP_FLUSH_SIZE", 500))
+
+NOT_MEMBER_STATUSES = ('left', 'kicked')
+
+# (user_id, channel) -> (a'zomi, amal qilish muddati)
+_cache = {}
+_semaphore = asyncio.Semaphore(SUB_CHECK_CONCURRENCY)
+# Bazaga yozilishini kutayotgan chat_member hodisalari
+_pending = []
+_flush_event = asyncio.Event()
+_flush_task = None
+
+
+def stats():
+    # /metrics uchun: kesh hajmi va bazaga yozilishini kutayotgan hodisalar
+    return {"cache": len(_cache), "pending": len(_pending)}
+
+
+def _cache_put(user_id: int, channel: str, is_member: bool):
+    now = time.monotonic()
+    if len(_cache) >= SUB_CACHE_MAX_SIZE:
+        # Avval muddati o'tganlarni tozalaymiz, yetmasa eng eskilarini
+        for key in [k for k, (_, exp) in _cache.items() if exp <= now]:
+            del _cache[key]
+        while len(_cache) >= SUB_CACHE_MAX_SIZE:
+            del _cache[next(iter(_cache))]
+    ttl = SUB_CACHE_TTL if is_member else SUB_CACHE_NEGATIVE_TTL
+    _cache[(user_id, channel)] = (is_member, now + ttl)
+
+
+async def _check_channel(bot: Bot, channel: str, user_id: int):
+    async with _semaphore:
+        try:
+            member = await bot.get_chat_member(channel, user_id)
+        except Exception as e:
+            logging.error(f"Error checking subscription for {channel}: {e}")
+            return False
+    is_member = member.status not in NOT_MEMBER_STATUSES
+    _cache_put(user_id, channel, is_member)
+    return is_member
+
+
+@tracing.traced("check")
+async def is_subscribed(bot: Bot, user_id: int, skip_negative: bool = False):
+    # skip_negative=True - "Obunani tekshirish" tugmasi uchun: salbiy natija keshdan olinmaydi
+    channels = await db.get_channels()
+    if not channels:
+        return True
+
+    now = time.monotonic()
+    unknown = []
+    for ch in channels:
+        cached = _cache.get((user_id, ch))
+        if cached is None or cached[1] <= now or (skip_negative and not cached[0]):
+            unknown.append(ch)
+            continue
+        metrics.CACHE.inc("subscription", "hit")
+        if not cached[0]:
+            return False
+
+    if not unknown:
+        return True
+
+    # Keyin chat_member hodisalaridan yig'ilgan indeks; API faqat noma'lum juftliklar uchun
+    indexed = await db.get_memberships(user_id, unknown)
+    metrics.CACHE.inc("subscription", "index", amount=len(indexed))
+    metrics.CACHE.inc("subscription", "miss", amount=len(unknown) - len(indexed))
+    if indexed:
+        for ch, status in indexed.items():
+            _cache_put(user_id, ch, status not in NOT_MEMBER_STATUSES)
+        if any(status in NOT_MEMBER_STATUSES for status in indexed.values()):
+            return False
+        unknown = [ch for ch in unknown if ch not in indexed]
+        if not unknown:
+            return True
+
+    results = await asyncio.gather(*(_check_channel(bot, ch, user_id) for ch in unknown))
+    return all(results)
+
+
+# --- CHAT_MEMBER INDEKSI ---
+
+async def track_chat_member(update: ChatMemberUpdated):
+    if not update.chat.username:
+        return
+    # Kanallar bazada kichik harfda saqlanadi (database._normalize_channel)
+    channel = '@' + update.chat.username.lower()
+    channels = await db.get_channels()
+    if channel not in channels:
+        return
+    user_id = update.new_chat_member.user.id
+    status = update.new_chat_member.status
+    _cache_put(user_id, channel, status not in NOT_MEMBER_STATUSES)
+    _pending.append((user_id, channel, status, int(update.date.timestamp())))
+    if len(_pending) >= MEMBERSHIP_FLUSH_SIZE:
+        _flush_event.set()
+
+
+async def _flush():
+    global _pending
+    if not _pending:
+        return
+    rows, _pending = _pending, []
+    try:
+        left = await db.upsert_memberships(rows)
+    except Exception as e:
+        logging.error(f"A'zolik indeksini yozishda xato: {e}")
+        _pending = rows + _pending
+        return
+    for user_id in left:
+        logging.warning(f"⚠️ Referral sifatida hisoblangan foydalanuvchi {user_id} kanaldan chiqib ketdi")
+
+
+async def _flush_loop():
+    while True:
+        try:
+            await asyncio.wait_for(_flush_event.wait(), MEMBERSHIP_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _flush_event.clear()
+        await _flush()
+
+
+def start_membership_sync():
+    global _flush_task
+    if _flush_task is None:
+        _flush_task = asyncio.create_task(_flush_loop())
+
+
+async def stop_membership_sync():
+    global _flush_task
+    if _flush_task is not None:
+        _flush_task.cancel()
+        try:
+            await _flush_task
+        except asyncio.CancelledError:
+            pass
+        _flush_task = None
+    await _flush()
@@ -0,0 +1,114 @@
+import asyncio
+import contextvars
+import logging
+import random
+import time
+from collections import OrderedDict
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter, TelegramServerError
+from aiogram.methods import Response, TelegramMethod
+
+import metrics
+import tracing
+from ratelimit import INTERACTIVE, BULK, PriorityTokenBucket, TokenBucket
+
+# Joriy vazifadagi so'rovlar ustuvorligi. Ommaviy yuborishlar (broadcast) BULK o'rnatadi,
+# qolgan barcha handlerlar standart INTERACTIVE bilan ishlaydi.
+priority = contextvars.ContextVar("telegram_priority", default=INTERACTIVE)
+
+# Xabar yuboradigan/tahrirlaydigan metodlar limitlanadi; getChatMember, answerCallbackQuery va h.k. emas
+_LIMITED_PREFIXES = ("send", "edit", "copy", "forward")
+
+
+def use_bulk_priority():
+    priority.set(BULK)
+
+
+class PooledSession(AiohttpSession):
+    # Telegram API uchun ulanishlar puli: keep-alive ulanishlar qayta ishlatiladi
+    def __init__(self, limit: int = 100, keepalive_timeout: float = 60, **kwargs):
+        super().__init__(limit=limit, **kwargs)
+        self._connector_init.update(limit_per_host=limit, keepalive_timeout=keepalive_timeout)
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    # Barcha chiqish so'rovlari uchun umumiy (global) va har bir chat uchun alohida token bucket,
+    # 429 (retry_after) va 5xx xatolarida qayta urinish.
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3,
+                 max_retries: int = 3, backoff: float = 0.5, max_chats: int = 10000):
+        self.global_bucket = PriorityTokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_chats = max_chats
+        self._chat_buckets = OrderedDict()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        # Eng kam ishlatilgan chat bucketlari chiqarib tashlanadi (LRU), xotira cheklangan
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            if len(self._chat_buckets) > self.max_chats:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType,
+        bot: Bot,
+        method: TelegramMethod,
+    ) -> Response:
+        limited = method.__api_method__.startswith(_LIMITED_PREFIXES)
+        chat_id = getattr(method, "chat_id", None) if limited else None
+        for attempt in range(self.max_retries + 1):
+            if limited:
+                if chat_id is not None:
+                    await self._chat_bucket(chat_id).acquire()
+                await self.global_bucket.acquire(priority.get())
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                logging.warning(f"⏳ {method.__api_method__}: 429, {e.retry_after} s kutiladi")
+                # Chat aniq bo'lsa faqat o'sha chat to'xtatiladi, boshqalarga javob berish davom etadi
+                if chat_id is not None:
+                    self._chat_bucket(chat_id).pause(e.retry_after)
+                elif limited:
+                    self.global_bucket.pause(e.retry_after)
+                else:
+                    await asyncio.sleep(e.retry_after)
+            except TelegramServerError as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.backoff * 2 ** attempt * (1 + random.random())
+                logging.warning(f"⚠️ {method.__api_method__}: {e}, {delay:.1f} s dan keyin qayta urinish")
+                await asyncio.sleep(delay)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    # Har bir haqiqiy HTTP so'rov (qayta urinishlar alohida) vaqti va xato turi; kuzatuv yoqilgan bo'lsa span ham
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType,
+        bot: Bot,
+        method: TelegramMethod,
+    ) -> Response:
+        name = method.__api_method__
+        start = time.perf_counter()
+        error = None
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            error = type(e).__name__
+            metrics.API_ERRORS.inc(name, error)
+            raise
+        finally:
+            metrics.API_SECONDS.observe(time.perf_counter() - start, name)
+            tracing.record("api", name, start, error)
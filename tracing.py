@@ -0,0 +1,145 @@
+import atexit
+import contextvars
+import functools
+import json
+import logging
+import logging.handlers
+import queue
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+# Update ichidagi DB va Bot API chaqiruvlari span sifatida yoziladi.
+# Kuzatuv faqat TracingMiddleware ulangan bo'lsa ishlaydi; aks holda record() darhol qaytadi.
+_current = contextvars.ContextVar("trace", default=None)
+
+slow_log = logging.getLogger("slow_updates")
+
+# (QueueListener, QueueHandler, asl handler'lar)
+_log_queue = None
+
+
+class Trace:
+    __slots__ = ("start", "spans")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = []
+
+
+def record(kind: str, name: str, start: float, error: str = None):
+    # start - time.perf_counter() bilan olingan boshlanish vaqti
+    trace = _current.get()
+    if trace is None:
+        return
+    end = time.perf_counter()
+    span = {
+        "kind": kind,
+        "name": name,
+        "at_ms": round((start - trace.start) * 1000, 2),
+        "ms": round((end - start) * 1000, 2),
+    }
+    if error:
+        span["error"] = error
+    trace.spans.append(span)
+
+
+def traced(kind: str):
+    # Async funksiya uchun span: masalan, is_subscribed ichidagi DB/API chaqiruvlarini guruhlash
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            if _current.get() is None:
+                return await fn(*args, **kwargs)
+            start = time.perf_counter()
+            error = None
+            try:
+                return await fn(*args, **kwargs)
+            except Exception as e:
+                error = type(e).__name__
+                raise
+            finally:
+                record(kind, fn.__name__, start, error)
+        return wrapper
+    return decorator
+
+
+def _describe(update) -> Dict[str, Any]:
+    info = {"update_id": update.update_id, "type": update.event_type}
+    event = update.event
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        info["user_id"] = user.id
+    if getattr(event, "text", None):
+        info["text"] = event.text[:64]
+    if getattr(event, "data", None):
+        info["data"] = event.data
+    return info
+
+
+class TracingMiddleware(BaseMiddleware):
+    # dp.update uchun: `slow_ms` dan uzoq ishlangan update'lar span'lari bilan bitta JSON qatorida loglanadi
+    def __init__(self, slow_ms: float):
+        self.slow_ms = slow_ms
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        trace = Trace()
+        token = _current.set(trace)
+        error = None
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            _current.reset(token)
+            total = (time.perf_counter() - trace.start) * 1000
+            if total >= self.slow_ms:
+                entry = _describe(event)
+                entry["ms"] = round(total, 2)
+                if error:
+                    entry["error"] = error
+                entry["spans"] = sorted(trace.spans, key=lambda s: s["at_ms"])
+                slow_log.warning(json.dumps(entry, ensure_ascii=False))
+
+
+def start_log_queue():
+    # Root logger handler'lari alohida oqimga ko'chiriladi: event loop faqat yozuvni navbatga qo'yadi,
+    # fayl/konsolga yozish QueueListener oqimida bajariladi.
+    global _log_queue
+    if _log_queue is not None:
+        return
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    if not handlers:
+        return
+    records = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    _log_queue = (listener, queue_handler, handlers)
+    atexit.register(stop_log_queue)
+
+
+def stop_log_queue():
+    # Navbatdagi qolgan yozuvlar chiqarib bo'lingach oqim to'xtaydi
+    global _log_queue
+    if _log_queue is None:
+        return
+    listener, queue_handler, handlers = _log_queue
+    _log_queue = None
+    listener.stop()
+    root = logging.getLogger()
+    root.removeHandler(queue_handler)
+    for handler in handlers:
+        root.addHandler(handler)
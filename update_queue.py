@@ -0,0 +1,95 @@
+import asyncio
+import logging
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+
+
+class UpdateQueue:
+    # Update'lar foydalanuvchi bo'yicha shardlarga bo'linadi: har bir shardni bitta worker
+    # ketma-ket bajaradi, shuning uchun bitta foydalanuvchining update'lari tartibi saqlanadi,
+    # turli foydalanuvchilar esa parallel ishlanadi.
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, workers: int, maxsize: int, put_timeout: float):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.put_timeout = put_timeout
+        self._queues = [asyncio.Queue(maxsize=max(1, maxsize // workers)) for _ in range(workers)]
+        self._tasks = []
+        self._closing = False
+
+    @staticmethod
+    def shard_key(update: Update) -> int:
+        event = update.event
+        user = getattr(event, "from_user", None)
+        if user is not None:
+            return user.id
+        chat = getattr(event, "chat", None)
+        if chat is not None:
+            return chat.id
+        return update.update_id
+
+    def qsize(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def start(self):
+        self._closing = False
+        self._tasks = [asyncio.create_task(self._worker(q)) for q in self._queues]
+
+    async def put(self, update: Update, wait: bool = False) -> bool:
+        # Navbat to'la bo'lsa put_timeout kutiladi; baribir joy bo'lmasa False qaytadi (backpressure).
+        # wait=True bo'lsa joy bo'shaguncha kutiladi (polling: update Telegram'da qolib turadi).
+        if self._closing:
+            return False
+        queue = self._queues[self.shard_key(update) % len(self._queues)]
+        if wait:
+            await queue.put(update)
+            return True
+        try:
+            await asyncio.wait_for(queue.put(update), self.put_timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"⚠️ Update navbati to'la, update {update.update_id} qabul qilinmadi")
+            return False
+        return True
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            update = await queue.get()
+            try:
+                await self.dispatcher.feed_update(self.bot, update)
+            except Exception as e:
+                logging.exception(f"Update {update.update_id} ni ishlashda xato: {e}")
+            finally:
+                queue.task_done()
+
+    async def drain(self, timeout: float = 30):
+        # Yangi update qabul qilinmaydi, navbatdagilar tugatiladi, keyin workerlar to'xtatiladi
+        self._closing = True
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"⚠️ Navbatda {self.qsize()} ta update ishlanmay qoldi")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+class QueuedRequestHandler(SimpleRequestHandler):
+    # Webhook update'ni navbatga qo'yadi va Telegram'ga darhol javob qaytaradi.
+    # Navbat to'la bo'lsa 503 qaytadi - Telegram update'ni keyinroq qayta yuboradi.
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, queue: UpdateQueue, **kwargs):
+        super().__init__(dispatcher=dispatcher, bot=bot, **kwargs)
+        self.queue = queue
+
+    async def handle(self, request: web.Request) -> web.Response:
+        bot = await self.resolve_bot(request)
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), bot):
+            return web.Response(body="Unauthorized", status=401)
+        update = Update.model_validate(await request.json(loads=bot.session.json_loads), context={"bot": bot})
+        if not await self.queue.put(update):
+            return web.Response(body="Queue is full", status=503)
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    __call__ = handle